@@ -0,0 +1,98 @@
+import argparse
+import gc
+import itertools
+import random
+import sys
+import time
+import tracemalloc
+import uuid
+
+import lib.broadcast_planner
+from lib.broadcast_planner import BroadcastPlan
+from lib.test_util import TestLogger
+from lib.uuid_cache import DictUuidCache
+
+uuid_prefix = "nook-phone-uuid-"
+
+
+class CachedUuidTable(object):
+    """A uuid table whose mappings are all cached, so that only the cost of planning is measured"""
+    def __init__(self, num_mappings):
+        self._cache = DictUuidCache()
+        self.uuids = []
+        rng = random.Random(1)
+        for count in range(0, num_mappings):
+            data_uuid = uuid_prefix + str(uuid.UUID(int=rng.getrandbits(128), version=4))
+            self._cache.add(f"tel:+2547{rng.randrange(0, 100000000):08}{count}", data_uuid)
+            self.uuids.append(data_uuid)
+
+    def uuid_to_data_batch(self, uuids_to_lookup):
+        results = {}
+        for uuid_lookup in uuids_to_lookup:
+            data = self._cache.get_data(uuid_lookup)
+            if data is None:
+                raise LookupError(f"Failed to find data for uuid {uuid_lookup}")
+            results[uuid_lookup] = data
+        return results
+
+
+def plan_in_lists(uuid_table, ids):
+    """Plan the groups as rapidpro_outgoing did before BroadcastPlan"""
+    mappings = uuid_table.uuid_to_data_batch(ids)
+    urns = list(mappings.values())
+    urn_groups = []
+    group_start = 0
+    group_end = 100
+    while group_end < len(urns):
+        urn_groups.append(urns[group_start:group_end])
+        group_start = group_end
+        group_end += 100
+    urn_groups.append(urns[group_start:])
+    assert set(urns) == set(itertools.chain.from_iterable(urn_groups))
+    return urn_groups
+
+
+def plan_streaming(uuid_table, ids):
+    return BroadcastPlan(uuid_table, ids).groups()
+
+
+def consume(groups):
+    """Iterate over the groups as they would be sent, returning the # of URNs"""
+    urn_count = 0
+    for urns in groups:
+        urn_count += len(urns)
+    return urn_count
+
+
+def measure(planner_name, plan_funct, uuid_table, ids):
+    # Measure the peak memory used while planning and iterating over the groups
+    gc.collect()
+    tracemalloc.start()
+    consume(plan_funct(uuid_table, ids))
+    _, peak_memory_bytes = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    # Measure the time without the overhead of tracemalloc
+    gc.collect()
+    start = time.perf_counter()
+    urn_count = consume(plan_funct(uuid_table, ids))
+    plan_time = time.perf_counter() - start
+    assert urn_count == len(set(ids))
+
+    print(f"{planner_name:<12} {len(ids):>10} {plan_time:>10.3f} {peak_memory_bytes / 1e6:>10.1f}")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description="Compare the time and peak memory used to plan the groups of URNs for a broadcast")
+    parser.add_argument("--num-recipients", type=int, nargs="+", default=[10000, 100000, 1000000],
+                        help="Numbers of recipients in the broadcasts to plan")
+
+    args = parser.parse_args(sys.argv[1:])
+    lib.broadcast_planner.log = TestLogger("broadcast_planner")
+
+    print(f"{'planner':<12} {'recipients':>10} {'plan s':>10} {'peak MB':>10}")
+    for num_recipients in args.num_recipients:
+        table = CachedUuidTable(num_recipients)
+        measure("lists", plan_in_lists, table, table.uuids)
+        measure("streaming", plan_streaming, table, table.uuids)
@@ -0,0 +1,78 @@
+import argparse
+import gc
+import random
+import sys
+import time
+import tracemalloc
+import uuid
+
+from lib.uuid_cache import CompactUuidCache, DictUuidCache
+
+uuid_prefix = "nook-phone-uuid-"
+
+
+def generate_mappings(num_mappings):
+    """Generate the same sequence of (data, uuid) pairs each time this is called.
+    New string instances are created each time so that they are owned by the cache being measured."""
+    rng = random.Random(1)
+    for count in range(0, num_mappings):
+        yield f"tel:+2547{rng.randrange(0, 100000000):08}{count}", uuid_prefix + str(uuid.UUID(int=rng.getrandbits(128), version=4))
+
+
+def build_cache(new_cache_funct, num_mappings):
+    cache = new_cache_funct()
+    for data, data_uuid in generate_mappings(num_mappings):
+        cache.add(data, data_uuid)
+    return cache
+
+
+def measure(cache_name, new_cache_funct, num_mappings, num_lookups):
+    # Measure the memory used by the cache
+    gc.collect()
+    tracemalloc.start()
+    cache = build_cache(new_cache_funct, num_mappings)
+    gc.collect()
+    memory_bytes, peak_memory_bytes = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    cache = None
+
+    # Measure the time to build the cache without the overhead of tracemalloc
+    gc.collect()
+    build_start = time.perf_counter()
+    cache = build_cache(new_cache_funct, num_mappings)
+    build_time = time.perf_counter() - build_start
+
+    # Measure the lookup latency in each direction
+    sample_indices = set(random.Random(2).sample(range(0, num_mappings), min(num_lookups, num_mappings)))
+    samples = [pair for index, pair in enumerate(generate_mappings(num_mappings)) if index in sample_indices]
+    sample_data = [data for data, _ in samples]
+    sample_uuids = [data_uuid for _, data_uuid in samples]
+
+    start = time.perf_counter()
+    for data in sample_data:
+        cache.get_uuid(data)
+    data_to_uuid_usec = (time.perf_counter() - start) / len(samples) * 1e6
+
+    start = time.perf_counter()
+    for data_uuid in sample_uuids:
+        cache.get_data(data_uuid)
+    uuid_to_data_usec = (time.perf_counter() - start) / len(samples) * 1e6
+
+    print(f"{cache_name:<18} {len(cache):>10} {memory_bytes / 1e6:>10.1f} {peak_memory_bytes / 1e6:>10.1f} "
+          f"{memory_bytes / len(cache):>10.1f} {build_time:>8.1f} {data_to_uuid_usec:>12.2f} {uuid_to_data_usec:>12.2f}")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description="Compare the memory used and lookup latency of the uuid table cache implementations")
+    parser.add_argument("--num-mappings", type=int, default=1000000,
+                        help="Number of data --> uuid mappings to cache")
+    parser.add_argument("--num-lookups", type=int, default=100000,
+                        help="Number of lookups used to measure latency")
+
+    args = parser.parse_args(sys.argv[1:])
+
+    print(f"{'cache':<18} {'mappings':>10} {'MB':>10} {'peak MB':>10} {'B/mapping':>10} {'build s':>8} "
+          f"{'data->uuid us':>12} {'uuid->data us':>12}")
+    measure("DictUuidCache", DictUuidCache, args.num_mappings, args.num_lookups)
+    measure("CompactUuidCache", lambda: CompactUuidCache(uuid_prefix), args.num_mappings, args.num_lookups)
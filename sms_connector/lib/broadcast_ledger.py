@@ -0,0 +1,100 @@
+import sqlite3
+import threading
+import time
+
+from lib.simple_logger import Logger
+
+log = None
+
+# Pub/Sub retains unacknowledged messages for at most 7 days, so progress older than this is never needed
+DEFAULT_RETENTION_SECONDS = 7 * 24 * 60 * 60
+
+
+class BroadcastLedger(object):
+    """
+    A durable record, stored in a local SQLite database, of the progress of each broadcast
+    keyed by the Pub/Sub message ID of the send_messages message.
+
+    For each group of URNs, the ledger records the # of texts that have been sent to the group.
+    Texts are sent to each group in order, so if a message is redelivered then the groups and texts that
+    have already been sent can be skipped. This relies on the groups for a message being planned identically
+    each time it is processed, which they are because the ids in the message and their URNs never change.
+    """
+    def __init__(self, path, retention_seconds=DEFAULT_RETENTION_SECONDS):
+        global log
+        if log is None:
+            log = Logger(__name__)
+
+        self.path = path
+        self.retention_seconds = retention_seconds
+        # Groups are sent on multiple threads, so all access to the connection is synchronized
+        self._lock = threading.Lock()
+        self._connection = sqlite3.connect(path, check_same_thread=False)
+        with self._lock, self._connection:
+            self._connection.execute(
+                "CREATE TABLE IF NOT EXISTS group_progress ("
+                "message_id TEXT NOT NULL, group_num INTEGER NOT NULL, texts_sent INTEGER NOT NULL, "
+                "updated REAL NOT NULL, PRIMARY KEY (message_id, group_num))")
+            self._connection.execute(
+                "CREATE TABLE IF NOT EXISTS completed_broadcasts ("
+                "message_id TEXT NOT NULL PRIMARY KEY, completed REAL NOT NULL)")
+        self.expire()
+
+    def progress(self, message_id):
+        """Return the BroadcastProgress for the specified message, including any progress already recorded"""
+        with self._lock:
+            rows = self._connection.execute(
+                "SELECT group_num, texts_sent FROM group_progress WHERE message_id = ?", (message_id,)).fetchall()
+        if len(rows) > 0:
+            log.info(f"Resuming broadcast {message_id}: {len(rows)} groups already sent some or all texts")
+        return BroadcastProgress(self, message_id, dict(rows))
+
+    def is_complete(self, message_id):
+        """Return True if all of the texts in the specified message have been sent to all of the groups"""
+        with self._lock:
+            row = self._connection.execute(
+                "SELECT 1 FROM completed_broadcasts WHERE message_id = ?", (message_id,)).fetchone()
+        return row is not None
+
+    def complete(self, message_id):
+        """Record that the specified message has been sent in full, discarding the progress of each group"""
+        with self._lock, self._connection:
+            self._connection.execute(
+                "INSERT OR REPLACE INTO completed_broadcasts (message_id, completed) VALUES (?, ?)",
+                (message_id, time.time()))
+            self._connection.execute("DELETE FROM group_progress WHERE message_id = ?", (message_id,))
+
+    def expire(self):
+        """Discard the progress of broadcasts older than the retention period"""
+        cutoff = time.time() - self.retention_seconds
+        with self._lock, self._connection:
+            self._connection.execute("DELETE FROM group_progress WHERE updated < ?", (cutoff,))
+            self._connection.execute("DELETE FROM completed_broadcasts WHERE completed < ?", (cutoff,))
+
+    def close(self):
+        with self._lock:
+            self._connection.close()
+
+    def _record_texts_sent(self, message_id, group_num, texts_sent):
+        # Commit each update so that it survives the adapter dying
+        with self._lock, self._connection:
+            self._connection.execute(
+                "INSERT OR REPLACE INTO group_progress (message_id, group_num, texts_sent, updated) "
+                "VALUES (?, ?, ?, ?)", (message_id, group_num, texts_sent, time.time()))
+
+
+class BroadcastProgress(object):
+    """The progress of sending a single broadcast, as recorded in a BroadcastLedger"""
+    def __init__(self, ledger, message_id, texts_sent_by_group):
+        self.ledger = ledger
+        self.message_id = message_id
+        self._texts_sent_by_group = texts_sent_by_group
+
+    def texts_sent(self, group_num):
+        """Return the # of texts that have already been sent to the specified group"""
+        return self._texts_sent_by_group.get(group_num, 0)
+
+    def record_texts_sent(self, group_num, texts_sent):
+        """Record that the first texts_sent texts have been sent to the specified group"""
+        self._texts_sent_by_group[group_num] = texts_sent
+        self.ledger._record_texts_sent(self.message_id, group_num, texts_sent)
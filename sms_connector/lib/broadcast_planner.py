@@ -0,0 +1,84 @@
+from lib.simple_logger import Logger
+
+log = None
+
+# The max # of URNs in a single send to RapidPro
+GROUP_SIZE = 100
+
+# The # of ids resolved to URNs by each call to the uuid table
+RESOLVE_CHUNK_SIZE = 1000
+
+
+class BroadcastPlan(object):
+    """
+    Plans sending a broadcast to a potentially very large list of recipient ids by streaming groups of URNs.
+
+    Duplicate ids are skipped, ids are resolved to URNs in chunks of chunk_size,
+    and groups of up to group_size URNs are yielded in the order of the ids as they are needed
+    so that the groups are never all held in memory at once.
+
+    Every id is resolved before the first group is yielded so that a LookupError for an unknown id
+    is raised before anything is sent. The resolved URNs are kept in a single list, which refers to
+    the URNs cached by the uuid table rather than copying them, and each group is sliced from that list.
+    """
+    def __init__(self, uuid_table, ids, group_size=GROUP_SIZE, chunk_size=RESOLVE_CHUNK_SIZE):
+        global log
+        if log is None:
+            log = Logger(__name__)
+
+        assert group_size > 0
+        assert chunk_size > 0
+        self.uuid_table = uuid_table
+        self.ids = ids
+        self.group_size = group_size
+        self.chunk_size = chunk_size
+        # Updated as the groups are planned
+        self.recipient_count = 0
+        self.duplicate_count = 0
+        self.group_count = 0
+        self.planned_urn_count = 0
+
+    def groups(self):
+        """Yield lists of up to group_size URNs, one for each unique id, in the order of the ids.
+        Raises LookupError before yielding any groups if any of the ids is unknown."""
+        urns = []
+        for chunk in self._unique_id_chunks():
+            urns.extend(self._resolve_chunk(chunk))
+
+        for group_start in range(0, len(urns), self.group_size):
+            group = urns[group_start:group_start + self.group_size]
+            self.group_count += 1
+            self.planned_urn_count += len(group)
+            yield group
+
+        # Check that the groups contained all of the recipients
+        assert self.planned_urn_count == self.recipient_count, \
+            f"Planned {self.planned_urn_count} URNs for {self.recipient_count} recipients"
+        log.info(f"Planned {self.group_count} groups for {self.recipient_count} recipients, "
+                 f"skipped {self.duplicate_count} duplicate ids")
+
+    def _unique_id_chunks(self):
+        """Yield lists of up to chunk_size ids, skipping and counting duplicate ids"""
+        seen_ids = set()
+        chunk = []
+        for id in self.ids:
+            if id in seen_ids:
+                self.duplicate_count += 1
+                continue
+            seen_ids.add(id)
+            self.recipient_count += 1
+            chunk.append(id)
+            if len(chunk) >= self.chunk_size:
+                yield chunk
+                chunk = []
+        if len(chunk) > 0:
+            yield chunk
+
+    def _resolve_chunk(self, chunk):
+        """Return the URNs of the ids in the chunk, in the order of the ids"""
+        mappings = self.uuid_table.uuid_to_data_batch(chunk)
+
+        # HACK: RapidPro sometimes crashes on sending messages to urns that don't start with "tel:+".
+        # These are working phone numbers though, and we can receive messages from them,
+        # so the issue has been raised with RapidPro and they are not filtered out here.
+        return [mappings[id] for id in chunk]
@@ -0,0 +1,147 @@
+import threading
+import time
+from collections import deque
+
+from lib.simple_logger import Logger
+
+log = None
+
+CLOSED = "closed"
+OPEN = "open"
+HALF_OPEN = "half-open"
+
+
+class CircuitOpenError(Exception):
+    """Raised instead of making a request while the circuit breaker is open"""
+    pass
+
+
+class CircuitBreaker(object):
+    """
+    A thread safe circuit breaker for requests to a server which may be shared by several clients of that server.
+
+    While closed, requests are allowed and the time of each failure is kept in a sliding window of window_sec seconds.
+    When the window contains max_failures failures the breaker opens and requests are not allowed,
+    so that an outage is detected quickly and the server is not sent requests which will fail.
+    After reset_timeout_sec seconds the breaker is half-open and allows a single probe request.
+    If the probe succeeds, the breaker closes. If it fails, the breaker opens again.
+    """
+    def __init__(self, name, max_failures=10, window_sec=5 * 60, reset_timeout_sec=60, clock=time.monotonic):
+        global log
+        if log is None:
+            log = Logger(__name__)
+
+        assert max_failures > 0
+        self.name = name
+        self.max_failures = max_failures
+        self.window_sec = window_sec
+        self.reset_timeout_sec = reset_timeout_sec
+        self._clock = clock
+        self._condition = threading.Condition()
+        self._state = CLOSED
+        # the times of the failures in the sliding window, oldest first
+        self._failures = deque()
+        self._opened_at = None
+        # the time at which the probe request was allowed, or None if there is no probe in progress
+        self._probe_started_at = None
+        self.open_count = 0
+        self.rejected_count = 0
+
+    @property
+    def state(self):
+        with self._condition:
+            return self._state
+
+    def failure_count(self):
+        """Return the # of failures in the sliding window"""
+        with self._condition:
+            self._expire_failures(self._clock())
+            return len(self._failures)
+
+    def allow_request(self):
+        """Return True if a request may be made now.
+        If the breaker is half-open, then only the first caller is allowed to make a probe request."""
+        with self._condition:
+            now = self._clock()
+            if self._state == CLOSED:
+                return True
+            if self._state == OPEN:
+                if now < self._opened_at + self.reset_timeout_sec:
+                    self.rejected_count += 1
+                    return False
+                log.info(f"{self.name}: half-open, probing")
+                self._state = HALF_OPEN
+                self._probe_started_at = now
+                return True
+            # Allow another probe if the result of the last probe was never recorded
+            if self._probe_started_at is None or now >= self._probe_started_at + self.reset_timeout_sec:
+                self._probe_started_at = now
+                return True
+            self.rejected_count += 1
+            return False
+
+    def wait_until_allowed(self, stop_event=None):
+        """Block until a request may be made and return True,
+        or return False if stop_event is set first, e.g. when shutting down. See wake_waiters()."""
+        while not self.allow_request():
+            with self._condition:
+                if stop_event is not None and stop_event.is_set():
+                    return False
+                self._condition.wait(max(self.seconds_until_probe(), 0.1))
+        return True
+
+    def wake_waiters(self):
+        """Wake the threads blocked in wait_until_allowed so that they check their stop_event"""
+        with self._condition:
+            self._condition.notify_all()
+
+    def seconds_until_probe(self):
+        """Return the # of seconds until a probe request will be allowed, or 0 if a request may be made now"""
+        with self._condition:
+            now = self._clock()
+            if self._state == OPEN:
+                return max(self._opened_at + self.reset_timeout_sec - now, 0)
+            if self._state == HALF_OPEN and self._probe_started_at is not None:
+                return max(self._probe_started_at + self.reset_timeout_sec - now, 0)
+            return 0
+
+    def record_success(self):
+        """Record that a request reached the server, closing the breaker if it was half-open"""
+        with self._condition:
+            if self._state != CLOSED:
+                log.info(f"{self.name}: closed")
+                self._state = CLOSED
+                self._failures.clear()
+                self._opened_at = None
+                self._probe_started_at = None
+                self._condition.notify_all()
+
+    def record_failure(self):
+        """Record that a request failed, opening the breaker if there are now too many failures in the window.
+        Return the # of failures in the window."""
+        with self._condition:
+            now = self._clock()
+            self._failures.append(now)
+            self._expire_failures(now)
+            if self._state == HALF_OPEN or (self._state == CLOSED and len(self._failures) >= self.max_failures):
+                log.warning(f"{self.name}: open after {len(self._failures)} failures in {self.window_sec} seconds")
+                self._state = OPEN
+                self._opened_at = now
+                self._probe_started_at = None
+                self.open_count += 1
+            return len(self._failures)
+
+    def stats(self):
+        """Return a dictionary containing the state and counters of the breaker, e.g. for metrics"""
+        with self._condition:
+            self._expire_failures(self._clock())
+            return {
+                "state": self._state,
+                "failures": len(self._failures),
+                "open_count": self.open_count,
+                "rejected_count": self.rejected_count,
+            }
+
+    def _expire_failures(self, now):
+        while len(self._failures) > 0 and self._failures[0] <= now - self.window_sec:
+            self._failures.popleft()
@@ -1,11 +1,37 @@
+import datetime
+import os
+import threading
+import time
 import uuid
+from concurrent.futures import ThreadPoolExecutor
 
 from firebase_admin import firestore
+from google.cloud.firestore_v1.field_path import FieldPath
 
 from lib.simple_logger import Logger
+from lib.utils import utcnow
+from lib.uuid_cache import CompactUuidCache, DictUuidCache, LruUuidCache
+from lib.uuid_table_snapshot import UuidTableSnapshot
 
+# The maximum number of writes in a firestore transaction
 BATCH_SIZE = 500
+# The maximum number of values in a firestore "in" query
+IN_QUERY_MAX_VALUES = 10
 _UUID_KEY_NAME = "uuid"
+_TIMESTAMP_KEY_NAME = "timestamp"
+_DATA_KEY_NAME = "data"
+
+# Mappings are stamped with the firestore server time when they are created so that
+# mappings created since a snapshot was written can be found using the snapshot high water mark.
+# Every process that writes mappings must stamp them this way. Mappings written without a timestamp
+# are only found by a full reload, which happens if a uuid cannot be found in a table loaded from a snapshot.
+# When loading mappings that have changed since a snapshot was written,
+# also load mappings up to this long before the snapshot high water mark
+# in case mappings were stamped with the clocks of processes that are not in sync.
+SNAPSHOT_OVERLAP = datetime.timedelta(minutes=10)
+
+# When loading the table in parallel partitions, log progress after loading this many mappings
+LOAD_PROGRESS_INTERVAL = 50000
 
 log = None
 
@@ -14,7 +40,9 @@ class FirestoreUuidTable(object):
     """
     Mapping table between a string and a random UUID backed by Firestore
     """
-    def __init__(self, firebase_client, table_name, uuid_prefix, crypto_token_path):
+    def __init__(self, firebase_client, table_name, uuid_prefix, crypto_token_path, snapshot_path=None,
+                 listen_for_changes=False, compact_cache=False, lazy_cache_size=None, maintain_reverse_index=False,
+                 load_partitions=1, load_partition_boundaries=None):
         global log
         if log is None:
             log = Logger(__name__)
@@ -22,36 +50,213 @@ class FirestoreUuidTable(object):
         self.firebase_client = firebase_client
         self._table_name = table_name
         self._uuid_prefix = uuid_prefix
-        self._data_to_uuid = None
-        self._uuid_to_data = None
+        # the cached mappings or None if the table has not been cached
+        self._cache = None
+        # if True, then cache the mappings in a CompactUuidCache rather than a DictUuidCache
+        self._compact_cache = compact_cache
+        # if not None, then rather than caching the entire table up front, mappings are read from firebase
+        # as they are needed and at most this many of the most recently used mappings are cached
+        self._lazy_cache_size = lazy_cache_size
+        # if True, then a uuid --> data document is written for each mapping that is created
+        # so that uuids can be looked up without caching the entire table
+        self._maintain_reverse_index = maintain_reverse_index or lazy_cache_size is not None
+        # the # of partitions in which to load the entire table in parallel when the table is cached
+        self._load_partitions = load_partitions
+        # the document ids at which the table is split into partitions that are loaded in parallel,
+        # or None to choose them from the first and last document ids when the table is loaded.
+        # If empty, then the table is loaded using a single stream.
+        self._load_partition_boundaries = \
+            sorted(set(load_partition_boundaries)) if load_partition_boundaries is not None else None
+        # the most recent mapping timestamp that has been cached, a datetime
+        self._high_water_mark = None
+        # True if the table was cached from a snapshot and only mappings with a timestamp were loaded from firebase
+        self._loaded_from_snapshot = False
+        # an optional local copy of the table used to speed up caching the table
+        self._snapshot = UuidTableSnapshot(snapshot_path) if snapshot_path is not None else None
+        # if True, then mappings created by other processes are added to the cache as they are created
+        self._listen_for_changes = listen_for_changes
+        # the snapshot listener, if listening for changes
+        self._watch = None
+        self._cache_lock = threading.Lock()
 
     def _data_to_uuid_collection(self):
         return self.firebase_client.collection(f"tables/{self._table_name}/mappings")
 
+    def _uuid_to_data_collection(self):
+        return self.firebase_client.collection(f"tables/{self._table_name}/reverse-mappings")
+
+    def _reverse_index_collection(self):
+        """Return the collection in which new uuid --> data documents should be written, or None"""
+        return self._uuid_to_data_collection() if self._maintain_reverse_index else None
+
     def cache_uuid_table(self):
         """If the UUID table lookup has not been cached locally, then this method will block and cache
         the entire UUID table from firestore... which may take a while.
         This will only happen once per instance of FirestoreUuidTable
+
+        If the table was created with a lazy_cache_size, then nothing is loaded
+        and mappings are read from firestore as they are needed.
         """
-        if self._data_to_uuid is not None:
+        if self._cache is not None:
             return
 
-        self._data_to_uuid = dict()
-        self._uuid_to_data = dict()
-        count = 0
+        if self._lazy_cache_size is not None:
+            log.info(f"Caching up to {self._lazy_cache_size} recently used uuid mappings")
+            self._cache = LruUuidCache(self._lazy_cache_size)
+            return
+
+        self._cache = CompactUuidCache(self._uuid_prefix) if self._compact_cache else DictUuidCache()
 
+        # If there is a local snapshot of the table, then load it
+        # and only load mappings from firebase that have changed since the snapshot was written
+        snapshot_count = None
+        if self._snapshot is not None:
+            snapshot_count, high_water_mark = self._snapshot.load_into(self._cache.add)
+            if high_water_mark is not None:
+                self._high_water_mark = datetime.datetime.fromisoformat(high_water_mark)
         # We cannot be sure that stream() will return all of the entries in the firebase UUID table
         # but new_or_existing_uuid_for_data() ensures that any entries that are not loaded will not be overwritten.
         # TODO consider adding exception handling to gracefully degrade if an exception occurs (e.g. network failure)
         # TODO consider adding field containing # of mappings so that we know if stream fails to return all mappings
-        log.info(f"Loading uuid mappings...")
-        for doc in self._data_to_uuid_collection().stream():
-            data = doc.id
-            uuid = doc.to_dict()[_UUID_KEY_NAME]
-            self._data_to_uuid[data] = uuid
-            self._uuid_to_data[uuid] = data
+        if snapshot_count is not None and self._high_water_mark is not None:
+            log.info(f"Loading uuid mappings changed since the snapshot...")
+            count = self._cache_docs(self._changed_since_query(self._high_water_mark).stream())
+            log.info(f"Loaded {count} uuid mappings")
+            self._loaded_from_snapshot = True
+        else:
+            # Without a high water mark, the mappings that changed since the snapshot cannot be found
+            self._load_entire_table()
+
+        if self._snapshot is not None:
+            self.save_snapshot()
+        if self._listen_for_changes:
+            self.start_listening()
+
+    def _load_entire_table(self):
+        boundaries = self._load_partition_boundaries
+        if boundaries is None:
+            boundaries = self._sample_partition_boundaries() if self._load_partitions > 1 else []
+        if len(boundaries) > 0:
+            self._load_partitions_in_parallel(boundaries)
+        else:
+            log.info(f"Loading uuid mappings...")
+            count = self._cache_docs(self._data_to_uuid_collection().stream())
+            log.info(f"Loaded {count} uuid mappings")
+
+    def _reload_after_miss(self):
+        """If the table was cached from a snapshot, then reload the entire table in case the missing mappings
+        were written without a timestamp, and return True. Otherwise return False."""
+        if not self._loaded_from_snapshot:
+            return False
+        log.warning(f"Uuid not found in table cached from snapshot, reloading the entire table")
+        self._loaded_from_snapshot = False
+        self._load_entire_table()
+        self.save_snapshot()
+        return True
+
+    def _changed_since_query(self, high_water_mark):
+        """Return the query for the mappings stamped at or after the specified high water mark less the overlap"""
+        return self._data_to_uuid_collection().where(_TIMESTAMP_KEY_NAME, ">=", high_water_mark - SNAPSHOT_OVERLAP)
+
+    def _cache_docs(self, docs, progress=None):
+        """Cache the mappings in the specified documents and return the number of mappings cached"""
+        count = 0
+        for doc in docs:
+            doc_data = doc.to_dict()
+            self._cache_mapping(doc.id, doc_data[_UUID_KEY_NAME], doc_data.get(_TIMESTAMP_KEY_NAME))
+            count += 1
+            if progress is not None and count % LOAD_PROGRESS_INTERVAL == 0:
+                progress.add(LOAD_PROGRESS_INTERVAL)
+        if progress is not None:
+            progress.add(count % LOAD_PROGRESS_INTERVAL)
+        return count
+
+    def _sample_partition_boundaries(self):
+        """Return the document ids at which to split the table into approximately equal partitions
+        by reading the first and last document ids in the table"""
+        collection = self._data_to_uuid_collection()
+        first_docs = list(collection.order_by(FieldPath.document_id()).limit(1).stream())
+        last_docs = list(collection.order_by(FieldPath.document_id(), direction=firestore.Query.DESCENDING)
+                         .limit(1).stream())
+        if len(first_docs) == 0 or len(last_docs) == 0:
+            return []
+        return partition_boundaries(first_docs[0].id, last_docs[0].id, self._load_partitions)
+
+    def _load_partitions_in_parallel(self, boundaries):
+        """Load the entire table by streaming each partition of the document id keyspace on a separate thread"""
+        partitions = list(zip([None] + boundaries, boundaries + [None]))
+        log.info(f"Loading uuid mappings in {len(partitions)} partitions...")
+        progress = _LoadProgress()
+        with ThreadPoolExecutor(max_workers=len(partitions), thread_name_prefix="uuid-table-load") as executor:
+            futures = [executor.submit(self._load_partition, start_id, end_id, progress)
+                       for start_id, end_id in partitions]
+            # Raise the first exception, if any, after all of the partitions have completed
+            for future in futures:
+                future.result()
+        progress.log_complete()
+
+    def _load_partition(self, start_id, end_id, progress):
+        """Cache the mappings with document ids >= start_id and < end_id, where None means unbounded"""
+        collection = self._data_to_uuid_collection()
+        query = collection
+        if start_id is not None:
+            query = query.where(FieldPath.document_id(), ">=", collection.document(start_id))
+        if end_id is not None:
+            query = query.where(FieldPath.document_id(), "<", collection.document(end_id))
+        count = self._cache_docs(query.stream(), progress)
+        log.debug(f"Loaded {count} uuid mappings from partition [{start_id}, {end_id})")
+
+    def start_listening(self):
+        """Subscribe to mappings created in firebase, including those created by other processes,
+        and add them to the cache as they are created.
+        This method caches the UUID table if it has not already been cached."""
+        self.cache_uuid_table()
+        if self._watch is not None:
+            return
+        # If no cached mappings have a timestamp, then the entire table was just loaded
+        high_water_mark = self._high_water_mark if self._high_water_mark is not None else utcnow()
+        log.info(f"Listening for uuid mappings created since {high_water_mark.isoformat()}")
+        self._watch = self._changed_since_query(high_water_mark).on_snapshot(self._on_mappings_snapshot)
+
+    def stop_listening(self):
+        """Unsubscribe from mappings created in firebase"""
+        if self._watch is not None:
+            self._watch.unsubscribe()
+            self._watch = None
+
+    def _on_mappings_snapshot(self, doc_snapshots, changes, read_time):
+        """Called on a background thread with the mappings that have been added or modified"""
+        count = 0
+        for change in changes:
+            if change.type.name == "REMOVED":
+                continue
+            doc = change.document
+            doc_data = doc.to_dict()
+            self._cache_mapping(doc.id, doc_data[_UUID_KEY_NAME], doc_data.get(_TIMESTAMP_KEY_NAME))
             count += 1
-        log.info(f"Loaded {count} uuid mappings")
+        log.debug(f"Cached {count} uuid mappings from snapshot listener")
+
+    def save_snapshot(self, wait=False):
+        """Write the cached mappings to the local snapshot on a background thread.
+
+        :param wait: if True, then block until the snapshot has been written
+        """
+        if self._snapshot is None or self._cache is None or self._lazy_cache_size is not None:
+            return
+        with self._cache_lock:
+            data_uuid_pairs = list(self._cache.items())
+            high_water_mark = self._high_water_mark
+        self._snapshot.write_in_background(
+            data_uuid_pairs, high_water_mark.isoformat() if high_water_mark is not None else None)
+        if wait:
+            self._snapshot.wait()
+
+    def _cache_mapping(self, data, data_uuid, timestamp=None):
+        # Mappings can be cached by both the snapshot listener thread and the thread using this table
+        with self._cache_lock:
+            self._cache.add(data, data_uuid)
+            if timestamp is not None and (self._high_water_mark is None or timestamp > self._high_water_mark):
+                self._high_water_mark = timestamp
 
     def data_to_uuid_batch(self, list_of_data_requested):
         """
@@ -64,11 +269,43 @@ class FirestoreUuidTable(object):
 
         log.info(f"Sourcing uuids for {len(list_of_data_requested)} data items...")
         ret = dict()
+        missing_data = []
         for data_requested in set(list_of_data_requested):
-            # If large #s of new data-to-uuid mappings need to be created and the code below becomes a bottleneck,
-            # then `data_to_uuid` and `new_or_existing_uuid_for_data` can be inlined in this method
-            # and the transaction optimized for this situation.
-            ret[data_requested] = self.data_to_uuid(data_requested)
+            cached_uuid = self._cache.get_uuid(data_requested)
+            if cached_uuid is not None:
+                ret[data_requested] = cached_uuid
+            else:
+                missing_data.append(data_requested)
+        cached_count = len(ret)
+
+        # Read all of the missing mappings with a single multi-get
+        # in case they were created by another process after the table was cached
+        found_count = 0
+        if len(missing_data) > 0:
+            doc_refs = [self._data_to_uuid_collection().document(data) for data in missing_data]
+            for snapshot in self.firebase_client.get_all(doc_refs):
+                if snapshot.exists:
+                    existing_uuid = snapshot.get(_UUID_KEY_NAME)
+                    self._cache_mapping(snapshot.id, existing_uuid)
+                    ret[snapshot.id] = existing_uuid
+                    found_count += 1
+
+        # Create any remaining mappings in transactions of up to BATCH_SIZE writes.
+        # Each transaction re-reads its documents so that existing mappings are never overwritten.
+        created_count = 0
+        missing_data = [data for data in missing_data if data not in ret]
+        batch_size = self._transaction_batch_size()
+        for batch_start in range(0, len(missing_data), batch_size):
+            batch_data = missing_data[batch_start:batch_start + batch_size]
+            uuids, batch_created_count = self.new_or_existing_uuids_for_data(batch_data)
+            for data, data_uuid in uuids.items():
+                self._cache_mapping(data, data_uuid)
+                ret[data] = data_uuid
+            found_count += len(batch_data) - batch_created_count
+            created_count += batch_created_count
+
+        log.info(f"Sourced uuids for {len(ret)} data items: "
+                 f"{cached_count} cached, {found_count} found, {created_count} created")
         return ret
 
     def data_to_uuid(self, data):
@@ -81,17 +318,21 @@ class FirestoreUuidTable(object):
         self.cache_uuid_table()
 
         # If the cache has not been initialized, then just lookup and return the UUID
-        if self._data_to_uuid is None:
+        if self._cache is None:
             return self.new_or_existing_uuid_for_data(data)
 
         # Return the cached UUID if it exists
-        if data in self._data_to_uuid:
-            return self._data_to_uuid[data]
+        cached_uuid = self._cache.get_uuid(data)
+        if cached_uuid is not None:
+            return cached_uuid
+
+        # A lazily cached table probably contains the mapping, so read it before starting a transaction
+        if self._lazy_cache_size is not None:
+            return self.data_to_uuid_batch([data])[data]
 
         # Generate, store, cache, and return a new UUID
         new_uuid = self.new_or_existing_uuid_for_data(data)
-        self._data_to_uuid[data] = new_uuid
-        self._uuid_to_data[new_uuid] = data
+        self._cache_mapping(data, new_uuid)
         return new_uuid
 
     def uuid_to_data(self, uuid_to_lookup):
@@ -106,8 +347,13 @@ class FirestoreUuidTable(object):
         :return: the associated data or LookupError if the UUID could not be found
         """
         self.cache_uuid_table()
-        if uuid_to_lookup in self._uuid_to_data:
-            return self._uuid_to_data[uuid_to_lookup]
+        data = self._cache.get_data(uuid_to_lookup)
+        if data is not None:
+            return data
+        if self._lazy_cache_size is not None:
+            return self.uuid_to_data_batch([uuid_to_lookup])[uuid_to_lookup]
+        if self._reload_after_miss():
+            return self.uuid_to_data(uuid_to_lookup)
         raise LookupError(f"Failed to find data for uuid {uuid_to_lookup}")
 
     def uuid_to_data_batch(self, uuids_to_lookup):
@@ -123,26 +369,141 @@ class FirestoreUuidTable(object):
         """
         self.cache_uuid_table()
         results = {}
+        missing_uuids = []
         for uuid_lookup in uuids_to_lookup:
-            if uuid_lookup in self._uuid_to_data:
-                results[uuid_lookup] = self._uuid_to_data[uuid_lookup]
+            data = self._cache.get_data(uuid_lookup)
+            if data is not None:
+                results[uuid_lookup] = data
             else:
+                missing_uuids.append(uuid_lookup)
+
+        if len(missing_uuids) > 0 and self._lazy_cache_size is not None:
+            results.update(self._read_data_for_uuids(set(missing_uuids)))
+        if len(missing_uuids) > 0 and self._reload_after_miss():
+            return self.uuid_to_data_batch(uuids_to_lookup)
+
+        for uuid_lookup in missing_uuids:
+            if uuid_lookup not in results:
                 raise LookupError(f"Failed to find data for uuid {uuid_lookup}")
         return results
 
+    def _read_data_for_uuids(self, uuids):
+        """Read and cache the data associated with the specified UUIDs from firestore
+        and return a mapping of UUID to data for those that were found"""
+        log.info(f"Reading data for {len(uuids)} uuids...")
+        results = {}
+        doc_refs = [self._uuid_to_data_collection().document(data_uuid) for data_uuid in uuids]
+        for snapshot in self.firebase_client.get_all(doc_refs):
+            if snapshot.exists:
+                data = snapshot.get(_DATA_KEY_NAME)
+                self._cache_mapping(data, snapshot.id)
+                results[snapshot.id] = data
+        index_count = len(results)
+
+        # Mappings created before the reverse index was maintained must be found by querying the mappings
+        missing_uuids = [data_uuid for data_uuid in uuids if data_uuid not in results]
+        for batch_start in range(0, len(missing_uuids), IN_QUERY_MAX_VALUES):
+            batch_uuids = missing_uuids[batch_start:batch_start + IN_QUERY_MAX_VALUES]
+            for doc in self._data_to_uuid_collection().where(_UUID_KEY_NAME, "in", batch_uuids).stream():
+                data_uuid = doc.get(_UUID_KEY_NAME)
+                self._cache_mapping(doc.id, data_uuid)
+                results[data_uuid] = doc.id
+
+        log.info(f"Read data for {len(results)} uuids: "
+                 f"{index_count} from reverse index, {len(results) - index_count} from mappings")
+        return results
+
     def new_or_existing_uuid_for_data(self, data):
         """Return the uuid for the specified data, creating and storing the new uuid in firebase if necessary"""
         transaction = self.firebase_client.transaction()
         doc_ref = self._data_to_uuid_collection().document(data)
-        return _new_or_existing_uuid_for_data_transaction(transaction, doc_ref, self._uuid_prefix)
+        return _new_or_existing_uuid_for_data_transaction(
+            transaction, doc_ref, self._uuid_prefix, self._reverse_index_collection())
+
+    def new_or_existing_uuids_for_data(self, list_of_data):
+        """Return the uuids for the specified data in a single transaction,
+        creating and storing new uuids in firebase if necessary.
+
+        :param list_of_data: a list of at most _transaction_batch_size() unique data items
+        :return: a tuple containing a mapping of data item to UUID and the number of UUIDs that were created
+        """
+        assert len(list_of_data) <= self._transaction_batch_size()
+        transaction = self.firebase_client.transaction()
+        doc_refs = [self._data_to_uuid_collection().document(data) for data in list_of_data]
+        return _new_or_existing_uuids_for_data_transaction(
+            transaction, doc_refs, self._uuid_prefix, self._reverse_index_collection())
+
+    def _transaction_batch_size(self):
+        """Return the maximum number of mappings to create in a single transaction.
+        Each mapping is two writes when the reverse index is maintained."""
+        return BATCH_SIZE // 2 if self._maintain_reverse_index else BATCH_SIZE
 
     @staticmethod
     def generate_new_uuid(prefix):
         return prefix + str(uuid.uuid4())
 
 
+def partition_boundaries(first_id, last_id, num_partitions, digits=6):
+    """Return the document ids at which to split the document ids from first_id to last_id into approximately
+    equal partitions, assuming that the digits which follow the prefix shared by first_id and last_id
+    are evenly distributed, e.g. the phone number URNs of a single country all start with "tel:+<country code>".
+    Return [] if the ids do not continue with digits after the shared prefix."""
+    if num_partitions <= 1:
+        return []
+    prefix = os.path.commonprefix([first_id, last_id])
+    low = _leading_digits(first_id[len(prefix):], digits, "0")
+    high = _leading_digits(last_id[len(prefix):], digits, "9")
+    if low is None or high is None:
+        return []
+    # Compare the leading digits as numbers, which preserves the order of the ids
+    # because both are padded to the same # of digits
+    span = high - low + 1
+    boundaries = [low + span * index // num_partitions for index in range(1, num_partitions)]
+    return sorted({f"{prefix}{boundary:0{digits}}" for boundary in boundaries if boundary > low})
+
+
+def _leading_digits(text, digits, padding):
+    """Return the number formed by the leading digits of text, padded on the right to the specified # of digits,
+    or None if text does not start with a digit. An empty text is all padding."""
+    leading = ""
+    for char in text[:digits]:
+        if char not in "0123456789":
+            break
+        leading += char
+    if leading == "" and text != "":
+        return None
+    return int(leading.ljust(digits, padding))
+
+
+class _LoadProgress(object):
+    """Thread safe count of the mappings loaded by parallel partitions, logging progress and rate"""
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._count = 0
+        self._start_time = time.monotonic()
+        self._next_log_count = LOAD_PROGRESS_INTERVAL
+
+    def add(self, count):
+        with self._lock:
+            self._count += count
+            if self._count < self._next_log_count:
+                return
+            self._next_log_count = self._count + LOAD_PROGRESS_INTERVAL
+            count, rate = self._count, self._rate()
+        log.info(f"Loaded {count} uuid mappings so far, {rate:.0f} mappings/sec")
+
+    def log_complete(self):
+        with self._lock:
+            count, elapsed, rate = self._count, time.monotonic() - self._start_time, self._rate()
+        log.info(f"Loaded {count} uuid mappings in {elapsed:.1f} sec, {rate:.0f} mappings/sec")
+
+    def _rate(self):
+        elapsed = time.monotonic() - self._start_time
+        return self._count / elapsed if elapsed > 0 else 0
+
+
 @firestore.transactional
-def _new_or_existing_uuid_for_data_transaction(transaction, doc_ref, prefix):
+def _new_or_existing_uuid_for_data_transaction(transaction, doc_ref, prefix, reverse_index_collection=None):
     """
     If the specified document exists, then return the existing UUID stored in that document,
     otherwise generate a new UUID, store the UUID in the document, and return the UUID.
@@ -153,6 +514,8 @@ def _new_or_existing_uuid_for_data_transaction(transaction, doc_ref, prefix):
     :param transaction: the transaction
     :param doc_ref: the document with document id == data (may not exist yet)
     :param prefix: the prefix of the UUID if it needs to be generated
+    :param reverse_index_collection: the collection in which to store a uuid --> data document
+                                     if a UUID is generated, or None
     :return: the existing or newly generated UUID associated with the specified document
     """
 
@@ -167,7 +530,51 @@ def _new_or_existing_uuid_for_data_transaction(transaction, doc_ref, prefix):
     # Create and store a new uuid for the data
     new_uuid = FirestoreUuidTable.generate_new_uuid(prefix)
     transaction.set(doc_ref, {
-        _UUID_KEY_NAME: new_uuid
+        _UUID_KEY_NAME: new_uuid,
+        _TIMESTAMP_KEY_NAME: firestore.SERVER_TIMESTAMP,
     })
+    if reverse_index_collection is not None:
+        transaction.set(reverse_index_collection.document(new_uuid), {_DATA_KEY_NAME: doc_ref.id})
     log.audit(f"transaction: created and stored new uuid: {new_uuid} data: {doc_ref.id}")
     return new_uuid
+
+
+@firestore.transactional
+def _new_or_existing_uuids_for_data_transaction(transaction, doc_refs, prefix, reverse_index_collection=None):
+    """
+    Batch version of _new_or_existing_uuid_for_data_transaction.
+    Return the existing UUIDs stored in the specified documents that exist,
+    and generate and store new UUIDs in the documents that do not.
+
+    :param transaction: the transaction
+    :param doc_refs: the documents with document id == data (may not exist yet)
+    :param prefix: the prefix of any UUIDs that need to be generated
+    :param reverse_index_collection: the collection in which to store uuid --> data documents
+                                     for any UUIDs that are generated, or None
+    :return: a tuple containing a mapping of document id to UUID and the number of UUIDs that were generated
+    """
+
+    # Check for existing data --> uuid mappings
+    log.debug(f"transaction: look up uuids for {len(doc_refs)} documents")
+    uuids = dict()
+    for snapshot in transaction.get_all(doc_refs):
+        if snapshot.exists:
+            uuids[snapshot.id] = snapshot.get(_UUID_KEY_NAME)
+    log.debug(f"transaction: found {len(uuids)} existing uuids")
+
+    # Create and store new uuids for the remaining data
+    created_count = 0
+    for doc_ref in doc_refs:
+        if doc_ref.id in uuids:
+            continue
+        new_uuid = FirestoreUuidTable.generate_new_uuid(prefix)
+        transaction.set(doc_ref, {
+            _UUID_KEY_NAME: new_uuid,
+            _TIMESTAMP_KEY_NAME: firestore.SERVER_TIMESTAMP,
+        })
+        if reverse_index_collection is not None:
+            transaction.set(reverse_index_collection.document(new_uuid), {_DATA_KEY_NAME: doc_ref.id})
+        log.audit(f"transaction: created and stored new uuid: {new_uuid} data: {doc_ref.id}")
+        uuids[doc_ref.id] = new_uuid
+        created_count += 1
+    return uuids, created_count
@@ -0,0 +1,213 @@
+import json
+import math
+import threading
+from contextlib import contextmanager
+from email.utils import parsedate_to_datetime
+from urllib.parse import urlparse
+
+import requests
+import temba_client.base
+import temba_client.utils
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+from lib.simple_logger import Logger
+from lib.utils import utcnow
+
+log = None
+
+# The session pool used by requests made by the temba client on the current thread, see use()
+_thread_local = threading.local()
+# The session pool used when no session pool has been specified for the current thread
+_default_pool = None
+# The lib.rate_limiter.RateLimiter shared by every request made via a session pool, or None
+_rate_limiter = None
+
+
+class EndpointConfig(object):
+    """
+    The timeout and retry policy for requests to a RapidPro API endpoint.
+
+    :param timeout: the # of seconds to wait for the server to respond,
+                    or a tuple (connect timeout, read timeout)
+    :param max_retries: a urllib3.util.retry.Retry instance or the max # of retries.
+                        By default, urllib3 only retries requests that have not reached the server
+                        and idempotent requests (e.g. GET but not POST) so messages are never sent twice.
+                        Read timeouts are not retried by default because each one has already waited
+                        for the full read timeout.
+    """
+    def __init__(self, timeout=(10, 600), max_retries=None):
+        self.timeout = timeout
+        self.max_retries = max_retries if max_retries is not None else \
+            Retry(total=2, read=0, backoff_factor=0.5, status=0)
+
+
+class SessionPool(object):
+    """
+    Keep-alive HTTP sessions for requests made by the temba client,
+    with one session (and connection pool) for each RapidPro API endpoint that has been requested.
+    """
+    def __init__(self, name, pool_size=10, default_config=None, endpoint_configs=None):
+        """
+        :param name: the name of the pool used in log messages
+        :param pool_size: the max # of connections kept alive for each endpoint
+        :param default_config: the EndpointConfig for endpoints not in endpoint_configs
+        :param endpoint_configs: a mapping of endpoint name (e.g. "messages" or "broadcasts") to EndpointConfig
+        """
+        global log
+        if log is None:
+            log = Logger(__name__)
+
+        self.name = name
+        self.pool_size = pool_size
+        self.default_config = default_config if default_config is not None else EndpointConfig()
+        self.endpoint_configs = endpoint_configs if endpoint_configs is not None else dict()
+        # a mapping of endpoint name to (session, adapter)
+        self._sessions = dict()
+        self._request_counts = dict()
+        self._lock = threading.Lock()
+
+    def request(self, method, url, **kwargs):
+        """Make a request using the session for the endpoint, reusing a pooled connection if one is available"""
+        endpoint = endpoint_name(url)
+        config = self.endpoint_configs.get(endpoint, self.default_config)
+        with self._lock:
+            if endpoint not in self._sessions:
+                session = requests.Session()
+                adapter = HTTPAdapter(pool_connections=1, pool_maxsize=self.pool_size, max_retries=config.max_retries)
+                session.mount("http://", adapter)
+                session.mount("https://", adapter)
+                self._sessions[endpoint] = session, adapter
+                self._request_counts[endpoint] = 0
+            session, _ = self._sessions[endpoint]
+            self._request_counts[endpoint] += 1
+
+        if "timeout" not in kwargs:
+            kwargs["timeout"] = config.timeout
+        if _rate_limiter is not None:
+            _rate_limiter.acquire()
+        response = session.request(method, url, **kwargs)
+        if response.status_code == 429:
+            # Slow down every request, not just those made using this pool
+            retry_after_header = response.headers.get("retry-after")
+            log.warning(f"{self.name} {endpoint}: rate exceeded, retry after {retry_after_header}")
+            retry_after = retry_after_seconds(retry_after_header)
+            if retry_after_header:
+                # The temba client expects a number of seconds rather than an HTTP date
+                response.headers["retry-after"] = str(retry_after) if retry_after is not None else ""
+            throttle(retry_after)
+        return response
+
+    def stats(self):
+        """Return a mapping of endpoint name to a dictionary containing the # of requests made
+        and the # of connections opened. Requests that did not open a new connection reused a pooled connection."""
+        stats = dict()
+        with self._lock:
+            for endpoint, (_, adapter) in self._sessions.items():
+                connection_count = 0
+                for key in adapter.poolmanager.pools.keys():
+                    connection_count += adapter.poolmanager.pools[key].num_connections
+                request_count = self._request_counts[endpoint]
+                stats[endpoint] = {
+                    "requests": request_count,
+                    "connections": connection_count,
+                    "reused": max(request_count - connection_count, 0),
+                }
+        return stats
+
+    def log_stats(self):
+        for endpoint, endpoint_stats in self.stats().items():
+            log.info(f"{self.name} {endpoint}: {endpoint_stats['requests']} requests, "
+                     f"{endpoint_stats['connections']} connections, {endpoint_stats['reused']} reused")
+
+    def close(self):
+        with self._lock:
+            for session, _ in self._sessions.values():
+                session.close()
+            self._sessions.clear()
+
+
+def endpoint_name(url):
+    """Return the name of the RapidPro API endpoint (e.g. "messages") for the specified URL"""
+    path = urlparse(url).path.rstrip("/")
+    name = path.split("/")[-1]
+    return name[:-len(".json")] if name.endswith(".json") else name
+
+
+def retry_after_seconds(retry_after):
+    """Return the # of seconds to wait specified by a Retry-After header value,
+    which is either a # of seconds or an HTTP date, or None if the value is missing or cannot be parsed"""
+    if not retry_after:
+        return None
+    try:
+        return max(int(retry_after), 0)
+    except ValueError:
+        pass
+    try:
+        retry_time = parsedate_to_datetime(retry_after)
+    except (TypeError, ValueError):
+        return None
+    return max(math.ceil((retry_time - utcnow()).total_seconds()), 0)
+
+
+def install(default_pool=None, rate_limiter=None):
+    """Route every request made by the temba client through a SessionPool.
+    Requests use the pool specified by use() on the current thread, otherwise the default pool.
+
+    :param default_pool: the pool used for requests not made within use(),
+                         or None to keep the current default pool or create a new SessionPool if there is none
+    :param rate_limiter: a lib.rate_limiter.RateLimiter shared by every request,
+                         or None to keep the current rate limiter if any
+    """
+    global _default_pool, _rate_limiter
+
+    # Check that the temba client still makes every request via the function in temba_client.utils
+    # so that this module is updated if the temba client changes.
+    if temba_client.base.request is not temba_client.utils.request and temba_client.base.request is not request:
+        raise AssertionError("temba_client.base no longer uses temba_client.utils.request")
+
+    if default_pool is not None:
+        _default_pool = default_pool
+    elif _default_pool is None:
+        _default_pool = SessionPool("default")
+    if rate_limiter is not None:
+        _rate_limiter = rate_limiter
+    temba_client.base.request = request
+
+
+def throttle(retry_after):
+    """Pause every request for retry_after seconds because the server has indicated that its rate was exceeded.
+    Return False if there is no shared rate limiter, in which case the caller is responsible for waiting."""
+    if _rate_limiter is None:
+        return False
+    _rate_limiter.throttle(retry_after)
+    return True
+
+
+def rate_limiter_stats():
+    """Return the stats for the shared rate limiter or None if there is none"""
+    return _rate_limiter.stats() if _rate_limiter is not None else None
+
+
+@contextmanager
+def use(pool):
+    """Make requests by the temba client on the current thread within this context using the specified pool.
+    If pool is None, then the default pool is used."""
+    previous_pool = getattr(_thread_local, "pool", None)
+    _thread_local.pool = pool
+    try:
+        yield pool
+    finally:
+        _thread_local.pool = previous_pool
+
+
+def request(method, url, **kwargs):
+    """Replacement for temba_client.utils.request which encodes JSON bodies in the same way
+    but makes the request using a keep-alive SessionPool"""
+    if "data" in kwargs:
+        kwargs["data"] = json.dumps(kwargs["data"])
+
+    pool = getattr(_thread_local, "pool", None)
+    if pool is None:
+        pool = _default_pool
+    return pool.request(method, url, **kwargs)
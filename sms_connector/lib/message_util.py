@@ -1,6 +1,38 @@
 import uuid
 
+# Outgoing messages are sent in one of two lanes so that replies to individual conversations
+# are not delayed by large broadcasts
+INTERACTIVE_LANE = "interactive"
+BULK_LANE = "bulk"
+
+# Outgoing messages to at most this many recipients are sent in the interactive lane
+INTERACTIVE_MAX_RECIPIENTS = 10
+
 
 # Return a new message identifier
 def generate_new_message_uuid():
     return f"nook-message-{uuid.uuid4()}"
+
+
+# Return the lane in which to send the outgoing messages in the specified payload:
+# the lane specified by its "lane" field if any, otherwise the interactive lane
+# if it has at most max_interactive_recipients ids, otherwise the bulk lane
+def outgoing_lane(data_map, max_interactive_recipients=INTERACTIVE_MAX_RECIPIENTS):
+    lane = data_map.get("lane")
+    if lane is not None:
+        if lane not in (INTERACTIVE_LANE, BULK_LANE):
+            raise Exception(f"Unknown lane: {lane}")
+        return lane
+    return INTERACTIVE_LANE if len(data_map["ids"]) <= max_interactive_recipients else BULK_LANE
+
+
+# Return the key of the conversation to which the specified pub/sub payload applies,
+# or None if it does not apply to a single conversation, e.g. "nook/set_tag" opinions.
+# Outgoing sends are not keyed so that they are all published in the order in which they were received.
+def conversation_key(data_map):
+    action = data_map.get("action")
+    if action == "add_opinion":
+        return data_map.get("opinion", {}).get("deidentified_phone_number")
+    if action == "sms_from_rapidpro":
+        return data_map.get("sms_raw", {}).get("deidentified_phone_number")
+    return None
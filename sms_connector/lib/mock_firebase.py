@@ -1,7 +1,10 @@
+import datetime
 import json
 import re
 import time
 
+from firebase_admin import firestore
+
 # regex: leading `^` means "not" any of these valid characters
 # regex: the character sequence `\\-` translates to `-` which cannot be directly represented
 _invalid_firebase_path_regex = re.compile('[^A-Za-z0-9/+:_\\-\ #]')
@@ -76,6 +79,9 @@ class MockFirestoreClient:
     def document(self, path):
         return MockFirestoreRef(self, path)
 
+    def get_all(self, references, transaction=None):
+        return [doc_ref.get(transaction=transaction) for doc_ref in references]
+
     def set_doc(self, collection_path, doc_id, new_doc_data):
         reference_path = "/".join([collection_path, doc_id])
         self._changes.append((reference_path, new_doc_data))
@@ -86,6 +92,9 @@ class MockFirestoreClient:
         _check_collection_path(collection_path)
         _check_document_id(doc_id)
         doc_data = new_doc_data.copy()
+        for key, value in doc_data.items():
+            if value is firestore.SERVER_TIMESTAMP:
+                doc_data[key] = datetime.datetime.now(datetime.timezone.utc)
         doc_data["__id"] = doc_id
         doc_data["__reference_path"] = reference_path
         doc_data["__subcollections"] = []
@@ -122,12 +131,12 @@ class MockFirestoreCollection:
 
     def get(self):
         docs = []
-        for doc_data in _raw_doc_list(self.client.data, self.collection_root):
+        for doc_data in _raw_doc_list(self.client.data, self.collection_root, absent_as_empty=True):
             docs.append(MockFirestoreDoc.from_data(self.client, doc_data))
         return docs
 
     def get_doc(self, doc_id):
-        for doc_data in _raw_doc_list(self.client.data, self.collection_root):
+        for doc_data in _raw_doc_list(self.client.data, self.collection_root, absent_as_empty=True):
             if doc_data["__id"] == doc_id:
                 return MockFirestoreDoc.from_data(self.client, doc_data)
         return MockFirestoreDoc.does_not_exist(self.client, self.collection_root, doc_id)
@@ -141,13 +150,16 @@ class MockFirestoreCollection:
     def where(self, key, comparison, value):
         return MockFirestoreQuery(self, key, comparison, value)
 
+    def order_by(self, key, direction=firestore.Query.ASCENDING):
+        return MockOrderedQuery(self, key, direction)
+
 
 class MockSnapshotSubscription(object):
-    def __init__(self, collection, callback):
+    def __init__(self, collection, callback, query=None):
         self.collection = collection
         self.callback = callback
         changes = []
-        for doc in self.collection.get():
+        for doc in (query if query is not None else self.collection).get():
             changes.append(MockChange(doc))
         self.callback(None, changes, None)
 
@@ -270,22 +282,82 @@ class MockFirestoreRef:
 
 
 class MockFirestoreQuery:
-    def __init__(self, collection, key, comparison, value):
+    def __init__(self, collection, key, comparison, value, parent_query=None):
         self.collection = collection
         self.key = key
         self.comparison = comparison
         self.value = value
+        self.parent_query = parent_query
 
     def get(self):
         docs = []
-        for doc in self.collection.get():
+        candidates = self.collection.get() if self.parent_query is None else self.parent_query.get()
+        for doc in candidates:
+            if self.key == "__name__":
+                # Comparing the document id to a document reference
+                doc_value = doc.id
+                value = self.value.id
+            elif self.key not in doc.data:
+                # Firestore excludes documents that do not contain the field being compared
+                continue
+            else:
+                doc_value = doc.data[self.key]
+                value = self.value
+                if self.comparison == u"in":
+                    if doc_value in value:
+                        docs.append(doc)
+                    continue
+                if isinstance(doc_value, str) != isinstance(value, str):
+                    # Firestore only compares values of the same type
+                    continue
             if self.comparison == u"==":
-                if doc.data[self.key] == self.value:
-                    docs.append(doc)
+                matches = doc_value == value
+            elif self.comparison == u"<":
+                matches = doc_value < value
+            elif self.comparison == u"<=":
+                matches = doc_value <= value
+            elif self.comparison == u">":
+                matches = doc_value > value
+            elif self.comparison == u">=":
+                matches = doc_value >= value
             else:
                 raise Exception(f"comparison not supported: {self.comparison}")
+            if matches:
+                docs.append(doc)
         return docs
 
+    def stream(self):
+        return self.get()
+
+    def on_snapshot(self, callback):
+        return MockSnapshotSubscription(self.collection, callback, query=self)
+
+    def where(self, key, comparison, value):
+        return MockFirestoreQuery(self.collection, key, comparison, value, parent_query=self)
+
+
+class MockOrderedQuery:
+    def __init__(self, source, key, direction, count=None):
+        self.source = source
+        self.key = key
+        self.direction = direction
+        self.count = count
+
+    def get(self):
+        if self.key == "__name__":
+            docs = sorted(self.source.get(), key=lambda doc: doc.id)
+        else:
+            docs = sorted([doc for doc in self.source.get() if self.key in doc.data], key=lambda doc: doc.data[self.key])
+        if self.direction == firestore.Query.DESCENDING:
+            docs.reverse()
+        return docs if self.count is None else docs[:self.count]
+
+    def stream(self):
+        return self.get()
+
+    def limit(self, count):
+        return MockOrderedQuery(self.source, self.key, self.direction, count)
+
 
 class MockTransaction(object):
     def __init__(self, client):
@@ -301,6 +373,8 @@ class MockTransaction(object):
         pass
 
     def _commit(self):
+        if len(self._changes) > 500:
+            raise Exception(f"Max 500 changes per transaction, but found {len(self._changes)}")
         for change_funct in self._changes:
             change_funct()
         self._changes = None
@@ -314,6 +388,9 @@ class MockTransaction(object):
         if self._changes is None:
             raise AssertionError("operation outside @firestore.transactional scope")
 
+    def get_all(self, references):
+        return self.client.get_all(references, transaction=self)
+
     def set(self, doc_ref, new_data):
         self.assert_in_transaction_scope()
 
@@ -348,7 +425,7 @@ def _check_firestore_path(path: str):
         raise Exception(f"Invalid character in firebase path: {path}")
 
 
-def _raw_doc_list(client_data, collection_path, add_if_absent=False):
+def _raw_doc_list(client_data, collection_path, add_if_absent=False, absent_as_empty=False):
     # HACK there is one nested collection that is stored in the top level
     if collection_path == "tables/uuid-table/mappings":
         return client_data[collection_path]
@@ -359,6 +436,9 @@ def _raw_doc_list(client_data, collection_path, add_if_absent=False):
         if depth % 2 == 0:
             # looking for collection (list of documents) in top level dictionary or nested document data
             if key not in data:
+                if absent_as_empty:
+                    # Firestore treats collections that have never been written as empty
+                    return []
                 if not add_if_absent:
                     raise Exception(f"Missing id '{key}' in {collection_path}")
                 if depth > 0:
@@ -374,6 +454,8 @@ def _raw_doc_list(client_data, collection_path, add_if_absent=False):
                     found = True
                     break
             if not found:
+                if absent_as_empty:
+                    return []
                 if not add_if_absent:
                     raise Exception(f"Missing id '{key}' in {collection_path}")
                 doc_data = {
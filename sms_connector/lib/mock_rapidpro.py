@@ -1,7 +1,8 @@
+import threading
 from datetime import datetime
 
 from requests.exceptions import HTTPError
-from temba_client.exceptions import TembaConnectionError
+from temba_client.exceptions import TembaBadRequestError, TembaConnectionError, TembaRateExceededError
 
 from lib import test_util
 
@@ -14,13 +15,27 @@ class MockRapidProClient(object):
         self.outgoing = []
         self.incoming = []
         self.retry_count = 0
+        # sends to any of these urns always fail
+        self.failing_urns = set()
+        # sends to any of these urns are always rejected as bad requests
+        self.bad_urns = set()
+        # the # of sends that fail because the rate limit was exceeded
+        self.rate_exceeded_count = 0
+        # messages may be sent on multiple threads
+        self._lock = threading.Lock()
 
-    def get_raw_messages(self, created_after_inclusive=None):
+    def get_raw_messages(self, created_after_inclusive=None, created_before_exclusive=None):
         if self.retry_count > 0:
             self.retry_count -= 1
             raise TembaConnectionError('pretend exception for testing')
-        result = self.incoming
-        self.incoming = []
+        if created_before_exclusive is None:
+            result = self.incoming
+            self.incoming = []
+            return result
+        result = [message for message in self.incoming
+                  if (created_after_inclusive is None or message.created_on >= created_after_inclusive)
+                  and message.created_on < created_before_exclusive]
+        self.incoming = [message for message in self.incoming if message not in result]
         return result
 
     def send_message_to_urn(self, message, urn, interrupt=False):
@@ -31,17 +46,26 @@ class MockRapidProClient(object):
         self.outgoing.append((urn, message))
 
     def send_message_to_urns(self, message, urns, interrupt=False):
-        if self.retry_count > 0:
-            self.retry_count -= 1
-            raise HTTPError('pretend exception for testing')
-        log.info(f"Mock: Skipping send smses: {urns}, interrupt={interrupt} --> {message}")
-        self.outgoing.append((urns, message))
+        with self._lock:
+            if self.retry_count > 0:
+                self.retry_count -= 1
+                raise HTTPError('pretend exception for testing')
+            if self.rate_exceeded_count > 0:
+                self.rate_exceeded_count -= 1
+                raise TembaRateExceededError(0)
+            if not self.bad_urns.isdisjoint(urns):
+                raise TembaBadRequestError({"urns": ["pretend invalid urn for testing"]})
+            if not self.failing_urns.isdisjoint(urns):
+                raise HTTPError('pretend exception for testing')
+            log.info(f"Mock: Skipping send smses: {urns}, interrupt={interrupt} --> {message}")
+            self.outgoing.append((urns, message))
 
 
 class MockRapidProMessage(object):
-    def __init__(self, created_on, urn, direction, text):
+    def __init__(self, created_on, urn, direction, text, uuid=None):
         self.created_on = datetime.fromisoformat(created_on)
         self.urn = urn
         self.direction = direction
         self.text = text
+        self.uuid = uuid
         pass
@@ -1,62 +1,66 @@
 import threading
 
-# buffer of opinions to process
-opinion_buffer = []
-opinion_buffer_lock = threading.Lock()
-
 firebase_client = None
 
 # As this is the only process that's allowed to modify firebase we can
 # decrease read costs by an in memory cache
 conversations_map = {}
-_dirty_list_ids = set()
+# Guards conversations_map, which is shared by the threads processing opinions about different conversations.
+# The contents of each conversation are only modified by the thread processing opinions about that conversation.
+_conversations_lock = threading.Lock()
+
+# Opinions about different conversations may be processed in parallel on separate threads,
+# but the opinions about each conversation are always processed on the same thread.
+# So each thread tracks the conversations that it has modified and writes only those.
+_dirty_list_ids = threading.local()
 
 # Very simple scheme to avoid multiple writes to the same firestore element
 def add_opinion(namespace, opinion):
-    with opinion_buffer_lock:
-        opinion_buffer.append((namespace, opinion))
-        print (f"{namespace} : {opinion} buffered")
-    process_buffer()
-
-def process_buffer():
-    global opinion_buffer
-    with opinion_buffer_lock:
-        print (f"Processing: {len(opinion_buffer)}")
-        for (namespace, opinion) in opinion_buffer:
-            print (f" processing {namespace} : {opinion}")
-            assert namespace in NAMESPACE_REACTORS
-
-            reactor = NAMESPACE_REACTORS[namespace]
-            reactor(opinion)
-        print (f"Processing complete")
-        opinion_buffer = []
-        _clean()
+    print (f" processing {namespace} : {opinion}")
+    assert namespace in NAMESPACE_REACTORS
+
+    reactor = NAMESPACE_REACTORS[namespace]
+    reactor(opinion)
+    _clean()
 
 def _ensure_conversation_loaded(id):
     # If the conversation exists in firebase load it, otherwise create empty
+    # and return the cached conversation
     print (f"_ensure_conversation_loaded {id}")
-    if id in conversations_map.keys():
-        return
+    with _conversations_lock:
+        conversation = conversations_map.get(id)
+    if conversation is not None:
+        return conversation
 
+    # Read outside the lock so that loading one conversation does not block the other threads
     doc = firebase_client.document(
         f'nook_conversation_shards/shard-0/conversations/{id}').get()
 
     if doc.exists:
-        conversations_map[id] = doc.to_dict()
-        return
-
-    conversations_map[id] = _create_empty_conversation_map(id)
+        conversation = doc.to_dict()
+    else:
+        conversation = _create_empty_conversation_map(id)
+    with _conversations_lock:
+        return conversations_map.setdefault(id, conversation)
 
 def _push_conversation(id):
     print ("_push_conversation {conv_id}")
+    with _conversations_lock:
+        conversation = conversations_map[id]
     firebase_client.document(
-        f'nook_conversation_shards/shard-0/conversations/{id}').set(conversations_map[id])
+        f'nook_conversation_shards/shard-0/conversations/{id}').set(conversation)
+
+def _mark_dirty(id):
+    if not hasattr(_dirty_list_ids, "ids"):
+        _dirty_list_ids.ids = set()
+    _dirty_list_ids.ids.add(id)
 
 def _clean():
-    global _dirty_list_ids
-    for conv_id in _dirty_list_ids:
+    if not hasattr(_dirty_list_ids, "ids"):
+        return
+    for conv_id in _dirty_list_ids.ids:
         _push_conversation(conv_id)
-    _dirty_list_ids = set()
+    _dirty_list_ids.ids = set()
 
 
 def _compute_message_id(opinion):
@@ -70,12 +74,12 @@ def _compute_message_id(opinion):
 # }
 def handle_sms_raw_msg(opinion):
     id = opinion["deidentified_phone_number"]
-    _ensure_conversation_loaded(id)
+    conversation = _ensure_conversation_loaded(id)
     created_on = opinion["created_on"]
     text = opinion["text"]
     direction = opinion['direction']
 
-    conversations_map[id]["messages"].append(
+    conversation["messages"].append(
         {
             "datetime" : created_on,
             "direction" : direction,
@@ -85,28 +89,28 @@ def handle_sms_raw_msg(opinion):
             "tags" : []
         }
     )
-    _dirty_list_ids.add(id)
+    _mark_dirty(id)
 
 
 def handle_add_conversation_tags(opinion):
     id = opinion["deidentified_phone_number"]
-    _ensure_conversation_loaded(id)
+    conversation = _ensure_conversation_loaded(id)
     for tag in opinion["tags"]:
-        conversations_map[id]["tags"].add(tag)
-    _dirty_list_ids.add(id)
+        conversation["tags"].add(tag)
+    _mark_dirty(id)
 
 def handle_remove_conversation_tags(opinion):
     id = opinion["deidentified_phone_number"]
-    _ensure_conversation_loaded(id)
+    conversation = _ensure_conversation_loaded(id)
     for tag in opinion["tags"]:
-        conversations_map[id]["tags"].remove(tag)
-    _dirty_list_ids.add(id)
+        conversation["tags"].remove(tag)
+    _mark_dirty(id)
 
 def handle_set_notes(opinion):
     id = opinion["deidentified_phone_number"]
-    _ensure_conversation_loaded(id)
-    conversations_map[id]["notes"] = opinion["notes"]
-    _dirty_list_ids.add(id)
+    conversation = _ensure_conversation_loaded(id)
+    conversation["notes"] = opinion["notes"]
+    _mark_dirty(id)
 
 def handle_set_unread(opinion):
     print (f"WARNING: handle_set_unread not implemented")
@@ -114,7 +118,7 @@ def handle_set_unread(opinion):
     # id = opinion["deidentified_phone_number"]
     # _ensure_conversation_loaded(id)
     # conversations_map[id]["unread"] = True
-    # _dirty_list_ids.add(id)
+    # _mark_dirty(id)
 
 def handle_add_message_tags(opinion):
     # id = opinion["deidentified_phone_number"]
@@ -0,0 +1,27 @@
+class AdaptivePollScheduler(object):
+    """
+    Determines how long to wait before polling again based upon the number of messages returned by the last poll.
+    Poll again immediately after a large batch of messages, poll again after min_interval seconds after
+    a small batch of messages, and back off exponentially up to max_interval seconds while polls are empty.
+    """
+    def __init__(self, min_interval=1, max_interval=30, large_batch_size=250, backoff_factor=2):
+        assert 0 < min_interval <= max_interval
+        assert backoff_factor >= 1
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.large_batch_size = large_batch_size
+        self.backoff_factor = backoff_factor
+        self._empty_interval = min_interval
+
+    def next_interval(self, message_count):
+        """Return the # of seconds to wait before the next poll given the # of messages returned by the last poll"""
+        if message_count > 0:
+            self._empty_interval = self.min_interval
+            if message_count >= self.large_batch_size:
+                # There are probably more messages waiting
+                return 0
+            return self.min_interval
+
+        interval = self._empty_interval
+        self._empty_interval = min(self._empty_interval * self.backoff_factor, self.max_interval)
+        return interval
@@ -1,11 +1,16 @@
+import datetime
 import json
+import queue
+from collections import deque
 import sys
 import threading
 import time
 import traceback
+import zlib
 
 from google.cloud import pubsub_v1
 
+from lib.circuit_breaker import CLOSED, CircuitBreaker
 from lib.simple_logger import Logger
 
 
@@ -13,6 +18,16 @@ from lib.simple_logger import Logger
 # Clients should initialize this global for proper logging
 log = Logger("pubsub_util")
 
+# The default max # of messages waiting to be processed by a MessageSequencer,
+# which matches the default max # of outstanding messages of a pub/sub subscription
+DEFAULT_MAX_QUEUE_SIZE = 1000
+
+# The default max # of seconds to wait for a MessageSequencer to finish processing the current message when stopping
+DEFAULT_STOP_TIMEOUT_SEC = 60
+
+# The # of seconds to wait before trying again to queue a message when a MessageSequencer's queue is full
+QUEUE_FULL_RETRY_SEC = 0.01
+
 
 class Subscriber:
     """Subscribe to the specific pub/sub channel.
@@ -21,6 +36,9 @@ class Subscriber:
     where the message passed is an instance of google.cloud.pubsub_v1.subscriber.message.Message.
     It is the responsibility of `process_message_funct` to ack() or nack() each message.
     If an exception occurs in process_message_funct, the exception is logged and and nack() is called.
+
+    If max_outstanding_messages is specified, then pub/sub delivers at most this many messages
+    which have not yet been acked or nacked, e.g. the max_queue_size of a MessageSequencer.
     """
 
     # Using pull and using streaming pull were considered.
@@ -40,7 +58,8 @@ class Subscriber:
     #   and subscribe does a lot of machinery to properly open and maintain the stream.
     # "
 
-    def __init__(self, crypto_token_path, topic_name, subscription_name, process_message_funct):
+    def __init__(self, crypto_token_path, topic_name, subscription_name, process_message_funct,
+                 max_outstanding_messages=None):
         publisher = Publisher(crypto_token_path, topic_name)
         self.client = pubsub_v1.SubscriberClient.from_service_account_json(publisher.crypto_token_path)
 
@@ -53,6 +72,9 @@ class Subscriber:
             log.debug(f"Error on subscription creation for {self.subscription_path}: {sys.exc_info()[0]}")
 
         self.subscription = None
+        self.max_outstanding_messages = max_outstanding_messages
+        # the exception passed to cancel_with_exception, if any, which is raised by wait()
+        self.exception = None
         self.subscribe(process_message_funct)
 
     def subscribe(self, process_message_funct):
@@ -64,17 +86,27 @@ class Subscriber:
         if self.subscription is not None:
             raise AssertionError("active subscription")
         self.process_message_funct = process_message_funct
-        self.subscription = self.client.subscribe(self.subscription_path, self.process_message)
+        if self.max_outstanding_messages is None:
+            self.subscription = self.client.subscribe(self.subscription_path, self.process_message)
+        else:
+            flow_control = pubsub_v1.types.FlowControl(max_messages=self.max_outstanding_messages)
+            self.subscription = self.client.subscribe(
+                self.subscription_path, self.process_message, flow_control=flow_control)
         log.debug("Subscribed")
 
     def process_message(self, message):
         self.process_message_funct(message)
 
     def wait(self):
-        """Blocks until cancel() is called or an exception occurs"""
-        if self.subscription is None:
+        """Blocks until cancel() is called or an exception occurs.
+        If cancel_with_exception() was called, then the exception is raised."""
+        subscription = self.subscription
+        if subscription is None:
             raise AssertionError("no active subscription")
-        self.subscription.result()
+        result = subscription.result()
+        if self.exception is not None:
+            raise self.exception
+        return result
 
     def cancel(self):
         """Signal the subscription process to shutdown gracefully and exit"""
@@ -82,6 +114,68 @@ class Subscriber:
             self.subscription.cancel()
             self.subscription = None
 
+    def cancel_with_exception(self, exception):
+        """Cancel the subscription so that wait() raises the specified exception,
+        e.g. as the exception_callback of a MessageSequencer so that a processing failure ends the subscription"""
+        self.exception = exception
+        self.cancel()
+
+
+class DeadLetterPolicy:
+    """A policy for handling poison messages, i.e. messages which cannot be processed, used by a MessageSequencer.
+
+    A message is processed at most max_attempts times, waiting initial_retry_wait_sec seconds before the first retry
+    and 4 times longer before each subsequent retry. If the last attempt fails, then the message is published
+    to the dead letter publisher along with the exception, and acked so that later messages can be processed.
+
+    If more than max_dead_letters messages are dead lettered within window_sec seconds,
+    then the failures are assumed to be systemic rather than caused by bad messages, so the message is not
+    dead lettered and processing halts as it would without a policy.
+    A policy may be shared by several sequencers, e.g. the lanes of a KeyedMessageSequencer.
+    """
+    def __init__(self, publisher, max_attempts=3, initial_retry_wait_sec=1, max_dead_letters=10, window_sec=5 * 60,
+                 publish_timeout=60):
+        assert max_attempts > 0
+        self.publisher = publisher
+        self.max_attempts = max_attempts
+        self.initial_retry_wait_sec = initial_retry_wait_sec
+        self.publish_timeout = publish_timeout
+        # Opens when there are too many dead letters in the window
+        self.circuit_breaker = CircuitBreaker("dead-letters", max_failures=max_dead_letters + 1, window_sec=window_sec)
+        self.dead_letter_count = 0
+        self._lock = threading.Lock()
+
+    def retry_wait_sec(self, attempts):
+        """Return the # of seconds to wait before retrying a message which has failed the specified # of times,
+        or None if the message should not be retried"""
+        if attempts >= self.max_attempts:
+            return None
+        return self.initial_retry_wait_sec * 4 ** (attempts - 1)
+
+    def dead_letter(self, message, exception, attempts, sequencer_name):
+        """Publish the message and the exception to the dead letter publisher and wait for it to be published.
+        Return False without publishing the message if too many messages have been dead lettered recently."""
+        self.circuit_breaker.record_failure()
+        if self.circuit_breaker.state != CLOSED:
+            log.warning(f"{sequencer_name}: too many dead letters, not dead lettering message {message.message_id}")
+            return False
+
+        data = message.data.decode("utf-8") if isinstance(message.data, bytes) else message.data
+        future = self.publisher.publish({
+            "message_id": message.message_id,
+            "data": data,
+            "error": f"{type(exception).__name__}: {exception}",
+            "traceback": "".join(traceback.format_exception(type(exception), exception, exception.__traceback__)),
+            "attempts": attempts,
+            "sequencer": sequencer_name,
+            "dead_lettered_at": datetime.datetime.now(datetime.timezone.utc).isoformat(),
+        })
+        Publisher.wait_for_futures([future], timeout=self.publish_timeout)
+        with self._lock:
+            self.dead_letter_count += 1
+        log.warning(f"{sequencer_name}: dead lettered message {message.message_id} after {attempts} attempts")
+        return True
+
 
 class MessageSequencer:
     """A message processor for sequencing Google pub/sub messages that arrive sequentially but on separate threads.
@@ -89,78 +183,356 @@ class MessageSequencer:
     1) messages are processed sequentially in the order in which process_message is called
     2) only one message is processed at a time even though the messages arrive on multiple threads
     3) if an exception occurs when when processing a message then subsequent messages are nacked and not processed
+
+    If dead_letter_policy is specified, then a message which fails is retried and then dead lettered
+    according to the policy, and subsequent messages are only nacked if the policy determines that
+    the failures are systemic. While a message is waiting to be retried, the worker holds the messages
+    received after it in a backlog rather than sleeping, so that it can still be stopped promptly.
+
+    process_message appends each message to a synchronized queue and returns immediately,
+    and the messages are processed on a dedicated worker thread, so pub/sub callback threads are never parked.
+    The queue holds at most max_queue_size messages, and process_message blocks while it is full.
+    Pass max_queue_size to the Subscriber as max_outstanding_messages so that pub/sub
+    stops delivering messages rather than blocking its callback threads.
+
+    If exception_callback is specified, then it is called with the exception when processing a message fails
+    so that the owner of the sequencer can respond without polling last_exception.
     """
-    def __init__(self, process_message_funct):
+    def __init__(self, process_message_funct, exception_callback=None, max_queue_size=DEFAULT_MAX_QUEUE_SIZE,
+                 name="message-sequencer", dead_letter_policy=None):
         assert process_message_funct is not None
+        assert max_queue_size > 0
         self.process_message_funct = process_message_funct
-        self.message_processing_lock = threading.Lock()
-        self.message_processing_queue = []
+        self.exception_callback = exception_callback
+        self.dead_letter_policy = dead_letter_policy
+        self.max_queue_size = max_queue_size
+        self.name = name
+        # a queue of (message, time at which the message was queued)
+        self.message_processing_queue = queue.Queue(max_queue_size)
+        # the _PendingRetry of the message waiting to be retried, or None, and the (message, time queued)
+        # of the messages taken from the queue while it waits. These are only accessed by the worker thread.
+        self._pending_retry = None
+        self._backlog = deque()
         self.last_exception = None
+        self._stopped = False
+        # Held while checking whether the sequencer has stopped and queueing a message, and while stopping,
+        # so that no message is queued after the worker has nacked the queued messages and exited
+        self._stop_lock = threading.Lock()
+        self._stats_lock = threading.Lock()
+        self.processed_count = 0
+        self.nacked_count = 0
+        self.retried_count = 0
+        self.dead_lettered_count = 0
+        self.total_wait_sec = 0.0
+        self.max_wait_sec = 0.0
+        self._thread = threading.Thread(target=self._run, name=name, daemon=True)
+        self._thread.start()
+
+    def record_exception(self, exception):
+        """Record an exception that occurred when processing a message outside of process_message,
+        e.g. when retrying on another thread, so that subsequent messages are nacked and not processed."""
+        self.last_exception = exception
+        if self.exception_callback is not None:
+            self.exception_callback(exception)
 
     def process_message(self, message):
-        """Process the message by forwarding it to the process_message_funct associated with this instance."""
-
-        # As discussed in https://github.com/larksystems/KK-Project-2020-COVID19-SOM/pull/34
-        # pub/sub delivers the messages in the correct order, but they can end up being processed out of order
-        # if the current thread is interrupted and given that there are multiple pub/sub threads.
-        #
-        # As a stop gap measure, we append the message to the end of a queue before the lock
-        # and pop the next message to process off the queue after the lock to ensure proper ordering.
-        #
-        # There is a very slight chance that the current thread will be interrupted by the garbage collector
-        # during the call to append causing the queue to be corrupted. To eliminate this, we need to rewrite this
-        # to have process_message append the message to a synchronized queue.
-        # See https://docs.python.org/3/library/queue.html
-
-        exception_on_this_thread = None
-
-        self.message_processing_queue.append(message)
-        with self.message_processing_lock:
-            message = self.message_processing_queue.pop(0)
-
-            if self.last_exception is None:
+        """Queue the message to be forwarded to the process_message_funct associated with this instance.
+        If processing a previous message failed, then the message is nacked and the exception is re-raised
+        to terminate the subscription."""
+        while True:
+            with self._stop_lock:
+                if self.last_exception is not None or self._stopped:
+                    self._nack(message)
+                    if self.last_exception is not None:
+                        raise self.last_exception
+                    return
                 try:
-                    self.process_message_funct(message)
-                except Exception as e:
-                    self.last_exception = e
-                    exception_on_this_thread = e
-                    log.warning(f"process message exception: {e}")
-                    log.warning(traceback.format_exc())
+                    self.message_processing_queue.put_nowait((message, time.monotonic()))
+                    return
+                except queue.Full:
+                    pass
+            # Wait for the worker to make room without blocking stop()
+            time.sleep(QUEUE_FULL_RETRY_SEC)
+
+    def queue_depth(self):
+        """Return the # of messages waiting to be processed"""
+        return self.message_processing_queue.qsize() + len(self._backlog)
+
+    def stats(self):
+        """Return a dictionary containing the queue depth and the time messages waited in the queue, e.g. for metrics"""
+        with self._stats_lock:
+            return {
+                "queue_depth": self.queue_depth(),
+                "processed": self.processed_count,
+                "nacked": self.nacked_count,
+                "retried": self.retried_count,
+                "dead_lettered": self.dead_lettered_count,
+                "mean_wait_sec": self.total_wait_sec / self.processed_count if self.processed_count > 0 else 0.0,
+                "max_wait_sec": self.max_wait_sec,
+            }
+
+    def join(self):
+        """Block until every message passed to process_message has been processed or nacked"""
+        self.message_processing_queue.join()
+
+    def stop(self, timeout_sec=DEFAULT_STOP_TIMEOUT_SEC):
+        """Stop the worker thread once the current message, if any, has been processed.
+        Messages that have not been processed are nacked so that they are redelivered promptly.
+        Wait at most timeout_sec seconds for the current message, e.g. in case it is waiting for a server
+        that is unavailable, after which the current message is left to be redelivered once its ack deadline expires.
+        """
+        self._signal_stop()
+        self._wait_for_stop(time.monotonic() + timeout_sec)
 
-        if self.last_exception is not None:
+    def _signal_stop(self):
+        with self._stop_lock:
+            self._stopped = True
             try:
-                # Nack the message so that it can be properly processed at another time
-                message.nack()
-                log.debug(f"nacked {message}")
-            except Exception as e1:
-                log.warning(f"{e1} - failed to nack message: {message}")
-
-            if exception_on_this_thread is not None:
-                # If this was the thread that had the exception, then
-                # 1) sleep to give other threads a chance to nack their messages
-                # 2) re-raise the exception to terminate the subscription
-                time.sleep(1)
-                raise exception_on_this_thread
+                # Wake the worker if it is waiting for a message
+                self.message_processing_queue.put_nowait((None, None))
+            except queue.Full:
+                pass
+
+    def _wait_for_stop(self, deadline):
+        self._thread.join(max(deadline - time.monotonic(), 0))
+        if self._thread.is_alive():
+            log.warning(f"{self.name}: still processing a message after stopping, nacking the queued messages")
+            self._nack_queued_messages()
+            # Wake the worker again so that it exits once the current message has been processed
+            self._signal_stop()
+
+    def _run(self):
+        while True:
+            if self._stopped:
+                self._nack_pending_messages()
+                return
+            retry = self._pending_retry
+            if retry is not None and time.monotonic() >= retry.retry_time:
+                self._pending_retry = None
+                self._process(retry.message, retry.attempts + 1)
+                continue
+            if retry is None and len(self._backlog) > 0:
+                self._start(*self._backlog.popleft())
+                continue
+
+            # Wait for the next message, or until the pending retry is due
+            timeout = max(retry.retry_time - time.monotonic(), 0) if retry is not None else None
+            try:
+                message, queued_time = self.message_processing_queue.get(timeout=timeout)
+            except queue.Empty:
+                continue
+            if message is None:
+                # Woken by stop()
+                self.message_processing_queue.task_done()
+            elif retry is not None:
+                # Keep the message in order behind the message waiting to be retried
+                self._backlog.append((message, queued_time))
             else:
-                # Give the failing thread a chance to re-raise the exception
-                time.sleep(2)
+                self._start(message, queued_time)
+
+    def _start(self, message, queued_time):
+        if self.last_exception is not None:
+            self._nack(message)
+            self.message_processing_queue.task_done()
+            return
+        wait_sec = time.monotonic() - queued_time
+        with self._stats_lock:
+            self.processed_count += 1
+            self.total_wait_sec += wait_sec
+            self.max_wait_sec = max(self.max_wait_sec, wait_sec)
+        self._process(message, 1)
+
+    def _process(self, message, attempts):
+        """Make the specified attempt to process the message. Once the message has been processed,
+        dead lettered, or nacked, rather than left to be retried, mark its queue task as done."""
+        try:
+            self.process_message_funct(message)
+        except Exception as e:
+            log.warning(f"process message exception: {e}")
+            log.warning(traceback.format_exc())
+            if self._handle_poison_message(message, e, attempts):
+                return
+        self.message_processing_queue.task_done()
+
+    def _handle_poison_message(self, message, exception, attempts):
+        """Handle the failure to process the message according to the dead letter policy, if any.
+        Return True if the message will be retried"""
+        policy = self.dead_letter_policy
+        if policy is not None:
+            wait_time_sec = policy.retry_wait_sec(attempts)
+            if wait_time_sec is not None:
+                log.warning(f"  will retry after {wait_time_sec} seconds")
+                with self._stats_lock:
+                    self.retried_count += 1
+                self._pending_retry = _PendingRetry(message, attempts, time.monotonic() + wait_time_sec)
+                return True
+            try:
+                if policy.dead_letter(message, exception, attempts, self.name):
+                    with self._stats_lock:
+                        self.dead_lettered_count += 1
+                    message.ack()
+                    return False
+            except Exception as e:
+                log.warning(f"failed to dead letter message: {e}")
+                exception = e
+
+        self.last_exception = exception
+        if self.exception_callback is not None:
+            self.exception_callback(exception)
+        # Nack the message so that it can be properly processed at another time
+        self._nack(message)
 
         # We should flush the system buffer so that current log entries can be seen in the console and subsequent file
         # but Python has this long standing potential deadlock when calling flush() in the presence of multiple threads.
         # See https://stackoverflow.com/questions/44069717/empty-python-process-hangs-on-join-sys-stderr-flush
         # and https://bugs.python.org/issue6721
         #sys.stdout.flush()
+        return False
+
+    def _nack_pending_messages(self):
+        """Nack the message waiting to be retried, if any, and the messages waiting to be processed
+        so that they are redelivered promptly"""
+        if self._pending_retry is not None:
+            self._nack(self._pending_retry.message)
+            self._pending_retry = None
+            self.message_processing_queue.task_done()
+        while len(self._backlog) > 0:
+            message, _ = self._backlog.popleft()
+            self._nack(message)
+            self.message_processing_queue.task_done()
+        self._nack_queued_messages()
+
+    def _nack_queued_messages(self):
+        while True:
+            try:
+                message, _ = self.message_processing_queue.get_nowait()
+            except queue.Empty:
+                return
+            if message is not None:
+                self._nack(message)
+            self.message_processing_queue.task_done()
+
+    def _nack(self, message):
+        with self._stats_lock:
+            self.nacked_count += 1
+        try:
+            message.nack()
+            log.debug(f"nacked {message}")
+        except Exception as e1:
+            log.warning(f"{e1} - failed to nack message: {message}")
+
+
+class _PendingRetry(object):
+    """A message which failed to be processed and is waiting to be retried by a MessageSequencer"""
+    def __init__(self, message, attempts, retry_time):
+        self.message = message
+        # the # of times the message has been processed
+        self.attempts = attempts
+        # the time.monotonic() at which the message should be retried
+        self.retry_time = retry_time
+
+
+class KeyedMessageSequencer:
+    """A message processor which processes messages with the same key sequentially and in order
+    while processing messages with different keys in parallel.
+
+    key_funct is called with each message and returns its key, e.g. the conversation to which it applies,
+    or None if the message has no key. Each key is hashed to one of num_lanes lanes, and messages without a key
+    are processed in a separate lane. Each lane is a MessageSequencer with its own worker thread,
+    so messages in each lane are processed in the order in which process_message is called.
+
+    If an exception occurs when processing a message in any lane, then subsequent messages in all lanes
+    are nacked and not processed, as for a MessageSequencer. If dead_letter_policy is specified,
+    then it is shared by all of the lanes.
+    """
+    def __init__(self, process_message_funct, key_funct, num_lanes=4, exception_callback=None,
+                 max_queue_size_per_lane=DEFAULT_MAX_QUEUE_SIZE, name="keyed-message-sequencer",
+                 dead_letter_policy=None):
+        assert num_lanes > 0
+        self.key_funct = key_funct
+        self.exception_callback = exception_callback
+        self.name = name
+        self.lanes = [
+            MessageSequencer(process_message_funct, exception_callback=self._lane_exception,
+                             max_queue_size=max_queue_size_per_lane, name=f"{name}-{index}",
+                             dead_letter_policy=dead_letter_policy)
+            for index in range(0, num_lanes)
+        ]
+        self.keyless_lane = MessageSequencer(process_message_funct, exception_callback=self._lane_exception,
+                                             max_queue_size=max_queue_size_per_lane, name=f"{name}-keyless",
+                                             dead_letter_policy=dead_letter_policy)
+        # The max # of messages queued in all lanes, e.g. for the Subscriber's max_outstanding_messages
+        self.max_queue_size = max_queue_size_per_lane * (num_lanes + 1)
+
+    @property
+    def last_exception(self):
+        for lane in self._all_lanes():
+            if lane.last_exception is not None:
+                return lane.last_exception
+        return None
+
+    def lane(self, key):
+        """Return the MessageSequencer which processes messages with the specified key"""
+        if key is None:
+            return self.keyless_lane
+        # Python's hash() of a string varies between processes, so use a stable hash
+        return self.lanes[zlib.crc32(key.encode("utf-8")) % len(self.lanes)]
+
+    def process_message(self, message):
+        """Queue the message in the lane for its key"""
+        self.lane(self.key_funct(message)).process_message(message)
+
+    def queue_depth(self):
+        """Return the # of messages waiting to be processed in all lanes"""
+        return sum(lane.queue_depth() for lane in self._all_lanes())
+
+    def stats(self):
+        """Return a dictionary containing the stats of each lane, e.g. for metrics"""
+        return {lane.name: lane.stats() for lane in self._all_lanes()}
+
+    def join(self):
+        """Block until every message passed to process_message has been processed or nacked"""
+        for lane in self._all_lanes():
+            lane.join()
+
+    def stop(self, timeout_sec=DEFAULT_STOP_TIMEOUT_SEC):
+        """Stop each lane once its current message, if any, has been processed, nacking the queued messages.
+        Wait at most timeout_sec seconds in total, see MessageSequencer.stop."""
+        deadline = time.monotonic() + timeout_sec
+        for lane in self._all_lanes():
+            lane._signal_stop()
+        for lane in self._all_lanes():
+            lane._wait_for_stop(deadline)
+
+    def _all_lanes(self):
+        return self.lanes + [self.keyless_lane]
+
+    def _lane_exception(self, exception):
+        # Halt every lane rather than just the one in which the exception occurred
+        for lane in self._all_lanes():
+            if lane.last_exception is None:
+                lane.last_exception = exception
+        if self.exception_callback is not None:
+            self.exception_callback(exception)
 
 
 class Publisher:
-    """Publish to the specified pub/sub channel."""
+    """Publish to the specified pub/sub channel.
+
+    If batch_settings (an instance of google.cloud.pubsub_v1.types.BatchSettings) is specified,
+    then the underlying client will group published messages into batches according to those settings.
+    """
 
-    def __init__(self, crypto_token_path, topic_name):
+    def __init__(self, crypto_token_path, topic_name, batch_settings=None):
         self.crypto_token_path = crypto_token_path
         with open(crypto_token_path) as f:
             self.project_id = json.load(f)["project_id"]
         self.topic_path = f"projects/{self.project_id}/topics/{self.project_id}-{topic_name}"
-        self.client = pubsub_v1.PublisherClient.from_service_account_json(crypto_token_path)
+        if batch_settings is None:
+            self.client = pubsub_v1.PublisherClient.from_service_account_json(crypto_token_path)
+        else:
+            self.client = pubsub_v1.PublisherClient.from_service_account_json(
+                crypto_token_path, batch_settings=batch_settings)
 
         print("Create topic")
         try:
@@ -172,6 +544,19 @@ class Publisher:
             print(f"Error on topic creation for {self.topic_path}: {sys.exc_info()[0]}")
 
     def publish(self, message):
-        """Publish a single message (a dictionary)"""
+        """Publish a single message (a dictionary) and return a future for the publish result"""
         data = json.dumps({"payload": message}).encode("utf-8")
         return self.client.publish(self.topic_path, data=data)
+
+    @staticmethod
+    def wait_for_futures(futures, timeout=None):
+        """Block until each of the specified publish futures has completed.
+        If any of the publish requests failed or timed out, then the first such exception is raised.
+
+        :param futures: a list of futures returned by publish()
+        :param timeout: the maximum number of seconds to wait for each future or None to wait indefinitely
+        :return: the number of messages that were published
+        """
+        for future in futures:
+            future.result(timeout=timeout)
+        return len(futures)
@@ -0,0 +1,93 @@
+import threading
+import time
+
+# Tokens within this amount of a whole token are treated as a whole token
+# so that rounding errors never cause a wait too short to advance the clock
+_TOKEN_TOLERANCE = 1e-9
+
+
+class RateLimiter(object):
+    """
+    A thread safe token bucket shared by every request to a server,
+    limiting requests to max_rate per second with bursts of up to burst requests.
+
+    When the server indicates that requests have exceeded its rate limit, throttle() pauses all requests
+    for the retry-after period and halves the rate. The rate then recovers linearly to max_rate
+    over recovery_period seconds. If max_rate is None, then requests are only limited while paused.
+    """
+    def __init__(self, max_rate=None, burst=None, min_rate=None, recovery_period=60,
+                 clock=time.monotonic, sleep=time.sleep):
+        self.max_rate = max_rate
+        self.burst = burst if burst is not None else max(1, max_rate or 1)
+        self.min_rate = min_rate if min_rate is not None else (max_rate / 16 if max_rate is not None else None)
+        self.recovery_period = recovery_period
+        self._clock = clock
+        self._sleep = sleep
+        self._lock = threading.Lock()
+        self._rate = max_rate
+        self._tokens = self.burst
+        self._last_update = clock()
+        # requests are paused until this time or None if not paused
+        self._paused_until = None
+        self.throttle_count = 0
+        self.wait_time = 0.0
+
+    def acquire(self):
+        """Block until a request can be made"""
+        while True:
+            with self._lock:
+                now = self._clock()
+                self._update(now)
+                if self._paused_until is not None and now < self._paused_until:
+                    wait_time_sec = self._paused_until - now
+                elif self._rate is None:
+                    return
+                elif self._tokens >= 1 - _TOKEN_TOLERANCE:
+                    self._tokens = max(self._tokens - 1, 0)
+                    return
+                else:
+                    wait_time_sec = (1 - self._tokens) / self._rate
+                self.wait_time += wait_time_sec
+            self._sleep(wait_time_sec)
+
+    def throttle(self, retry_after=None):
+        """Pause all requests for retry_after seconds (or 1 second if not specified) and reduce the rate.
+        Throttling again before the pause has ended extends the pause without reducing the rate further."""
+        if not retry_after or retry_after < 0:
+            retry_after = 1
+        with self._lock:
+            now = self._clock()
+            self._update(now)
+            paused = self._paused_until is not None and now < self._paused_until
+            if not paused:
+                self.throttle_count += 1
+                if self._rate is not None:
+                    self._rate = max(self._rate / 2, self.min_rate)
+            paused_until = now + retry_after
+            if self._paused_until is None or paused_until > self._paused_until:
+                self._paused_until = paused_until
+            self._tokens = 0
+
+    def stats(self):
+        """Return a dictionary containing the current rate, # of times throttled, and total seconds spent waiting"""
+        with self._lock:
+            self._update(self._clock())
+            return {
+                "rate": self._rate,
+                "throttle_count": self.throttle_count,
+                "wait_time": self.wait_time,
+            }
+
+    def _update(self, now):
+        elapsed = now - self._last_update
+        if elapsed <= 0:
+            return
+        if self._rate is not None:
+            if self._rate < self.max_rate:
+                self._rate = min(self._rate + self.max_rate * elapsed / self.recovery_period, self.max_rate)
+            # Tokens do not accumulate while paused
+            refill_start = self._last_update
+            if self._paused_until is not None:
+                refill_start = max(refill_start, min(self._paused_until, now))
+            self._tokens = min(self._tokens + (now - refill_start) * self._rate, self.burst)
+        self._last_update = now
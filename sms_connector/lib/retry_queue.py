@@ -0,0 +1,77 @@
+import heapq
+import itertools
+import threading
+import time
+import traceback
+
+from lib.simple_logger import Logger
+
+log = None
+
+
+class RetryQueue(object):
+    """
+    Calls functions at scheduled times on a dedicated worker thread, earliest first,
+    so that the caller can schedule a retry rather than sleeping until it is due.
+
+    Scheduled functions are responsible for handling their own exceptions.
+    Any exception raised by a scheduled function is logged and otherwise ignored.
+    """
+    def __init__(self, name="retry-queue", clock=time.monotonic):
+        global log
+        if log is None:
+            log = Logger(__name__)
+
+        self.name = name
+        self._clock = clock
+        # a heap of (due time, sequence #, funct, args) where the sequence # keeps retries due at the same time in order
+        self._heap = []
+        self._sequence = itertools.count()
+        self._condition = threading.Condition()
+        self._stopped = False
+        self._thread = threading.Thread(target=self._run, name=name, daemon=True)
+        self._thread.start()
+
+    def __len__(self):
+        with self._condition:
+            return len(self._heap)
+
+    def schedule(self, delay_sec, funct, *args):
+        """Call funct(*args) on the worker thread in delay_sec seconds"""
+        with self._condition:
+            if self._stopped:
+                raise AssertionError(f"{self.name} is stopped")
+            heapq.heappush(self._heap, (self._clock() + delay_sec, next(self._sequence), funct, args))
+            self._condition.notify()
+
+    def stop(self):
+        """Stop the worker thread once the current call, if any, has completed
+        and return a list of the args of each scheduled call that was not made"""
+        with self._condition:
+            self._stopped = True
+            pending = [args for _, _, _, args in sorted(self._heap)]
+            self._heap.clear()
+            self._condition.notify()
+        self._thread.join()
+        return pending
+
+    def _run(self):
+        while True:
+            with self._condition:
+                while not self._stopped:
+                    if len(self._heap) == 0:
+                        self._condition.wait()
+                        continue
+                    wait_sec = self._heap[0][0] - self._clock()
+                    if wait_sec <= 0:
+                        break
+                    self._condition.wait(wait_sec)
+                if self._stopped:
+                    return
+                _, _, funct, args = heapq.heappop(self._heap)
+
+            try:
+                funct(*args)
+            except Exception as e:
+                log.warning(f"{self.name}: scheduled call failed: {e}")
+                log.warning(traceback.format_exc())
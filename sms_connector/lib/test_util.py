@@ -1,4 +1,5 @@
 import inspect
+import itertools
 import json
 import os
 
@@ -10,6 +11,8 @@ from lib.pubsub_util import Subscriber
 
 crypto_token_path = None
 
+_message_ids = itertools.count(1)
+
 
 class TestLogger(Logger):
     def __init__(self, logger_name):
@@ -20,8 +23,9 @@ class TestLogger(Logger):
 
 
 class MockPubSubMessage:
-    def __init__(self, data):
+    def __init__(self, data, message_id=None):
         self.data = data
+        self.message_id = message_id if message_id is not None else f"mock-message-id-{next(_message_ids)}"
         self.acked = False
         self.nacked = False
 
@@ -32,6 +36,26 @@ class MockPubSubMessage:
         self.nacked = True
 
 
+class MockPublishFuture(object):
+    def __init__(self, exception=None):
+        self.exception = exception
+
+    def result(self, timeout=None):
+        if self.exception is not None:
+            raise self.exception
+        return "mock-message-id"
+
+
+class MockPublisher(object):
+    def __init__(self):
+        self.payloads = []
+        self.publish_exception = None
+
+    def publish(self, message):
+        self.payloads.append(message)
+        return MockPublishFuture(self.publish_exception)
+
+
 class MockSubscriber(object):
     def __init__(self):
         self.canceled = False
@@ -41,18 +65,23 @@ class MockSubscriber(object):
 
 
 class ProxyPubSubMessage(object):
-    def __init__(self, message):
+    def __init__(self, message, collector=None):
         self.message = message
+        self.collector = collector
         self.data = message.data
         self.acked = False
         self.nacked = False
 
     def ack(self):
         self.acked = True
+        if self.collector is not None:
+            self.collector.ack_count += 1
         self.message.ack()
 
     def nack(self):
         self.nacked = True
+        if self.collector is not None:
+            self.collector.nack_count += 1
         self.message.nack()
 
 
@@ -67,14 +96,9 @@ class MessageCollector(object):
         payload = json.loads(message.data)['payload']
         self.payloads.append(payload)
         if self.process_message_funct is not None:
-            proxy = ProxyPubSubMessage(message)
-            try:
-                self.process_message_funct(proxy)
-            finally:
-                if proxy.acked:
-                    self.ack_count += 1
-                elif proxy.nacked:
-                    self.nack_count += 1
+            # The proxy counts the message when it is acked or nacked,
+            # which may be after process_message_funct returns, e.g. if it queues the message
+            self.process_message_funct(ProxyPubSubMessage(message, self))
         else:
             # put process order critical operations above this line
             # because print() and ack() can trigger thread switching
@@ -0,0 +1,233 @@
+import threading
+from array import array
+from collections import OrderedDict
+
+
+class DictUuidCache(object):
+    """
+    An in memory cache of the mappings between data and UUIDs in a FirestoreUuidTable
+    stored as a pair of dictionaries.
+    """
+    def __init__(self):
+        self._data_to_uuid = dict()
+        self._uuid_to_data = dict()
+
+    def __len__(self):
+        return len(self._data_to_uuid)
+
+    def add(self, data, data_uuid):
+        self._data_to_uuid[data] = data_uuid
+        self._uuid_to_data[data_uuid] = data
+
+    def get_uuid(self, data):
+        """Return the UUID associated with the specified data or None if it is not cached"""
+        return self._data_to_uuid.get(data)
+
+    def get_data(self, data_uuid):
+        """Return the data associated with the specified UUID or None if it is not cached"""
+        return self._uuid_to_data.get(data_uuid)
+
+    def items(self):
+        """Return an iterable of (data, uuid) pairs"""
+        return self._data_to_uuid.items()
+
+
+class LruUuidCache(object):
+    """
+    An in memory cache of the most recently used mappings between data and UUIDs in a FirestoreUuidTable.
+    Each direction holds at most max_size mappings, evicting the least recently used mapping when full.
+    """
+    def __init__(self, max_size):
+        assert max_size > 0
+        self._max_size = max_size
+        self._data_to_uuid = OrderedDict()
+        self._uuid_to_data = OrderedDict()
+        # Lookups modify the order of the entries, so all access is synchronized
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._data_to_uuid)
+
+    def add(self, data, data_uuid):
+        with self._lock:
+            _lru_put(self._data_to_uuid, data, data_uuid, self._max_size)
+            _lru_put(self._uuid_to_data, data_uuid, data, self._max_size)
+
+    def get_uuid(self, data):
+        """Return the UUID associated with the specified data or None if it is not cached"""
+        with self._lock:
+            return _lru_get(self._data_to_uuid, data)
+
+    def get_data(self, data_uuid):
+        """Return the data associated with the specified UUID or None if it is not cached"""
+        with self._lock:
+            return _lru_get(self._uuid_to_data, data_uuid)
+
+    def items(self):
+        """Return an iterable of (data, uuid) pairs"""
+        with self._lock:
+            return list(self._data_to_uuid.items())
+
+
+def _lru_put(lru, key, value, max_size):
+    lru[key] = value
+    lru.move_to_end(key)
+    while len(lru) > max_size:
+        lru.popitem(last=False)
+
+
+def _lru_get(lru, key):
+    value = lru.get(key)
+    if value is not None:
+        lru.move_to_end(key)
+    return value
+
+
+class CompactUuidCache(object):
+    """
+    An in memory cache of the mappings between data and UUIDs in a FirestoreUuidTable
+    using much less memory than DictUuidCache at the cost of slower lookups.
+
+    UUIDs of the form <uuid_prefix><uuid4> are stored without the prefix as 16 byte binary values.
+    The data (e.g. URNs) are stored UTF-8 encoded end to end in a single byte array.
+    Lookups in each direction use an open addressing hash table of array indices
+    rather than a dictionary of Python strings.
+
+    Mappings with a UUID that is not of the form <uuid_prefix><uuid4> are stored in dictionaries.
+
+    Only one thread may add mappings at a time, but lookups can be performed concurrently on other threads.
+    """
+    def __init__(self, uuid_prefix):
+        self._uuid_prefix = uuid_prefix
+        # data item i is _data_blob[_data_offsets[i]:_data_offsets[i + 1]]
+        self._data_blob = bytearray()
+        self._data_offsets = array("I", [0])
+        # the 16 byte UUID for data item i is _uuids[16 * i:16 * i + 16]
+        self._uuids = bytearray()
+        # a tuple of (mask, data hash table, uuid hash table)
+        # where each hash table entry is 0 if empty or the index of the data item + 1
+        self._indexes = _new_indexes(16)
+        # mappings with UUIDs that cannot be stored as 16 bytes: data --> UUID and UUID --> data
+        self._irregular_data_to_uuid = dict()
+        self._irregular_uuid_to_data = dict()
+
+    def __len__(self):
+        return len(self._data_offsets) - 1 + len(self._irregular_data_to_uuid)
+
+    def add(self, data, data_uuid):
+        uuid_bytes = self._encode_uuid(data_uuid)
+        if uuid_bytes is None:
+            self._irregular_data_to_uuid[data] = data_uuid
+            self._irregular_uuid_to_data[data_uuid] = data
+            return
+
+        data_bytes = data.encode("utf-8")
+        if self._find_data(data_bytes) is not None:
+            # mappings never change, so keep the existing mapping
+            return
+
+        # Keep the hash tables at most half full
+        index = len(self._data_offsets) - 1
+        mask = self._indexes[0]
+        if (index + 1) * 2 > mask + 1:
+            self._resize_indexes((mask + 1) * 2)
+
+        # Append the mapping before adding it to the hash tables
+        # so that concurrent lookups never find an incomplete mapping
+        self._data_blob += data_bytes
+        self._data_offsets.append(len(self._data_blob))
+        self._uuids += uuid_bytes
+        mask, data_table, uuid_table = self._indexes
+        _insert(data_table, mask, hash(data_bytes), index)
+        _insert(uuid_table, mask, hash(uuid_bytes), index)
+
+    def get_uuid(self, data):
+        """Return the UUID associated with the specified data or None if it is not cached"""
+        index = self._find_data(data.encode("utf-8"))
+        if index is not None:
+            return self._decode_uuid(self._uuid_at(index))
+        return self._irregular_data_to_uuid.get(data)
+
+    def get_data(self, data_uuid):
+        """Return the data associated with the specified UUID or None if it is not cached"""
+        uuid_bytes = self._encode_uuid(data_uuid)
+        if uuid_bytes is None:
+            return self._irregular_uuid_to_data.get(data_uuid)
+
+        mask, _, uuid_table = self._indexes
+        slot = hash(uuid_bytes) & mask
+        while True:
+            entry = uuid_table[slot]
+            if entry == 0:
+                return None
+            if self._uuid_at(entry - 1) == uuid_bytes:
+                return self._data_at(entry - 1).decode("utf-8")
+            slot = (slot + 1) & mask
+
+    def items(self):
+        """Return an iterable of (data, uuid) pairs"""
+        for index in range(0, len(self._data_offsets) - 1):
+            yield self._data_at(index).decode("utf-8"), self._decode_uuid(self._uuid_at(index))
+        yield from list(self._irregular_data_to_uuid.items())
+
+    def _find_data(self, data_bytes):
+        """Return the index of the specified data or None if it is not cached"""
+        mask, data_table, _ = self._indexes
+        slot = hash(data_bytes) & mask
+        while True:
+            entry = data_table[slot]
+            if entry == 0:
+                return None
+            if self._data_at(entry - 1) == data_bytes:
+                return entry - 1
+            slot = (slot + 1) & mask
+
+    def _data_at(self, index):
+        return self._data_blob[self._data_offsets[index]:self._data_offsets[index + 1]]
+
+    def _uuid_at(self, index):
+        return self._uuids[16 * index:16 * index + 16]
+
+    def _resize_indexes(self, size):
+        mask, data_table, uuid_table = _new_indexes(size)
+        for index in range(0, len(self._data_offsets) - 1):
+            _insert(data_table, mask, hash(bytes(self._data_at(index))), index)
+            _insert(uuid_table, mask, hash(bytes(self._uuid_at(index))), index)
+        # Replace the hash tables in a single assignment so that concurrent lookups see a consistent set
+        self._indexes = (mask, data_table, uuid_table)
+
+    def _encode_uuid(self, data_uuid):
+        """Return the 16 byte representation of the specified UUID
+        or None if the UUID is not of the form <uuid_prefix><uuid4>"""
+        if not data_uuid.startswith(self._uuid_prefix):
+            return None
+        uuid_string = data_uuid[len(self._uuid_prefix):]
+        # Check that the UUID will round trip (e.g. it is lowercase with hyphens in the standard positions)
+        if len(uuid_string) != 36 or uuid_string[8] != "-" or uuid_string[13] != "-" \
+                or uuid_string[18] != "-" or uuid_string[23] != "-":
+            return None
+        hex_string = uuid_string.replace("-", "")
+        if len(hex_string) != 32 or hex_string != hex_string.lower():
+            return None
+        try:
+            uuid_bytes = bytes.fromhex(hex_string)
+        except ValueError:
+            return None
+        return uuid_bytes if len(uuid_bytes) == 16 else None
+
+    def _decode_uuid(self, uuid_bytes):
+        hex_string = uuid_bytes.hex()
+        return f"{self._uuid_prefix}{hex_string[0:8]}-{hex_string[8:12]}-{hex_string[12:16]}-" \
+               f"{hex_string[16:20]}-{hex_string[20:32]}"
+
+
+def _new_indexes(size):
+    """Return a tuple of (mask, data hash table, uuid hash table) where size is a power of 2"""
+    return size - 1, array("I", bytes(4 * size)), array("I", bytes(4 * size))
+
+
+def _insert(table, mask, hash_value, index):
+    slot = hash_value & mask
+    while table[slot] != 0:
+        slot = (slot + 1) & mask
+    table[slot] = index + 1
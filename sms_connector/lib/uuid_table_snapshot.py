@@ -0,0 +1,100 @@
+import os
+import sqlite3
+import threading
+
+from lib.simple_logger import Logger
+
+log = None
+
+
+class UuidTableSnapshot(object):
+    """
+    A local SQLite file containing a copy of the data --> uuid mappings in a FirestoreUuidTable
+    along with a high water mark indicating the most recent mapping timestamp contained in the file.
+    """
+    def __init__(self, file_path):
+        global log
+        if log is None:
+            log = Logger(__name__)
+
+        self.file_path = file_path
+        self._write_lock = threading.Lock()
+        self._write_thread = None
+
+    def load(self):
+        """Return a tuple containing a mapping of data to uuid and the high water mark,
+        or (None, None) if the snapshot does not exist or cannot be read."""
+        data_to_uuid = dict()
+        count, high_water_mark = self.load_into(data_to_uuid.__setitem__)
+        if count is None:
+            return None, None
+        return data_to_uuid, high_water_mark
+
+    def load_into(self, add_mapping):
+        """Call add_mapping(data, uuid) for each mapping in the snapshot without building an intermediate copy,
+        and return a tuple containing the number of mappings loaded and the high water mark,
+        or (None, None) if the snapshot does not exist or cannot be read."""
+        if not os.path.exists(self.file_path):
+            log.info(f"No uuid table snapshot found: {self.file_path}")
+            return None, None
+
+        log.info(f"Loading uuid table snapshot: {self.file_path}")
+        count = 0
+        try:
+            connection = sqlite3.connect(f"file:{self.file_path}?mode=ro", uri=True)
+            try:
+                for data, data_uuid in connection.execute("SELECT data, uuid FROM mappings"):
+                    add_mapping(data, data_uuid)
+                    count += 1
+                row = connection.execute("SELECT value FROM meta WHERE key = 'high_water_mark'").fetchone()
+            finally:
+                connection.close()
+        except sqlite3.DatabaseError as e:
+            # Fall back to loading the entire table from firebase
+            log.warning(f"Failed to load uuid table snapshot {self.file_path}: {e}")
+            return None, None
+
+        high_water_mark = row[0] if row is not None else None
+        log.info(f"Loaded {count} uuid mappings from snapshot, high water mark: {high_water_mark}")
+        return count, high_water_mark
+
+    def write(self, data_uuid_pairs, high_water_mark):
+        """Write the specified (data, uuid) pairs and high water mark to the snapshot file.
+        The snapshot is written to a temporary file which then replaces the existing snapshot
+        so that a partially written snapshot is never loaded."""
+        with self._write_lock:
+            temp_file_path = f"{self.file_path}.tmp"
+            if os.path.exists(temp_file_path):
+                os.remove(temp_file_path)
+
+            connection = sqlite3.connect(temp_file_path)
+            try:
+                connection.execute("CREATE TABLE mappings (data TEXT PRIMARY KEY, uuid TEXT NOT NULL)")
+                connection.execute("CREATE TABLE meta (key TEXT PRIMARY KEY, value TEXT)")
+                connection.executemany("INSERT INTO mappings (data, uuid) VALUES (?, ?)", data_uuid_pairs)
+                connection.execute("INSERT INTO meta (key, value) VALUES ('high_water_mark', ?)", (high_water_mark,))
+                connection.commit()
+            finally:
+                connection.close()
+
+            os.replace(temp_file_path, self.file_path)
+            log.info(f"Wrote uuid table snapshot: {self.file_path}, high water mark: {high_water_mark}")
+
+    def write_in_background(self, data_uuid_pairs, high_water_mark):
+        """Write the snapshot on a background thread. See write()."""
+        self._write_thread = threading.Thread(
+            target=self._write_in_background_impl, args=(data_uuid_pairs, high_water_mark), name="uuid-table-snapshot")
+        self._write_thread.start()
+
+    def _write_in_background_impl(self, data_uuid_pairs, high_water_mark):
+        try:
+            self.write(data_uuid_pairs, high_water_mark)
+        except Exception as e:
+            # The snapshot is an optimization, so log the failure rather than crashing
+            log.warning(f"Failed to write uuid table snapshot {self.file_path}: {e}")
+
+    def wait(self):
+        """Block until any background write has completed"""
+        if self._write_thread is not None:
+            self._write_thread.join()
+            self._write_thread = None
@@ -1,3 +1,4 @@
+import argparse
 import datetime
 import json
 import os
@@ -6,7 +7,7 @@ import sys
 from lib import message_util
 from lib.simple_logger import Logger
 from lib import pubsub_util
-from lib.pubsub_util import Subscriber, MessageSequencer, Publisher
+from lib.pubsub_util import DeadLetterPolicy, KeyedMessageSequencer, Publisher, Subscriber
 from lib.utils import utcnow
 import lib.opinion_handlers
 from firebase_admin import credentials
@@ -20,6 +21,9 @@ subscription = None
 
 # The publisher used to send outgoing sms requests to the rapidpro adapter
 rapidpro_publisher = None
+# The publisher used to send outgoing sms requests in the interactive lane to the rapidpro adapter,
+# or None to send all requests using rapidpro_publisher
+interactive_publisher = None
 
 
 def init_logger(crypto_token_path):
@@ -27,6 +31,15 @@ def init_logger(crypto_token_path):
     log = Logger(__name__)
     pubsub_util.log = Logger(pubsub_util.__name__)
 
+def message_key(message):
+    """Return the key of the conversation to which the message applies, or None if there is no such conversation.
+    Messages which cannot be parsed have no key so that the exception occurs when processing them"""
+    try:
+        return message_util.conversation_key(json.loads(message.data)['payload'])
+    except Exception:
+        return None
+
+
 def process_message_impl(message):
     """Called on a background thread once for each message.
     It is the responsibility of the caller to gracefully handle exceptions"""
@@ -57,11 +70,16 @@ def process_message_impl(message):
 
         log.audit(f"pubsub: send_sms {json.dumps(data_map)}")
 
-        rapidpro_publisher.publish({
+        payload = {
             "action": "send_messages",
             "ids": ids,
             "messages": messages,
-        })
+        }
+        if interactive_publisher is not None \
+                and message_util.outgoing_lane(data_map) == message_util.INTERACTIVE_LANE:
+            interactive_publisher.publish(payload)
+        else:
+            rapidpro_publisher.publish(payload)
 
         log.debug(f"Acking message {message}")
         message.ack()
@@ -117,18 +135,55 @@ def run():
     log.info(r)
 
 
-if __name__ == '__main__':
-    if len(sys.argv) != 2:
-        print(f"usage: python {sys.argv[0]} crypto_token")
-        exit(1)
+def end_subscription(exception):
+    """Called on a sequencer worker thread when processing a message fails
+    so that run() raises the exception rather than waiting for the next message"""
+    subscriber.cancel_with_exception(exception)
+
 
-    crypto_token_file = sys.argv[1]
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Handles messages between Nook and the rapidpro adapter")
+    parser.add_argument("crypto_token_file", metavar="crypto-token-file",
+                        help="Path to the Firebase credentials file")
+    parser.add_argument("--conversation-lanes", type=int, default=4,
+                        help="# of worker threads processing messages for different conversations in parallel. "
+                             "Messages for each conversation are always processed in order, and messages which do not "
+                             "apply to a single conversation, e.g. nook/set_tag opinions, are processed in order "
+                             "on a separate thread")
+    parser.add_argument("--dead-letter-topic",
+                        help="If specified, a message which still fails after --max-attempts is published to this "
+                             "topic with the error and acked so that later messages are processed. "
+                             "Otherwise processing stops after the first message which fails")
+    parser.add_argument("--max-attempts", type=int, default=3,
+                        help="Max # of times to process a message before dead lettering it, "
+                             "waiting 1 second before the first retry and 4 times longer before each later retry")
+    parser.add_argument("--max-dead-letters", type=int, default=10,
+                        help="Stop processing rather than dead lettering a message if more than this many messages "
+                             "have been dead lettered in the last 5 minutes, because the failures are likely systemic")
+    parser.add_argument("--interactive-lane", action="store_true",
+                        help="Publish outgoing messages to at most a few recipients, or with \"lane\": \"interactive\", "
+                             "to the sms-outgoing-interactive topic so that they are not delayed by large broadcasts. "
+                             "The rapidpro adapter must be run with --outgoing-interactive-lane")
+
+    args = parser.parse_args(sys.argv[1:])
+    crypto_token_file = args.crypto_token_file
 
 
     init_logger(crypto_token_file)
-    sequencer = MessageSequencer(process_message_impl)
-    subscriber = Subscriber(crypto_token_file, "sms-channel-topic", "sms-channel-subscription", sequencer.process_message)
+    dead_letter_policy = None
+    if args.dead_letter_topic is not None:
+        log.info(f"Dead lettering messages to {args.dead_letter_topic} after {args.max_attempts} attempts")
+        dead_letter_policy = DeadLetterPolicy(Publisher(crypto_token_file, args.dead_letter_topic),
+                                              max_attempts=args.max_attempts, max_dead_letters=args.max_dead_letters)
+    sequencer = KeyedMessageSequencer(process_message_impl, message_key, num_lanes=args.conversation_lanes,
+                                      exception_callback=end_subscription, name="pubsub-handler-sequencer",
+                                      dead_letter_policy=dead_letter_policy)
+    log.info(f"Processing messages for different conversations on {args.conversation_lanes} threads")
+    subscriber = Subscriber(crypto_token_file, "sms-channel-topic", "sms-channel-subscription", sequencer.process_message,
+                            max_outstanding_messages=sequencer.max_queue_size)
     rapidpro_publisher = Publisher(crypto_token_file, "sms-outgoing")
+    if args.interactive_lane:
+        interactive_publisher = Publisher(crypto_token_file, "sms-outgoing-interactive")
 
     firebase_cred = credentials.Certificate(crypto_token_file)
     firebase_admin.initialize_app(firebase_cred)
@@ -143,4 +198,6 @@ if __name__ == '__main__':
         log.info("Keyboard interrupt")
     finally:
         subscriber.cancel()
+        sequencer.stop()
+        log.info(f"Sequencer: {sequencer.stats()}")
         log.info("Cleanup complete")
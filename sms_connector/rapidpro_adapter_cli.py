@@ -4,7 +4,6 @@ import json
 import os
 import sys
 import threading
-import time
 
 import firebase_admin
 from firebase_admin import credentials
@@ -15,18 +14,50 @@ from rapid_pro_tools.rapid_pro_client import RapidProClient
 
 import rapidpro_incoming
 import rapidpro_outgoing
+import rapidpro_webhook
 
+from lib import http_session_pool
 from lib import pubsub_util
+from lib.circuit_breaker import CLOSED, CircuitBreaker, CircuitOpenError
 from lib.firestore_uuid_table import FirestoreUuidTable
+from lib.http_session_pool import EndpointConfig, SessionPool
+from lib.poll_scheduler import AdaptivePollScheduler
+from lib.rate_limiter import RateLimiter
 from lib.simple_logger import Logger
 
 
 log = None
 process_messages = True
-
-
-def setup(crypto_token_path, project_name, credentials_bucket_name, sync_token_path, rapid_pro_config_blob_name="rapidpro-config.json"):
-    global log
+phone_number_uuid_table = None
+
+# Determines how long to wait between polls. Replaced in setup() if any poll settings are specified.
+poll_scheduler = AdaptivePollScheduler()
+# When receiving messages via webhook, poll RapidPro this often (in seconds) for any messages that were missed
+DEFAULT_WEBHOOK_RECONCILE_INTERVAL = 300
+
+# The keep-alive session pools for requests to RapidPro
+rapidpro_session_pools = []
+# Shared by incoming and outgoing so that an outage detected by either stops both from making requests which will fail
+rapidpro_circuit_breaker = None
+
+# Set to wake the polling loop before the next poll is due, e.g. on shutdown or when an outgoing message fails
+wakeup_event = threading.Event()
+
+
+def setup(crypto_token_path, project_name, credentials_bucket_name, sync_token_path, rapid_pro_config_blob_name="rapidpro-config.json",
+          publish_batch_max_messages=None, publish_batch_max_bytes=None, publish_batch_max_latency=None,
+          uuid_table_snapshot_path=None, uuid_table_listen_for_changes=False, uuid_table_compact_cache=False,
+          uuid_table_lazy_cache_size=None, uuid_table_maintain_reverse_index=False, uuid_table_load_partitions=1,
+          uuid_table_load_partition_boundaries=None,
+          incoming_page_max_duration=None, incoming_page_target_messages=None,
+          poll_min_interval=None, poll_max_interval=None, poll_large_batch_size=None,
+          webhook_port=None, webhook_host="127.0.0.1", webhook_token=None, webhook_reconcile_interval=None,
+          incoming_rapidpro_concurrency=1, outgoing_rapidpro_concurrency=1,
+          incoming_rapidpro_timeout=600, outgoing_rapidpro_timeout=600, rapidpro_max_requests_per_second=None,
+          outgoing_ledger_path=None, outgoing_min_split_size=None, outgoing_quarantine_path=None,
+          outgoing_coalesce_window=None, outgoing_interactive_lane=False, outgoing_schedule_retries=False,
+          rapidpro_circuit_reset_timeout=60):
+    global log, phone_number_uuid_table, poll_scheduler, rapidpro_session_pools, rapidpro_circuit_breaker
     log = Logger(__name__)
     pubsub_util.log = Logger(pubsub_util.__name__)
 
@@ -43,31 +74,118 @@ def setup(crypto_token_path, project_name, credentials_bucket_name, sync_token_p
     rapid_pro_token = rapid_pro_config_dict["token"]
     log.info(f"Rapid Pro domain: {rapid_pro_domain}")
     log.info(f"Rapid Pro token: {rapid_pro_token[0:6]}...")
-    rapidpro_client = RapidProClient(rapid_pro_domain, rapid_pro_token)
+    # Each direction has its own client and concurrency limit
+    # so that sending replies never waits on a slow poll and vice versa
+    # All requests to RapidPro share a rate limiter so that the whole pipeline slows down when RapidPro throttles
+    http_session_pool.install(rate_limiter=RateLimiter(rapidpro_max_requests_per_second))
+    log.info(f"Rapid Pro max requests per second: {rapidpro_max_requests_per_second}")
+    incoming_rapidpro_client, incoming_rapidpro_lock, incoming_session_pool = new_rapidpro_client(
+        "incoming", rapid_pro_domain, rapid_pro_token, incoming_rapidpro_concurrency, incoming_rapidpro_timeout)
+    outgoing_rapidpro_client, outgoing_rapidpro_lock, outgoing_session_pool = new_rapidpro_client(
+        "outgoing", rapid_pro_domain, rapid_pro_token, outgoing_rapidpro_concurrency, outgoing_rapidpro_timeout)
+    rapidpro_session_pools = [incoming_session_pool, outgoing_session_pool]
+    log.info(f"Rapid Pro concurrency: incoming {incoming_rapidpro_concurrency}, "
+             f"outgoing {outgoing_rapidpro_concurrency}")
+    rapidpro_circuit_breaker = CircuitBreaker("rapidpro", reset_timeout_sec=rapidpro_circuit_reset_timeout)
+    log.info(f"Rapid Pro circuit breaker: open after {rapidpro_circuit_breaker.max_failures} failures "
+             f"in {rapidpro_circuit_breaker.window_sec} seconds, probe every {rapidpro_circuit_reset_timeout} seconds")
 
     log.info("Setting up Firebase client")
     firebase_cred = credentials.Certificate(crypto_token_path)
     firebase_admin.initialize_app(firebase_cred)
     firebase_client = firestore.client()
 
-    phone_number_uuid_table = new_uuid_table(crypto_token_path, firebase_client)
-    rapidpro_lock = threading.Lock()
-    rapidpro_incoming.init(crypto_token_path, rapidpro_client, rapidpro_lock, phone_number_uuid_table)
-    rapidpro_outgoing.init(crypto_token_path, rapidpro_client, rapidpro_lock, phone_number_uuid_table)
+    phone_number_uuid_table = new_uuid_table(crypto_token_path, firebase_client, uuid_table_snapshot_path,
+                                             uuid_table_listen_for_changes, uuid_table_compact_cache,
+                                             uuid_table_lazy_cache_size, uuid_table_maintain_reverse_index,
+                                             uuid_table_load_partitions, uuid_table_load_partition_boundaries)
+    rapidpro_incoming.init(crypto_token_path, incoming_rapidpro_client, incoming_rapidpro_lock, phone_number_uuid_table,
+                           batch_max_messages=publish_batch_max_messages,
+                           batch_max_bytes=publish_batch_max_bytes,
+                           batch_max_latency=publish_batch_max_latency,
+                           max_page_duration=(datetime.timedelta(seconds=incoming_page_max_duration)
+                                              if incoming_page_max_duration is not None else None),
+                           target_page_messages=incoming_page_target_messages,
+                           # Skip messages received by both the webhook and the reconciliation poll
+                           dedup_window_size=10000 if webhook_port is not None else None,
+                           rp_session_pool=incoming_session_pool,
+                           rp_circuit_breaker=rapidpro_circuit_breaker)
+    # Wake the polling loop as soon as sending an outgoing message fails
+    rapidpro_outgoing.init(crypto_token_path, outgoing_rapidpro_client, outgoing_rapidpro_lock, phone_number_uuid_table,
+                           exception_callback=lambda e: wakeup_event.set(),
+                           rp_session_pool=outgoing_session_pool,
+                           max_concurrent_sends=outgoing_rapidpro_concurrency,
+                           ledger_path=outgoing_ledger_path,
+                           min_split_size=outgoing_min_split_size,
+                           quarantine_path=outgoing_quarantine_path,
+                           coalesce_window_sec=outgoing_coalesce_window,
+                           interactive_topic_name="sms-outgoing-interactive" if outgoing_interactive_lane else None,
+                           schedule_retries=outgoing_schedule_retries,
+                           rp_circuit_breaker=rapidpro_circuit_breaker)
+
+    if webhook_port is not None:
+        # Polling is only a slow sweep for messages that were not received via the webhook
+        if webhook_reconcile_interval is None:
+            webhook_reconcile_interval = DEFAULT_WEBHOOK_RECONCILE_INTERVAL
+        if poll_min_interval is None:
+            poll_min_interval = webhook_reconcile_interval
+        if poll_max_interval is None:
+            poll_max_interval = max(webhook_reconcile_interval, poll_min_interval)
+    poll_scheduler = AdaptivePollScheduler(
+        min_interval=poll_min_interval if poll_min_interval is not None else poll_scheduler.min_interval,
+        max_interval=poll_max_interval if poll_max_interval is not None else poll_scheduler.max_interval,
+        large_batch_size=(poll_large_batch_size if poll_large_batch_size is not None
+                          else poll_scheduler.large_batch_size))
+    log.info(f"Poll every {poll_scheduler.min_interval} to {poll_scheduler.max_interval} seconds, "
+             f"immediately after {poll_scheduler.large_batch_size} or more messages")
+
+    if webhook_port is not None:
+        rapidpro_webhook.init(webhook_host, webhook_port, token=webhook_token)
 
 
 def teardown():
+    log.info("teardown webhook")
+    rapidpro_webhook.teardown()
     log.info("teardown outgoing")
     rapidpro_outgoing.teardown()
+    for session_pool in rapidpro_session_pools:
+        session_pool.log_stats()
+        session_pool.close()
+    log.info(f"Rapid Pro rate limiter: {http_session_pool.rate_limiter_stats()}")
+    if rapidpro_circuit_breaker is not None:
+        log.info(f"Rapid Pro circuit breaker: {rapidpro_circuit_breaker.stats()}")
+    if phone_number_uuid_table is not None:
+        phone_number_uuid_table.stop_listening()
+        log.info("saving uuid table snapshot")
+        phone_number_uuid_table.save_snapshot(wait=True)
     log.info("teardown complete")
 
 
-def new_uuid_table(crypto_token_path, firebase_client):
+def new_rapidpro_client(name, domain, token, max_concurrent_requests=1, timeout=600):
+    """Return a tuple containing a new RapidPro client, a semaphore limiting the # of concurrent requests
+    made using that client, and a pool of keep-alive sessions for those requests
+
+    :param timeout: the # of seconds to wait for RapidPro to respond to a request
+    """
+    session_pool = SessionPool(name, pool_size=max_concurrent_requests, default_config=EndpointConfig(timeout=(10, timeout)))
+    return RapidProClient(domain, token), threading.BoundedSemaphore(max_concurrent_requests), session_pool
+
+
+def new_uuid_table(crypto_token_path, firebase_client, snapshot_path=None, listen_for_changes=False,
+                   compact_cache=False, lazy_cache_size=None, maintain_reverse_index=False, load_partitions=1,
+                   load_partition_boundaries=None):
     phone_number_uuid_table = FirestoreUuidTable(
         firebase_client,
         "uuid-table",
         "nook-phone-uuid-",
-        crypto_token_path
+        crypto_token_path,
+        snapshot_path=snapshot_path,
+        listen_for_changes=listen_for_changes,
+        compact_cache=compact_cache,
+        lazy_cache_size=lazy_cache_size,
+        maintain_reverse_index=maintain_reverse_index,
+        load_partitions=load_partitions,
+        load_partition_boundaries=load_partition_boundaries,
     )
     return phone_number_uuid_table
 
@@ -95,21 +213,52 @@ def write_last_update_time(sync_token_path, before_exec):
         json.dump({ "last_update_time": before_exec.isoformat() }, f)
 
 
-def idle_sleep():
-    for count in range(0, 50):
-        rapidpro_outgoing.check_exception()
-        time.sleep(0.1)
+def idle_wait(wait_time_sec):
+    """Wait for the specified # of seconds or until stop_polling() is called or an outgoing message fails"""
+    rapidpro_outgoing.check_exception()
+    if wait_time_sec > 0:
+        wakeup_event.wait(wait_time_sec)
+        wakeup_event.clear()
+    rapidpro_outgoing.check_exception()
 
 
-def run_inbound_polling(sync_token_path, idle_funct=idle_sleep):
+def stop_polling():
+    """Signal run_inbound_polling to exit after the current poll"""
+    global process_messages
+    process_messages = False
+    wakeup_event.set()
+
+
+def run_inbound_polling(sync_token_path, idle_funct=None):
+    """Repeatedly transfer new messages from RapidPro to pub/sub until stop_polling() is called.
+    Between polls, idle_funct() is called if specified,
+    otherwise wait for an interval determined by the # of messages returned by the last poll.
+    While RapidPro is unavailable, wait for the circuit breaker to allow a probe then poll again
+    rather than raising the RapidPro error. Any other exception is raised."""
     global process_messages
     last_update_time = read_last_update_time(sync_token_path)
     process_messages = True
     while process_messages:
         before_exec = datetime.datetime.now(datetime.timezone.utc)
-        rapidpro_incoming.transfer_messages(created_after_inclusive=last_update_time)
+        try:
+            if rapidpro_incoming.page_max_duration is not None and last_update_time is not None:
+                # Record progress after each page so that a restart resumes from the last page published
+                message_count = rapidpro_incoming.transfer_messages_in_pages(
+                    last_update_time, before_exec, lambda page_end: write_last_update_time(sync_token_path, page_end))
+            else:
+                message_count = rapidpro_incoming.transfer_messages(created_after_inclusive=last_update_time)
+                write_last_update_time(sync_token_path, before_exec)
+        except (CircuitOpenError,) + rapidpro_incoming.RAPIDPRO_UNAVAILABLE_ERRORS as e:
+            if rapidpro_incoming.circuit_breaker.state == CLOSED:
+                raise
+            # Resume from the last page that was published
+            last_update_time = read_last_update_time(sync_token_path)
+            wait_time_sec = rapidpro_incoming.circuit_breaker.seconds_until_probe()
+            log.warning(f"Poll failed while RapidPro is unavailable: {e}")
+            log.warning(f"  will poll again after {wait_time_sec} seconds")
+            idle_wait(wait_time_sec)
+            continue
         last_update_time = before_exec
-        write_last_update_time(sync_token_path, before_exec)
 
         # We should flush the system buffer so that current log entries can be seen in the console and subsequent file
         # but Python has this long standing potential deadlock when calling flush() in the presence of multiple threads.
@@ -117,8 +266,13 @@ def run_inbound_polling(sync_token_path, idle_funct=idle_sleep):
         # and https://bugs.python.org/issue6721
         #sys.stdout.flush()
 
-        idle_funct()
-        log.debug("idle_funct() completed")
+        if idle_funct is not None:
+            idle_funct()
+            log.debug("idle_funct() completed")
+        elif process_messages:
+            wait_time_sec = poll_scheduler.next_interval(message_count)
+            log.debug(f"Polled {message_count} messages, waiting {wait_time_sec} seconds")
+            idle_wait(wait_time_sec)
 
 
 class DefaultHelpArgParser(argparse.ArgumentParser):
@@ -142,10 +296,129 @@ if __name__ == '__main__':
                         help="Bucket containing RapidPro credentials token")
     required_named.add_argument("--last-update-token-path", required=True,
                         help="File storing a timestamp sync token used for incrementally polling messages from RapidPro")
+    parser.add_argument("--publish-batch-max-messages", type=int,
+                        help="Max # of incoming messages published to pub/sub in a single batch")
+    parser.add_argument("--publish-batch-max-bytes", type=int,
+                        help="Max # of bytes of incoming messages published to pub/sub in a single batch")
+    parser.add_argument("--publish-batch-max-latency", type=float,
+                        help="Max # of seconds to wait for a pub/sub batch to fill before publishing it")
+    parser.add_argument("--incoming-page-max-duration", type=float,
+                        help="Fetch incoming messages from RapidPro in pages each covering at most this many seconds, "
+                             "recording progress in the sync token after each page")
+    parser.add_argument("--incoming-page-target-messages", type=int,
+                        help="Adjust the period covered by each page of incoming messages to fetch approximately "
+                             "this many messages per page")
+    parser.add_argument("--poll-min-interval", type=float,
+                        help="# of seconds to wait before polling RapidPro again after a poll returned messages")
+    parser.add_argument("--poll-max-interval", type=float,
+                        help="Max # of seconds to wait before polling RapidPro again while polls return no messages")
+    parser.add_argument("--poll-large-batch-size", type=int,
+                        help="Poll RapidPro again immediately after a poll returned at least this many messages")
+    parser.add_argument("--webhook-port", type=int,
+                        help="Receive incoming messages from RapidPro webhooks on this port "
+                             "and only poll RapidPro as a slow sweep for messages that were missed")
+    parser.add_argument("--webhook-host", default="127.0.0.1",
+                        help="Interface on which to receive RapidPro webhooks, e.g. 0.0.0.0 for all interfaces. "
+                             "Requires --webhook-token unless this is a loopback interface")
+    parser.add_argument("--webhook-token",
+                        help="Token that RapidPro must include in each webhook request, "
+                             "either as an 'Authorization: Token <token>' header or a 'token' query parameter")
+    parser.add_argument("--webhook-reconcile-interval", type=float,
+                        help=f"# of seconds between polls of RapidPro when receiving messages via webhook, "
+                             f"default {DEFAULT_WEBHOOK_RECONCILE_INTERVAL}")
+    parser.add_argument("--incoming-rapidpro-concurrency", type=int, default=1,
+                        help="Max # of concurrent requests to RapidPro to fetch incoming messages")
+    parser.add_argument("--outgoing-rapidpro-concurrency", type=int, default=1,
+                        help="Max # of concurrent requests to RapidPro to send outgoing messages, "
+                             "i.e. the # of groups of recipients to which a message is sent at once")
+    parser.add_argument("--incoming-rapidpro-timeout", type=float, default=600,
+                        help="# of seconds to wait for RapidPro to respond to a request for incoming messages")
+    parser.add_argument("--outgoing-rapidpro-timeout", type=float, default=600,
+                        help="# of seconds to wait for RapidPro to respond to a request to send messages")
+    parser.add_argument("--rapidpro-max-requests-per-second", type=float,
+                        help="Max # of requests per second to RapidPro shared by incoming and outgoing. "
+                             "Regardless of this setting, all requests pause when RapidPro indicates its rate was exceeded")
+    parser.add_argument("--rapidpro-circuit-reset-timeout", type=float, default=60,
+                        help="After 10 failed requests to RapidPro within 5 minutes, stop making requests and "
+                             "probe RapidPro with a single request this many seconds later, "
+                             "rather than retrying every request and crashing")
+    parser.add_argument("--outgoing-ledger-path",
+                        help="Local SQLite database recording the progress of each broadcast so that a message "
+                             "redelivered after the adapter stops part way through sending it resumes where it left off")
+    parser.add_argument("--outgoing-min-split-size", type=int,
+                        help="If specified, a group of recipients that fails is split in half and retried down to "
+                             "groups of this size, and recipients in groups that still fail are quarantined so that "
+                             "the rest of the broadcast continues. Note that recipients may be sent a message twice "
+                             "if RapidPro reported a failure but actually sent the message")
+    parser.add_argument("--outgoing-quarantine-path",
+                        help="File to which a JSON line is appended for each group of quarantined recipients")
+    parser.add_argument("--outgoing-coalesce-window", type=float,
+                        help="If specified, consecutive outgoing messages with identical texts received within this "
+                             "many seconds (e.g. 0.3) are sent together to up to 15 recipients, "
+                             "so that failed sends are retried")
+    parser.add_argument("--outgoing-interactive-lane", action="store_true",
+                        help="Also receive outgoing messages from the sms-outgoing-interactive topic and send them "
+                             "independently of those from sms-outgoing so that they are not delayed by large broadcasts")
+    parser.add_argument("--outgoing-schedule-retries", action="store_true",
+                        help="Schedule retries of failed sends to a few recipients on a separate worker "
+                             "rather than delaying all other outgoing messages until the retry has completed")
+    parser.add_argument("--uuid-table-snapshot-path",
+                        help="Local file storing a snapshot of the uuid table used to speed up startup")
+    parser.add_argument("--uuid-table-listen-for-changes", action="store_true",
+                        help="Keep the cached uuid table up to date with mappings created by other processes")
+    parser.add_argument("--uuid-table-compact-cache", action="store_true",
+                        help="Cache the uuid table using less memory at the cost of slower lookups")
+    parser.add_argument("--uuid-table-lazy-cache-size", type=int,
+                        help="Rather than caching the entire uuid table at startup, read mappings as they are needed "
+                             "and cache at most this many recently used mappings")
+    parser.add_argument("--uuid-table-maintain-reverse-index", action="store_true",
+                        help="Store a uuid --> data document for each new mapping so that lazily cached uuid tables "
+                             "can look up uuids efficiently. Implied by --uuid-table-lazy-cache-size")
+    parser.add_argument("--uuid-table-load-partitions", type=int, default=1,
+                        help="Number of partitions of the uuid table to load in parallel when caching the entire table")
+    parser.add_argument("--uuid-table-load-partition-boundaries", type=lambda value: value.split(","),
+                        help="Comma separated document ids at which to split the uuid table into partitions "
+                             "that are loaded in parallel, e.g. tel:+2547,tel:+2548. "
+                             "By default the boundaries are chosen from the first and last document ids "
+                             "according to --uuid-table-load-partitions")
 
     args = parser.parse_args(sys.argv[1:])
-
-    setup(args.crypto_token_file, args.project_name, args.credentials_bucket_name, args.last_update_token_path)
+    if args.webhook_port is not None and args.webhook_token is None \
+            and not rapidpro_webhook.is_loopback(args.webhook_host):
+        parser.error(f"--webhook-token is required to receive webhooks on {args.webhook_host}")
+
+    setup(args.crypto_token_file, args.project_name, args.credentials_bucket_name, args.last_update_token_path,
+          publish_batch_max_messages=args.publish_batch_max_messages,
+          publish_batch_max_bytes=args.publish_batch_max_bytes,
+          publish_batch_max_latency=args.publish_batch_max_latency,
+          uuid_table_snapshot_path=args.uuid_table_snapshot_path,
+          uuid_table_listen_for_changes=args.uuid_table_listen_for_changes,
+          uuid_table_compact_cache=args.uuid_table_compact_cache,
+          uuid_table_lazy_cache_size=args.uuid_table_lazy_cache_size,
+          uuid_table_maintain_reverse_index=args.uuid_table_maintain_reverse_index,
+          uuid_table_load_partitions=args.uuid_table_load_partitions,
+          uuid_table_load_partition_boundaries=args.uuid_table_load_partition_boundaries,
+          incoming_page_max_duration=args.incoming_page_max_duration,
+          incoming_page_target_messages=args.incoming_page_target_messages,
+          poll_min_interval=args.poll_min_interval,
+          poll_max_interval=args.poll_max_interval,
+          poll_large_batch_size=args.poll_large_batch_size,
+          webhook_port=args.webhook_port,
+          webhook_host=args.webhook_host,
+          webhook_token=args.webhook_token,
+          webhook_reconcile_interval=args.webhook_reconcile_interval,
+          incoming_rapidpro_concurrency=args.incoming_rapidpro_concurrency,
+          outgoing_rapidpro_concurrency=args.outgoing_rapidpro_concurrency,
+          incoming_rapidpro_timeout=args.incoming_rapidpro_timeout,
+          outgoing_rapidpro_timeout=args.outgoing_rapidpro_timeout,
+          rapidpro_max_requests_per_second=args.rapidpro_max_requests_per_second,
+          outgoing_ledger_path=args.outgoing_ledger_path,
+          outgoing_min_split_size=args.outgoing_min_split_size,
+          outgoing_quarantine_path=args.outgoing_quarantine_path,
+          outgoing_coalesce_window=args.outgoing_coalesce_window,
+          outgoing_interactive_lane=args.outgoing_interactive_lane,
+          outgoing_schedule_retries=args.outgoing_schedule_retries,
+          rapidpro_circuit_reset_timeout=args.rapidpro_circuit_reset_timeout)
 
     try:
         run_inbound_polling(args.last_update_token_path)
@@ -1,11 +1,14 @@
-import json
-import requests
+import datetime
+import threading
 import time
+from collections import OrderedDict
 
+from google.cloud import pubsub_v1
 from requests.exceptions import ReadTimeout
-from temba_client.utils import request
-from temba_client.exceptions import TembaConnectionError, TembaHttpError
+from temba_client.exceptions import TembaConnectionError, TembaHttpError, TembaRateExceededError
 
+from lib import http_session_pool
+from lib.circuit_breaker import CLOSED, CircuitBreaker, CircuitOpenError
 from lib.pubsub_util import Publisher
 from lib.simple_logger import Logger
 
@@ -13,23 +16,52 @@ from lib.simple_logger import Logger
 log = None
 
 rapidpro_client = None
+# A lock or semaphore limiting the # of concurrent requests made using rapidpro_client
 rapidpro_lock = None
+# The http_session_pool.SessionPool used for requests made using rapidpro_client, or None for the default pool
+session_pool = None
 firebase_client = None
 phone_number_uuid_table = None
 publisher = None
 counter = None
 retry_wait_times = [0.1, 0.5, 2, 4, 8, 16, 32]
+# Tracks recent failures getting messages from RapidPro. This may be shared with rapidpro_outgoing.
+circuit_breaker = CircuitBreaker("rapidpro-incoming")
 
+# Messages published to pub/sub are grouped into batches by the pub/sub client.
+# A batch is sent when it reaches the max # of messages, the max # of bytes, or the max latency in seconds,
+# whichever comes first.
+publish_batch_max_messages = 100
+publish_batch_max_bytes = 1024 * 1024
+publish_batch_max_latency = 0.05
 
-def init(crypto_token_path, rp_client, rp_lock, lookup_table, topic_name ="sms-channel-topic", is_mock_rp=False):
-    global log, rapidpro_client, rapidpro_lock, phone_number_uuid_table, publisher, counter
+# The max # of seconds to wait for pub/sub to confirm each published message
+publish_timeout = 60
+
+# If not None, then transfer_messages_in_pages fetches messages from RapidPro in pages
+# each covering at most this period of time (a datetime.timedelta).
+# The period is adjusted so that each page contains approximately page_target_messages messages.
+page_max_duration = None
+page_min_duration = datetime.timedelta(seconds=1)
+page_target_messages = 1000
+
+# If not None, then the most recently published messages are remembered
+# so that a message received more than once (e.g. by both webhook and polling) is only published once.
+recently_published = None
+
+
+def init(crypto_token_path, rp_client, rp_lock, lookup_table, topic_name ="sms-channel-topic", is_mock_rp=False,
+         batch_max_messages=None, batch_max_bytes=None, batch_max_latency=None,
+         max_page_duration=None, target_page_messages=None, dedup_window_size=None, rp_session_pool=None,
+         rp_circuit_breaker=None):
+    global log, rapidpro_client, rapidpro_lock, session_pool, phone_number_uuid_table, publisher, counter
+    global circuit_breaker
+    global publish_batch_max_messages, publish_batch_max_bytes, publish_batch_max_latency
+    global page_max_duration, page_target_messages, recently_published
 
     if not is_mock_rp:
-        # HACK: Rewrite the request method used by the temba_client to provide a timeout
-        # First check that the original method's code hasn't changed by verifying its bytecode
-        assert request.__code__.co_code == original_request_function.__code__.co_code
-        # Then replace the code with the timeout method
-        request.__code__ = request_with_default_timeout.__code__
+        # Make requests using keep-alive sessions with a default timeout
+        http_session_pool.install()
 
     if log is None:
         if crypto_token_path is None:
@@ -39,27 +71,121 @@ def init(crypto_token_path, rp_client, rp_lock, lookup_table, topic_name ="sms-c
     log.info("Init incoming")
     rapidpro_client = rp_client
     rapidpro_lock = rp_lock
+    session_pool = rp_session_pool
     phone_number_uuid_table = lookup_table
-    publisher = Publisher(crypto_token_path, topic_name)
+    if rp_circuit_breaker is not None:
+        circuit_breaker = rp_circuit_breaker
+
+    if batch_max_messages is not None:
+        publish_batch_max_messages = batch_max_messages
+    if batch_max_bytes is not None:
+        publish_batch_max_bytes = batch_max_bytes
+    if batch_max_latency is not None:
+        publish_batch_max_latency = batch_max_latency
+    batch_settings = pubsub_v1.types.BatchSettings(
+        max_messages=publish_batch_max_messages,
+        max_bytes=publish_batch_max_bytes,
+        max_latency=publish_batch_max_latency,
+    )
+    log.info(f"Publish batch settings: {batch_settings}")
+    publisher = Publisher(crypto_token_path, topic_name, batch_settings=batch_settings)
+
+    if max_page_duration is not None:
+        page_max_duration = max_page_duration
+    if target_page_messages is not None:
+        page_target_messages = target_page_messages
+    if dedup_window_size is not None:
+        log.info(f"Skip messages matching the last {dedup_window_size} messages published")
+        recently_published = RecentMessages(dedup_window_size)
+    if page_max_duration is not None:
+        log.info(f"Fetch messages in pages of at most {page_max_duration}, target {page_target_messages} messages")
     log.info("Done")
 
 
 def transfer_messages(created_after_inclusive=None):
     log.info(f"Get messages")
+    new_messages = get_raw_messages(created_after_inclusive)
+    return publish_messages(new_messages)
+
+
+def transfer_messages_in_pages(created_after_inclusive, created_before_exclusive, checkpoint_funct):
+    """Fetch and publish the messages created in the specified period one page at a time, oldest page first,
+    so that memory use does not grow with the number of messages waiting to be transferred.
+
+    :param created_after_inclusive: the start of the period
+    :param created_before_exclusive: the end of the period
+    :param checkpoint_funct: a function called with the exclusive end time of each page
+                             once every message in that page has been published
+    :return: the number of messages published
+    """
+    process_count = 0
+    page_count = 0
+    for messages, page_end in iter_message_pages(created_after_inclusive, created_before_exclusive):
+        process_count += publish_messages(messages)
+        checkpoint_funct(page_end)
+        page_count += 1
+    log.info(f"Transferred {process_count} messages in {page_count} pages")
+    return process_count
+
+
+def iter_message_pages(created_after_inclusive, created_before_exclusive):
+    """Generator returning a tuple (messages, page_end) for each successive page of messages
+    created in the specified period, oldest page first, where page_end is the exclusive end time of the page.
+
+    RapidPro returns messages newest first, so rather than following RapidPro's cursor,
+    each page is fetched by a separate request for a period of time no longer than page_max_duration.
+    The period is halved after a page with more than page_target_messages messages
+    and doubled after a page with less than a quarter of page_target_messages.
+    """
+    page_duration = page_max_duration
+    page_start = created_after_inclusive
+    while page_start < created_before_exclusive:
+        page_end = min(page_start + page_duration, created_before_exclusive)
+        log.info(f"Get messages from {page_start} to {page_end}")
+        messages = get_raw_messages(page_start, page_end)
+        yield messages, page_end
 
-    new_messages = None
+        if len(messages) > page_target_messages:
+            page_duration = max(page_duration / 2, page_min_duration)
+        elif len(messages) < page_target_messages / 4:
+            page_duration = min(page_duration * 2, page_max_duration)
+        page_start = page_end
+
+
+# The exceptions raised when RapidPro cannot be reached or fails to respond,
+# which count as failures for the circuit breaker
+RAPIDPRO_UNAVAILABLE_ERRORS = (TembaConnectionError, TembaHttpError, ReadTimeout)
+
+
+def get_raw_messages(created_after_inclusive=None, created_before_exclusive=None):
+    """Return the messages created in the specified period, retrying if RapidPro cannot be reached.
+    Raises CircuitOpenError rather than making a request if the circuit breaker is open."""
     retry_count = 0
     while True:
+        if not circuit_breaker.allow_request():
+            raise CircuitOpenError(f"Not getting messages: {circuit_breaker.name} circuit breaker is open")
         try:
-            with rapidpro_lock:
-                new_messages = rapidpro_client.get_raw_messages(created_after_inclusive=created_after_inclusive)
-            break
-        except (TembaConnectionError, TembaHttpError, ReadTimeout) as e:
+            with rapidpro_lock, http_session_pool.use(session_pool):
+                messages = rapidpro_client.get_raw_messages(created_after_inclusive=created_after_inclusive,
+                                                            created_before_exclusive=created_before_exclusive)
+            circuit_breaker.record_success()
+            return messages
+        except RAPIDPRO_UNAVAILABLE_ERRORS as e:
             retry_exception = e
+            circuit_breaker.record_failure()
             # fall through to retry
+        except TembaRateExceededError as e:
+            retry_exception = e
+            # RapidPro is available, just busy
+            circuit_breaker.record_success()
+            # Slow down every request to RapidPro then fall through to retry
+            http_session_pool.throttle(e.retry_after)
 
-        if retry_count < len(retry_wait_times):
+        # Stop retrying once the circuit breaker has opened, leaving the caller to wait for it to allow a probe
+        if retry_count < len(retry_wait_times) and circuit_breaker.state == CLOSED:
             wait_time_sec = retry_wait_times[retry_count]
+            if isinstance(retry_exception, TembaRateExceededError):
+                wait_time_sec = max(wait_time_sec, retry_exception.retry_after)
             log.warning(f"Get messages failed: {retry_exception}")
             log.warning(f"  will retry after {wait_time_sec} seconds")
             time.sleep(wait_time_sec)
@@ -67,25 +193,61 @@ def transfer_messages(created_after_inclusive=None):
             continue
         raise retry_exception
 
+
+def publish_messages(messages):
+    """Publish the specified RapidPro messages to pub/sub and block until every message has been published.
+
+    The URNs for all of the messages are resolved to UUIDs in a single batch before publishing
+    so that a burst of messages from new phone numbers does not cost one lookup per message.
+
+    :param messages: a list of messages each having created_on, urn, direction, and text attributes
+    :return: the number of messages published
+    """
+    if recently_published is not None:
+        received_count = len(messages)
+        messages = recently_published.unpublished(messages)
+        if len(messages) < received_count:
+            log.info(f"Skipping {received_count - len(messages)} messages that have already been published")
+
+    if len(messages) == 0:
+        log.info(f"Processed 0 messages")
+        return 0
+
+    urn_to_uuid = phone_number_uuid_table.data_to_uuid_batch([message.urn for message in messages])
+
     process_count = 0
-    for message in new_messages:
+    publish_futures = []
+    for message in messages:
         created_on = message.created_on
         urn = message.urn
         direction = message.direction
         text = message.text
-        process_message(created_on, urn, direction, text)
+        publish_futures.append(process_message(created_on, urn, direction, text, urn_to_uuid[urn]))
         process_count += 1
+
+    # Wait for pub/sub to confirm that every message was published
+    # so that the caller does not advance the sync token past messages that were lost.
+    # If any publish failed, then the exception is raised here.
+    log.info(f"Waiting for {len(publish_futures)} messages to be published")
+    Publisher.wait_for_futures(publish_futures, timeout=publish_timeout)
     log.info(f"Processed {process_count} messages")
+    if recently_published is not None:
+        recently_published.add(messages)
     return process_count
 
 
-def process_message(created_on, urn, direction, text):
+def process_message(created_on, urn, direction, text, deidentified_phone_number=None):
+    """Publish the specified message and return a future for the publish result.
+    If deidentified_phone_number is not specified, then it is looked up from the urn."""
     log.info (f'Processing: {created_on}: {urn}, {direction},\t {text}')
 
-    id = phone_number_uuid_table.data_to_uuid(urn)
+    if deidentified_phone_number is None:
+        id = phone_number_uuid_table.data_to_uuid(urn)
+    else:
+        id = deidentified_phone_number
     # print (f'URN mapping: {urn} => {id}')
 
-    publisher.publish({
+    return publisher.publish({
         "action": "sms_from_rapidpro",
         "sms_raw": {
             "deidentified_phone_number": id,
@@ -96,21 +258,43 @@ def process_message(created_on, urn, direction, text):
     })
 
 
-def original_request_function(method, url, **kwargs):  # pragma: no cover
-    """
-    For the purposes of testing, all calls to requests.request go through here before JSON bodies are encoded. It's
-    easier to mock this and verify request data before it's encoded.
-    """
-    if "data" in kwargs:
-        kwargs["data"] = json.dumps(kwargs["data"])
+class RecentMessages(object):
+    """A thread safe record of the uuids of the most recently published messages.
 
-    return requests.request(method, url, **kwargs)
+    Messages are identified only by their RapidPro uuid. Messages without a uuid have no stable identity
+    (the same text may be sent again by the same contact), so they are never recorded or excluded."""
+    def __init__(self, max_size):
+        self._max_size = max_size
+        self._keys = OrderedDict()
+        self._lock = threading.Lock()
 
+    @staticmethod
+    def key(message):
+        """Return the RapidPro uuid of the message, or None if it does not have one"""
+        return getattr(message, "uuid", None)
 
-def request_with_default_timeout(method, url, **kwargs):
-    if "data" in kwargs:
-        kwargs["data"] = json.dumps(kwargs["data"])
-    if "timeout" not in kwargs:
-        kwargs["timeout"] = 600  # 10 mins
+    def unpublished(self, messages):
+        """Return the specified messages that have not been recorded as published, in their original order.
+        Messages that are being published concurrently are not excluded
+        so that a failure to publish on one thread never causes a message to be dropped on another."""
+        result = []
+        keys = set()
+        with self._lock:
+            for message in messages:
+                key = RecentMessages.key(message)
+                if key is None:
+                    result.append(message)
+                elif key not in self._keys and key not in keys:
+                    keys.add(key)
+                    result.append(message)
+        return result
 
-    return requests.request(method, url, **kwargs)
+    def add(self, messages):
+        """Record the specified messages as published"""
+        with self._lock:
+            for message in messages:
+                key = RecentMessages.key(message)
+                if key is not None:
+                    self._keys[key] = True
+            while len(self._keys) > self._max_size:
+                self._keys.popitem(last=False)
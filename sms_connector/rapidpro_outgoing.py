@@ -1,61 +1,294 @@
-import itertools
 import json
+import threading
 import time
+from collections import Counter
+from concurrent.futures import ALL_COMPLETED, FIRST_COMPLETED, FIRST_EXCEPTION, ThreadPoolExecutor, wait
 
 from requests.exceptions import HTTPError
 from temba_client.exceptions import TembaBadRequestError, TembaRateExceededError
 
+from lib import http_session_pool
+from lib.broadcast_ledger import BroadcastLedger
+from lib.broadcast_planner import BroadcastPlan
+from lib.circuit_breaker import CLOSED, CircuitBreaker, CircuitOpenError
+from lib.message_util import BULK_LANE, INTERACTIVE_LANE
 from lib.pubsub_util import Subscriber, MessageSequencer
+from lib.retry_queue import RetryQueue
 from lib.simple_logger import Logger
 from lib.utils import utcnow
 
 log = None
 phone_number_uuid_table = None
 rapidpro_client = None
+# A lock or semaphore limiting the # of concurrent requests made using rapidpro_client
 rapidpro_lock = None
+# The http_session_pool.SessionPool used for requests made using rapidpro_client, or None for the default pool
+session_pool = None
 subscriber = None
 sequencer = None
+# The subscriber and sequencer for the interactive lane, or None if all messages are received in the bulk lane.
+# Small sends are published to a separate topic so that they are not delayed by large broadcasts.
+interactive_subscriber = None
+interactive_sequencer = None
 counter = None
+# The lib.broadcast_ledger.BroadcastLedger recording the progress of each broadcast, or None
+ledger = None
 
 # There are times that rapidpro responds with an error, but has actually sent the SMS.
 # Because of this, we retry slowly so that a human can intervene before too many SMS have been sent.
 retry_wait_times = [4, 16, 32]
 
-# This contains timestamps for each of the last rapidpro call failures.
-last_failure_tokens = []
-
-
-def init(crypto_token_path, rp_client, rp_lock, lookup_table, topic_name = "sms-outgoing"):
-    global log, rapidpro_client, rapidpro_lock, phone_number_uuid_table, subscriber, sequencer, counter
+# Sends to at most this many URNs are retried. Larger sends are not retried because RapidPro sometimes
+# responds with an error but has actually sent the SMS, and resending to many people is worse than failing.
+max_retried_group_size = 15
+
+# If not None, then a RetryQueue on which the retries of sends of messages to at most max_retried_group_size ids
+# are scheduled, rather than sleeping until each retry is due, so that other messages are not delayed.
+retry_queue = None
+# The # of scheduled retries for each URN. Sends to these URNs wait until the retries complete
+# so that each recipient is sent messages in order.
+retrying_urns = Counter()
+retrying_condition = threading.Condition()
+
+# Tracks recent failures sending to RapidPro. This may be shared with rapidpro_incoming.
+circuit_breaker = CircuitBreaker("rapidpro-outgoing")
+# Set by teardown so that sends waiting for the circuit breaker or for a retry give up
+stopping = threading.Event()
+
+# The max # of times to retry sending to a group because RapidPro's rate limit was exceeded.
+# The message was not sent, so these retries are not limited by the size of the group.
+max_rate_exceeded_retries = 10
+
+# If not None, then a group of URNs that fails is split in half and the texts are sent to each half separately,
+# down to groups of this size. The URNs in groups of this size that still fail are quarantined,
+# i.e. logged and appended to the quarantine report, and the rest of the broadcast continues.
+min_split_group_size = None
+# The max # of URNs quarantined in a single broadcast before it fails, in case the failures are not due to bad URNs
+max_quarantined_urns = 100
+# The path of the file to which a JSON line is appended for each group of quarantined URNs, or None
+quarantine_report_path = None
+quarantine_report_lock = threading.Lock()
+
+# If not None, then consecutive send_messages messages with identical texts received within this many seconds
+# of the first are coalesced and sent together to up to coalesce_max_ids recipients,
+# e.g. so that the same reply sent to many conversations one after another is sent with one request per text.
+# Coalesced sends are also limited to max_retried_group_size recipients so that they are retried if they fail.
+# They are retried inline by send_messages rather than scheduled on the retry_queue,
+# because the coalesced messages are acked together once the send has completed.
+coalesce_window = None
+coalesce_max_ids = 100
+# A mapping of lane --> the _PendingSends waiting to be coalesced with the next message in that lane.
+# Each lane's entry is only accessed by process_message_impl, so access is serialized by the lane's sequencer.
+pending_sends = dict()
+
+# The max # of groups of URNs to which messages are sent concurrently.
+# Concurrent requests are also limited by rapidpro_lock.
+max_concurrent_group_sends = 1
+
+
+class BadRequestSendError(Exception):
+    """RapidPro rejected a request to send a message, e.g. because a URN is invalid"""
+    pass
+
+
+class _RetryLater(Exception):
+    """Raised by send_text_to_group instead of sleeping until the next retry is due"""
+    def __init__(self, retry_count, wait_time_sec):
+        super().__init__(f"Retry {retry_count} due in {wait_time_sec} seconds")
+        self.retry_count = retry_count
+        self.wait_time_sec = wait_time_sec
+
+
+class _ScheduledRetrySend(object):
+    """A message sent to a small group of URNs whose retries are scheduled on the retry queue"""
+    def __init__(self, message, lane, urns, texts):
+        self.message = message
+        self.lane = lane
+        self.urns = urns
+        self.texts = texts
+        self.text_index = 0
+        self.retry_count = 0
+        self.scheduled = False
+
+
+class Quarantine(object):
+    """The URNs quarantined while sending a single broadcast"""
+    def __init__(self, message_id):
+        self.message_id = message_id
+        self.urns = []
+        self._lock = threading.Lock()
+
+    def add(self, urns, texts, exception):
+        """Quarantine the URNs to which the texts could not be sent,
+        raising an exception if the broadcast has quarantined too many URNs"""
+        with self._lock:
+            if len(self.urns) + len(urns) > max_quarantined_urns:
+                raise Exception(f"Too many URNs quarantined, failing broadcast {self.message_id}") from exception
+            self.urns.extend(urns)
+        log.warning(f"Quarantining {len(urns)} URNs which were not sent {len(texts)} texts: {exception}")
+
+        if quarantine_report_path is not None:
+            entry = {
+                "time": utcnow().isoformat(),
+                "message_id": self.message_id,
+                "urns": urns,
+                "texts": texts,
+                "error": str(exception),
+            }
+            with quarantine_report_lock, open(quarantine_report_path, "a") as f:
+                f.write(json.dumps(entry) + "\n")
+
+
+class _PendingSends(object):
+    """send_messages messages with identical texts waiting to be sent together"""
+    def __init__(self, texts):
+        self.texts = texts
+        self.ids = []
+        self.messages = []
+        self.timer = None
+        self._id_set = set()
+
+    def can_add(self, ids, texts):
+        # Do not coalesce messages to the same recipient so that each is still sent every message
+        return texts == self.texts and len(self.ids) + len(ids) <= _coalesce_max_ids() \
+            and self._id_set.isdisjoint(ids)
+
+    def add(self, message, ids):
+        self.messages.append(message)
+        self.ids.extend(ids)
+        self._id_set.update(ids)
+
+
+class _FlushPendingSends(object):
+    """Passed to the sequencer once the coalescing window has elapsed
+    so that the pending sends are sent in order with the other messages"""
+    def __init__(self, pending):
+        self.pending = pending
+
+    def ack(self):
+        pass
+
+    def nack(self):
+        pass
+
+
+def init(crypto_token_path, rp_client, rp_lock, lookup_table, topic_name = "sms-outgoing", exception_callback=None,
+         rp_session_pool=None, max_concurrent_sends=None, ledger_path=None, min_split_size=None,
+         quarantine_path=None, coalesce_window_sec=None, interactive_topic_name=None, schedule_retries=False,
+         rp_circuit_breaker=None):
+    """Subscribe to outgoing messages and send them via RapidPro.
+    If exception_callback is specified, then it is called with the exception if sending a message fails.
+    If ledger_path is specified, then the progress of each broadcast is recorded in a local database at that path
+    so that a redelivered message resumes sending where it left off.
+    If min_split_size is specified, then groups that fail are split down to groups of this size
+    and the URNs that still fail are appended to the quarantine report at quarantine_path.
+    If coalesce_window_sec is specified, then consecutive messages with identical texts are coalesced,
+    see coalesce_window.
+    If interactive_topic_name is specified, then messages published to that topic are received and sent
+    independently of those published to topic_name so that they are not delayed by large broadcasts.
+    If schedule_retries, then retries of small sends are scheduled on a retry queue, see retry_queue.
+    If rp_circuit_breaker is specified, then it is used instead of circuit_breaker, e.g. to share it with incoming."""
+    global log, rapidpro_client, rapidpro_lock, session_pool, phone_number_uuid_table, subscriber, sequencer, counter
+    global max_concurrent_group_sends, ledger, min_split_group_size, quarantine_report_path, coalesce_window
+    global interactive_subscriber, interactive_sequencer, retry_queue, circuit_breaker
 
     if log is None:
         log = Logger(__name__)
 
     log.info("Init outgoing")
+    stopping.clear()
     rapidpro_client = rp_client
     rapidpro_lock = rp_lock
+    session_pool = rp_session_pool
     phone_number_uuid_table = lookup_table
-    sequencer = MessageSequencer(process_message_impl)
-    subscriber = Subscriber(crypto_token_path, topic_name, f"{topic_name}-subscription", sequencer.process_message)
+    if rp_circuit_breaker is not None:
+        circuit_breaker = rp_circuit_breaker
+    if max_concurrent_sends is not None:
+        max_concurrent_group_sends = max_concurrent_sends
+    log.info(f"Max concurrent group sends: {max_concurrent_group_sends}")
+    if min_split_size is not None:
+        min_split_group_size = min_split_size
+        quarantine_report_path = quarantine_path
+        log.info(f"Splitting failed groups down to {min_split_group_size} URNs, "
+                 f"quarantine report: {quarantine_report_path}")
+    if ledger_path is not None:
+        log.info(f"Recording broadcast progress in {ledger_path}")
+        ledger = BroadcastLedger(ledger_path)
+    if schedule_retries:
+        log.info(f"Scheduling retries of sends to at most {max_retried_group_size} URNs")
+        retry_queue = RetryQueue("rapidpro-outgoing-retries")
+    if coalesce_window_sec is not None:
+        coalesce_window = coalesce_window_sec
+        log.info(f"Coalescing sends received within {coalesce_window} seconds")
+    sequencer = MessageSequencer(process_message_impl, exception_callback=exception_callback,
+                                 name="rapidpro-outgoing-sequencer")
+    subscriber = Subscriber(crypto_token_path, topic_name, f"{topic_name}-subscription", sequencer.process_message,
+                            max_outstanding_messages=sequencer.max_queue_size)
+    if interactive_topic_name is not None:
+        log.info(f"Receiving interactive messages from {interactive_topic_name}")
+        interactive_sequencer = MessageSequencer(process_interactive_message_impl,
+                                                 exception_callback=exception_callback,
+                                                 name="rapidpro-outgoing-interactive-sequencer")
+        interactive_subscriber = Subscriber(crypto_token_path, interactive_topic_name,
+                                            f"{interactive_topic_name}-subscription",
+                                            interactive_sequencer.process_message,
+                                            max_outstanding_messages=interactive_sequencer.max_queue_size)
 
 
 def check_exception():
     """If there is a message processing exception, raise it."""
-    if sequencer.last_exception is not None:
-        raise sequencer.last_exception
+    for lane_sequencer in [sequencer, interactive_sequencer]:
+        if lane_sequencer is not None and lane_sequencer.last_exception is not None:
+            raise lane_sequencer.last_exception
 
 
 def teardown():
+    global ledger, interactive_subscriber, retry_queue
     log.info("canceling outgoing subscription")
     subscriber.cancel()
+    if interactive_subscriber is not None:
+        interactive_subscriber.cancel()
+        interactive_subscriber = None
+    # Interrupt sends waiting for RapidPro so that the sequencers can stop
+    stopping.set()
+    circuit_breaker.wake_waiters()
+    for lane_sequencer in [sequencer, interactive_sequencer]:
+        if lane_sequencer is not None:
+            # Wait for the message being processed, if any, and nack the messages that are queued
+            lane_sequencer.stop()
+            log.info(f"{lane_sequencer.name}: {lane_sequencer.stats()}")
+    if retry_queue is not None:
+        # Nack the messages waiting to be retried so that they are redelivered promptly
+        for send, in retry_queue.stop():
+            send.message.nack()
+        retry_queue = None
+    for pending in list(pending_sends.values()):
+        # Nack the messages waiting to be coalesced so that they are redelivered promptly
+        pending.timer.cancel()
+        for message in pending.messages:
+            message.nack()
+    pending_sends.clear()
+    if ledger is not None:
+        ledger.close()
+        ledger = None
     log.info("teardown complete")
 
 
-def process_message_impl(message):
+def process_interactive_message_impl(message):
+    """Called on a background thread once for each message in the interactive lane"""
+    process_message_impl(message, INTERACTIVE_LANE)
+
+
+def process_message_impl(message, lane=BULK_LANE):
     """Called on a background thread once for each message.
     It is the responsibility of the caller to gracefully handle exceptions"""
     log.debug(f"Processing: {message}")
 
+    if isinstance(message, _FlushPendingSends):
+        if message.pending is pending_sends.get(lane):
+            flush_pending_sends(lane)
+        return
+
     data_map = json.loads(message.data)['payload']
     log.notify(f"pubsub: processing {json.dumps(data_map)}")
 
@@ -74,91 +307,328 @@ def process_message_impl(message):
         #   "messages" : [ "🐱" ]
         # }
 
-        # TODO: Handle lookup failures
-        mappings = phone_number_uuid_table.uuid_to_data_batch(data_map["ids"])
-
-        # HACK: Filter out urns that don't start with "tel:+" as
-        # RapidPro sometimes crashes on sending messages to them
-        # These are working phone numbers though, and we can receive
-        # messages from them, so the issue has been raised with RapidPro
-        dirty_urns = list(mappings.values())
-
-        urns = []
-
-        for urn in dirty_urns:
-            # if not urn.find("tel:+") >= 0:
-                # print (f"WARNING: SKIPPING SEND TO bad {urn}")
-                # continue
-            urns.append(urn)
-
-        # Break into groups of 100
-        urn_groups = []
-        group_start = 0
-        group_end = 100
-        while group_end < len(urns):
-            urn_groups.append(urns[group_start:group_end])
-            group_start = group_end
-            group_end += 100
-        urn_groups.append(urns[group_start:])
-
-        # Assert that groups contain all of the original urns
-        assert set(urns) == set(itertools.chain.from_iterable(urn_groups))
-
-        group_num = 0
-        while len(urn_groups) > 0:
-            group_num += 1
-            urns = urn_groups.pop(0)
-            for text in data_map["messages"]:
-                retry_count = 0
-                while True:
-                    log.debug(f"sending group {group_num}: {len(urns)} sms")
-                    try:
-                        with rapidpro_lock:
-                            rapidpro_client.send_message_to_urns(text, urns, interrupt=True)
-                        log.debug(f"sent {len(urns)} sms")
-                        # in addition to notifying about the send_message command
-                        # notify for each URN so we can get a view of how many people are being messaged
-                        # send successful - exit loop
-                        break
-                    except HTTPError as e:
-                        retry_exception = e
-                        # fall through to retry
-                    except TembaRateExceededError as e:
-                        retry_exception = e
-                        # fall through to retry
-                    except TembaBadRequestError as e:
-                        # recast underlying exception so that the underlying details can be logged
-                        raise Exception(f"Exception sending sms: {e.errors}") from e
-
-                    last_failure_tokens.append(utcnow())
-
-                    # expire any tokens that are more than 5 minutes old
-                    expired_tokens = []
-                    now = utcnow()
-                    for token in last_failure_tokens:
-                        if (now - token).total_seconds() > (5 * 60):
-                            expired_tokens.append(token)
-
-                    for token in expired_tokens:
-                        log.warning(f"Removing failure token: {token.isoformat()}")
-                        last_failure_tokens.remove(token)
-
-                    # Do not retry large batch send-multis
-                    # or there are more than 10 exceptions in 5 min ... prefer to crash and cause a page
-                    if len(urns) <= 15 and retry_count < len(retry_wait_times) and len(last_failure_tokens) < 10:
-                        wait_time_sec = retry_wait_times[retry_count]
-                        log.warning(f"Send failed: {retry_exception}")
-                        log.warning(f"  will retry send after {wait_time_sec} seconds")
-                        time.sleep(wait_time_sec)
-                        retry_count += 1
-                        continue
-
-                    log.warning(f"Failing after {retry_count} retries, failure_tokens: {last_failure_tokens}")
-                    raise retry_exception
+        if ledger is not None and ledger.is_complete(message.message_id):
+            log.info(f"Skipping send_messages {message.message_id} which has already been sent")
+            message.ack()
+            return
+
+        if coalesce_window is not None and len(data_map["ids"]) <= _coalesce_max_ids():
+            coalesce_send(message, data_map["ids"], data_map["messages"], lane)
+            return
+        # Send any pending sends first so that messages are sent in the order in which they were received
+        flush_pending_sends(lane)
+
+        if retry_queue is not None and len(set(data_map["ids"])) <= max_retried_group_size:
+            send_with_scheduled_retries(message, lane, data_map["ids"], data_map["messages"])
+            return
 
+        # If this message was redelivered after the adapter stopped part way through sending it,
+        # then skip the groups and texts that have already been sent
+        progress = ledger.progress(message.message_id) if ledger is not None else None
+        send_messages(data_map["ids"], data_map["messages"], message.message_id, progress)
+
+        if ledger is not None:
+            ledger.complete(message.message_id)
         log.debug(f"Acking message")
         message.ack()
         log.info(f"Done send_messages")
         return
 
+    flush_pending_sends(lane)
     raise Exception(f"Unknown action: {action}")
+
+
+def send_messages(ids, texts, message_id, progress=None):
+    """Send each of the texts in order to each of the ids"""
+    # TODO: Handle lookup failures
+    # Groups of URNs are planned as they are sent so that very large broadcasts use little memory
+    plan = BroadcastPlan(phone_number_uuid_table, ids)
+    quarantine = Quarantine(message_id) if min_split_group_size is not None else None
+    send_to_groups(plan.groups(), texts, progress, quarantine)
+    if quarantine is not None and len(quarantine.urns) > 0:
+        log.warning(f"Sent to all but {len(quarantine.urns)} quarantined URNs")
+
+
+def send_with_scheduled_retries(message, lane, ids, texts):
+    """Send each of the texts in order to each of the ids, scheduling a retry on the retry queue if a send fails.
+    The message is acked once all of the texts have been sent, which may be after this function returns."""
+    urns = [urn for group in BroadcastPlan(phone_number_uuid_table, ids).groups() for urn in group]
+    wait_for_scheduled_retries(urns)
+    continue_scheduled_retry_send(_ScheduledRetrySend(message, lane, urns, texts))
+
+
+def continue_scheduled_retry_send(send):
+    """Send the remaining texts, scheduling a retry on the retry queue if sending fails and can be retried.
+    Return True if all of the texts have been sent and the message has been acked."""
+    abort_event = threading.Event()
+    while send.text_index < len(send.texts):
+        try:
+            send_text_to_group(1, send.urns, send.texts[send.text_index], abort_event,
+                               retry_count=send.retry_count, schedule_retry=True)
+        except _RetryLater as e:
+            if not send.scheduled:
+                send.scheduled = True
+                with retrying_condition:
+                    retrying_urns.update(send.urns)
+            send.retry_count = e.retry_count
+            retry_queue.schedule(e.wait_time_sec, retry_scheduled_send, send)
+            return False
+        send.text_index += 1
+        send.retry_count = 0
+
+    if ledger is not None:
+        ledger.complete(send.message.message_id)
+    send.message.ack()
+    return True
+
+
+def retry_scheduled_send(send):
+    """Called on the retry queue's worker thread when a retry is due"""
+    try:
+        done = continue_scheduled_retry_send(send)
+    except Exception as e:
+        # Fail in the same way as if the send had failed while processing the message
+        log.warning(f"Scheduled retry failed: {e}")
+        send.message.nack()
+        _lane_sequencer(send.lane).record_exception(e)
+        done = True
+    if done:
+        with retrying_condition:
+            retrying_urns.subtract(send.urns)
+            for urn in send.urns:
+                if retrying_urns[urn] <= 0:
+                    del retrying_urns[urn]
+            retrying_condition.notify_all()
+
+
+def wait_for_scheduled_retries(urns):
+    """Block until no retries are scheduled for any of the URNs so that each recipient is sent messages in order"""
+    with retrying_condition:
+        if len(retrying_urns) == 0 or retrying_urns.keys().isdisjoint(urns):
+            return
+        log.info(f"Waiting for scheduled retries to {len(urns)} URNs")
+        retrying_condition.wait_for(lambda: retrying_urns.keys().isdisjoint(urns))
+
+
+def _lane_sequencer(lane):
+    return interactive_sequencer if lane == INTERACTIVE_LANE else sequencer
+
+
+def _coalesce_max_ids():
+    """Return the max # of ids to which coalesced messages are sent together"""
+    return min(coalesce_max_ids, max_retried_group_size)
+
+
+def coalesce_send(message, ids, texts, lane=BULK_LANE):
+    """Add the message to the lane's pending sends, first sending the pending sends if the message cannot be added"""
+    pending = pending_sends.get(lane)
+    if pending is not None and not pending.can_add(ids, texts):
+        flush_pending_sends(lane)
+        pending = None
+    if pending is None:
+        pending = _PendingSends(texts)
+        pending.timer = threading.Timer(coalesce_window, _flush_after_coalesce_window, [pending, lane])
+        pending.timer.daemon = True
+        pending.timer.start()
+        pending_sends[lane] = pending
+    pending.add(message, ids)
+    log.debug(f"Coalesced {len(pending.messages)} {lane} messages to {len(pending.ids)} ids")
+    if len(pending.ids) >= _coalesce_max_ids():
+        flush_pending_sends(lane)
+
+
+def _flush_after_coalesce_window(pending, lane):
+    """Called on the timer thread once the coalescing window has elapsed"""
+    try:
+        _lane_sequencer(lane).process_message(_FlushPendingSends(pending))
+    except Exception as e:
+        # The sequencer has failed, so the pending sends are nacked by teardown rather than sent
+        log.warning(f"Not flushing {len(pending.messages)} coalesced {lane} messages after failure: {e}")
+
+
+def flush_pending_sends(lane=BULK_LANE):
+    """Send the texts in the lane's pending sends to all of their ids, then ack each of the coalesced messages"""
+    pending = pending_sends.pop(lane, None)
+    if pending is None:
+        return
+    pending.timer.cancel()
+
+    log.info(f"Sending {len(pending.messages)} coalesced send_messages to {len(pending.ids)} ids")
+    try:
+        send_messages(pending.ids, pending.texts, f"coalesced-{pending.messages[0].message_id}")
+    except Exception:
+        # The sequencer only nacks the message being processed, so nack each of the coalesced messages
+        for message in pending.messages:
+            message.nack()
+        raise
+    for message in pending.messages:
+        if ledger is not None:
+            ledger.complete(message.message_id)
+        message.ack()
+
+
+def send_to_groups(urn_groups, texts, progress=None, quarantine=None):
+    """Send each of the texts to each group of URNs, sending to up to max_concurrent_group_sends groups at once.
+    Each group is sent the texts in order. urn_groups may be a generator, from which the next group is only
+    requested once fewer sends are in progress. If sending to any group fails, then no further sends are started
+    and the first exception is raised once the sends in progress have completed.
+    If progress is specified, then it is a BroadcastProgress recording the texts sent to each group.
+    If quarantine is specified, then groups that fail are split and bad URNs are quarantined, see send_to_group."""
+    abort_event = threading.Event()
+
+    if max_concurrent_group_sends <= 1:
+        for group_num, urns in enumerate(urn_groups, 1):
+            send_to_group(group_num, urns, texts, abort_event, progress, quarantine)
+        return
+
+    # a mapping of future --> group number for each send in progress
+    in_progress = dict()
+    sent_count = 0
+    failed = []
+    with ThreadPoolExecutor(max_workers=max_concurrent_group_sends, thread_name_prefix="rapidpro-send") as executor:
+        try:
+            for group_num, urns in enumerate(urn_groups, 1):
+                in_progress[executor.submit(send_to_group, group_num, urns, texts, abort_event, progress, quarantine)] = group_num
+                if len(in_progress) >= max_concurrent_group_sends:
+                    sent_count += _wait_for_sends(in_progress, failed, FIRST_COMPLETED)
+                    if len(failed) > 0:
+                        break
+            while len(in_progress) > 0 and len(failed) == 0:
+                sent_count += _wait_for_sends(in_progress, failed, FIRST_EXCEPTION)
+        finally:
+            if len(in_progress) > 0:
+                # A send or planning the next group failed, so do not send any more texts
+                abort_event.set()
+                sent_count += _wait_for_sends(in_progress, failed, ALL_COMPLETED)
+
+    log.info(f"Sent to {sent_count} groups, {len(failed)} failed")
+    if len(failed) > 0:
+        for group_num, exception in failed:
+            log.warning(f"Send to group {group_num} failed: {exception}")
+        raise failed[0][1]
+
+
+def _wait_for_sends(in_progress, failed, return_when):
+    """Wait for sends in progress to complete as specified by return_when, removing them from in_progress
+    and appending (group number, exception) to failed for each send that failed.
+    Return the # of sends that succeeded."""
+    done, _ = wait(in_progress.keys(), return_when=return_when)
+    sent_count = 0
+    for future in done:
+        group_num = in_progress.pop(future)
+        if future.exception() is not None:
+            failed.append((group_num, future.exception()))
+        else:
+            sent_count += 1
+    return sent_count
+
+
+def send_to_group(group_num, urns, texts, abort_event, progress=None, quarantine=None):
+    """Send each of the texts in order to the specified URNs, retrying as appropriate.
+    If progress is specified, then the texts already sent to the group are skipped
+    and each text is recorded once it has been sent.
+    If quarantine is specified, then a group that fails is split as described by min_split_group_size."""
+    wait_for_scheduled_retries(urns)
+    texts_sent = progress.texts_sent(group_num) if progress is not None else 0
+    if texts_sent > 0:
+        log.info(f"Skipping {texts_sent} of {len(texts)} texts already sent to group {group_num}")
+    for text_index in range(texts_sent, len(texts)):
+        if abort_event.is_set():
+            log.warning(f"Not sending to group {group_num} because sending to another group failed")
+            return
+        can_split = quarantine is not None and len(urns) > min_split_group_size
+        try:
+            send_text_to_group(group_num, urns, texts[text_index], abort_event, can_split)
+        except (HTTPError, BadRequestSendError) as e:
+            # Groups are not split when RapidPro's rate limit is exceeded, because that is not caused by the URNs
+            if quarantine is None or abort_event.is_set() or circuit_breaker.state != CLOSED:
+                raise
+            # Send the remaining texts to each half of the group separately
+            split_and_send(group_num, urns, texts[text_index:], abort_event, quarantine, e)
+            if progress is not None:
+                progress.record_texts_sent(group_num, len(texts))
+            return
+
+        if progress is not None:
+            progress.record_texts_sent(group_num, text_index + 1)
+
+
+def split_and_send(group_num, urns, texts, abort_event, quarantine, exception):
+    """Called when sending the texts to a group of URNs failed with the specified exception.
+    Send the texts to each half of the group separately, quarantining the URNs in groups
+    that fail and are too small to split."""
+    if len(urns) <= min_split_group_size:
+        quarantine.add(urns, texts, exception)
+        return
+    middle = len(urns) // 2
+    log.warning(f"Send to group {group_num} of {len(urns)} sms failed, "
+                f"retrying as groups of {middle} and {len(urns) - middle}: {exception}")
+    for half in (urns[:middle], urns[middle:]):
+        send_to_group(group_num, half, texts, abort_event, quarantine=quarantine)
+
+
+def send_text_to_group(group_num, urns, text, abort_event, can_split=False, retry_count=0, schedule_retry=False):
+    """Send the text to the specified URNs, retrying as appropriate.
+    If can_split, then a failure is raised without retrying so that the group can be split instead.
+    If schedule_retry, then _RetryLater is raised rather than sleeping until a retry is due."""
+    rate_exceeded_count = 0
+    while True:
+        log.debug(f"sending group {group_num}: {len(urns)} sms")
+        # While RapidPro is unavailable, wait for the circuit breaker to allow a probe rather than failing the send
+        if not circuit_breaker.wait_until_allowed(stopping):
+            raise CircuitOpenError(f"Not sending to group {group_num}: stopping while RapidPro is unavailable")
+        try:
+            with rapidpro_lock, http_session_pool.use(session_pool):
+                rapidpro_client.send_message_to_urns(text, urns, interrupt=True)
+            log.debug(f"sent {len(urns)} sms")
+            # in addition to notifying about the send_message command
+            # notify for each URN so we can get a view of how many people are being messaged
+            # send successful - exit loop
+            circuit_breaker.record_success()
+            break
+        except HTTPError as e:
+            retry_exception = e
+            # fall through to retry
+        except TembaRateExceededError as e:
+            # RapidPro is available, just busy
+            circuit_breaker.record_success()
+            if rate_exceeded_count < max_rate_exceeded_retries and not abort_event.is_set():
+                # Slow down every request to RapidPro then retry
+                log.warning(f"Send to group {group_num} throttled: {e}")
+                if not http_session_pool.throttle(e.retry_after):
+                    time.sleep(e.retry_after)
+                rate_exceeded_count += 1
+                continue
+            retry_exception = e
+            # fall through to retry
+        except TembaBadRequestError as e:
+            circuit_breaker.record_success()
+            # recast underlying exception so that the underlying details can be logged
+            raise BadRequestSendError(f"Exception sending sms: {e.errors}") from e
+
+        # Failures of groups that will be split do not count towards opening the circuit breaker,
+        # unless this send was probing whether RapidPro is available again
+        if can_split and circuit_breaker.state == CLOSED and isinstance(retry_exception, HTTPError):
+            raise retry_exception
+
+        failure_count = circuit_breaker.record_failure()
+
+        # Do not retry large batch send-multis
+        # or the circuit breaker has opened because there are more than 10 exceptions in 5 min
+        # ... prefer to crash and cause a page
+        if len(urns) <= max_retried_group_size and retry_count < len(retry_wait_times) \
+                and circuit_breaker.state == CLOSED and not abort_event.is_set():
+            wait_time_sec = retry_wait_times[retry_count]
+            log.warning(f"Send failed: {retry_exception}")
+            if schedule_retry:
+                log.warning(f"  scheduling retry after {wait_time_sec} seconds")
+                raise _RetryLater(retry_count + 1, wait_time_sec)
+            log.warning(f"  will retry send after {wait_time_sec} seconds")
+            if stopping.wait(wait_time_sec):
+                raise retry_exception
+            retry_count += 1
+            continue
+
+        log.warning(f"Failing after {retry_count} retries, {failure_count} recent failures")
+        raise retry_exception
+
@@ -0,0 +1,259 @@
+import datetime
+import hmac
+import ipaddress
+import json
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+import rapidpro_incoming
+
+from lib.simple_logger import Logger
+
+log = None
+server = None
+server_thread = None
+flush_thread = None
+
+# The path to which RapidPro should POST message events
+WEBHOOK_PATH = "/messages"
+
+# If not None, then requests must include this token
+# either in an "Authorization: Token <token>" header or in a "token" query parameter
+auth_token = None
+
+# Messages received by the webhook are published in batches.
+# A batch is published when it reaches the max # of messages or the max latency in seconds, whichever comes first.
+batch_max_messages = 100
+batch_max_latency = 0.1
+
+# The max # of bytes in a single request
+max_request_bytes = 1024 * 1024
+
+# The max # of seconds a request waits for its messages to be published before failing
+response_timeout = 60
+
+_pending_requests = []
+_pending_condition = threading.Condition()
+_stopping = False
+
+
+class WebhookMessage(object):
+    """An incoming message received from a RapidPro webhook
+    with the same attributes as the messages returned by RapidProClient.get_raw_messages"""
+    def __init__(self, created_on, urn, direction, text, uuid=None):
+        self.created_on = created_on
+        self.urn = urn
+        self.direction = direction
+        self.text = text
+        self.uuid = uuid
+
+
+class _PendingRequest(object):
+    """The messages received in a single request, waiting to be published"""
+    def __init__(self, messages):
+        self.messages = messages
+        self.exception = None
+        self.published = threading.Event()
+
+
+def init(host, port, token=None, max_messages=None, max_latency=None):
+    """Start receiving RapidPro message events on a background thread
+    and publishing them via rapidpro_incoming.publish_messages.
+    rapidpro_incoming must be initialized before calling this function.
+
+    :param host: the interface on which to listen, e.g. "0.0.0.0" for all interfaces
+    :param port: the port on which to listen, or 0 for an arbitrary unused port
+    :param token: the token that requests must include or None if requests are not authenticated.
+                  Unauthenticated requests are only accepted when listening on a loopback interface.
+    """
+    global log, server, server_thread, flush_thread, auth_token, batch_max_messages, batch_max_latency, _stopping
+
+    if token is None and not is_loopback(host):
+        raise ValueError(f"A token is required to receive webhooks on a non-loopback interface: {host}")
+
+    if log is None:
+        log = Logger(__name__)
+
+    auth_token = token
+    if max_messages is not None:
+        batch_max_messages = max_messages
+    if max_latency is not None:
+        batch_max_latency = max_latency
+
+    _stopping = False
+    flush_thread = threading.Thread(target=_flush_pending_requests, name="rapidpro-webhook-flush", daemon=True)
+    flush_thread.start()
+
+    server = ThreadingHTTPServer((host, port), _WebhookRequestHandler)
+    server.daemon_threads = True
+    server_thread = threading.Thread(target=server.serve_forever, name="rapidpro-webhook", daemon=True)
+    server_thread.start()
+    log.info(f"Receiving RapidPro messages at http://{host}:{server.server_address[1]}{WEBHOOK_PATH}")
+
+
+def is_loopback(host):
+    """Return True if host is a loopback interface, i.e. one which cannot be reached from other machines"""
+    if host == "localhost":
+        return True
+    try:
+        return ipaddress.ip_address(host).is_loopback
+    except ValueError:
+        return False
+
+
+def teardown():
+    global server, server_thread, flush_thread, _stopping
+    if server is not None:
+        log.info("stopping webhook server")
+        server.shutdown()
+        server.server_close()
+        server_thread.join()
+        server = None
+        server_thread = None
+    if flush_thread is not None:
+        with _pending_condition:
+            _stopping = True
+            _pending_condition.notify_all()
+        flush_thread.join()
+        flush_thread = None
+
+
+def parse_messages(body):
+    """Return a list of WebhookMessages parsed from the JSON body of a request or raise ValueError if it is invalid.
+
+    The body may be a single event or a list of events. Each event is either
+    a RapidPro flow webhook payload containing "input" (or "contact") with the "urn" and "text" of the message,
+    or an object containing the "urn", "text", "created_on", and optional "direction" of the message.
+    Either may contain the "uuid" of the message, which is used to skip it when it is also fetched by a poll.
+
+    RapidPro's default flow webhook body does not include the time at which the message was created,
+    so the webhook body must add it to the input, e.g. "created_on", input.created_on.
+    Events without a valid created_on are rejected rather than published with an invented time.
+    """
+    try:
+        events = json.loads(body)
+    except ValueError as e:
+        raise ValueError(f"Invalid JSON: {e}")
+    if not isinstance(events, list):
+        events = [events]
+
+    messages = []
+    for event in events:
+        if not isinstance(event, dict):
+            raise ValueError(f"Expected an object, but found {type(event).__name__}")
+        msg = event.get("input")
+        if not isinstance(msg, dict):
+            msg = event
+
+        urn = msg.get("urn")
+        if urn is None and isinstance(event.get("contact"), dict):
+            urn = event["contact"].get("urn")
+        text = msg.get("text")
+        direction = msg.get("direction", "in")
+        created_on = msg.get("created_on", event.get("created_on"))
+        uuid = msg.get("uuid")
+
+        if not isinstance(urn, str) or len(urn) == 0:
+            raise ValueError("Missing urn")
+        if not isinstance(text, str):
+            raise ValueError("Missing text")
+        if direction not in ("in", "out"):
+            raise ValueError(f"Invalid direction: {direction}")
+        if created_on is None:
+            raise ValueError("Missing created_on")
+        try:
+            created_on = datetime.datetime.fromisoformat(str(created_on).replace("Z", "+00:00"))
+        except ValueError:
+            raise ValueError(f"Invalid created_on: {created_on}")
+        if created_on.tzinfo is None:
+            raise ValueError(f"created_on must include a timezone: {msg.get('created_on')}")
+        if uuid is not None and not isinstance(uuid, str):
+            raise ValueError(f"Invalid uuid: {uuid}")
+
+        messages.append(WebhookMessage(created_on, urn, direction, text, uuid))
+    return messages
+
+
+def _flush_pending_requests():
+    """Called on a background thread to publish the messages from pending requests in batches"""
+    while True:
+        with _pending_condition:
+            while len(_pending_requests) == 0 and not _stopping:
+                _pending_condition.wait()
+            if len(_pending_requests) == 0:
+                return
+
+            # Wait for more messages to arrive unless the batch is already full
+            _pending_condition.wait_for(
+                lambda: _stopping or sum(len(r.messages) for r in _pending_requests) >= batch_max_messages,
+                timeout=batch_max_latency)
+            requests = list(_pending_requests)
+            _pending_requests.clear()
+
+        messages = [message for request in requests for message in request.messages]
+        log.info(f"Publishing {len(messages)} messages from {len(requests)} webhook requests")
+        exception = None
+        try:
+            rapidpro_incoming.publish_messages(messages)
+        except Exception as e:
+            log.warning(f"Failed to publish webhook messages: {e}")
+            exception = e
+        for request in requests:
+            request.exception = exception
+            request.published.set()
+
+
+class _WebhookRequestHandler(BaseHTTPRequestHandler):
+    def do_POST(self):
+        url = urlparse(self.path)
+        if url.path != WEBHOOK_PATH:
+            self._respond(404, {"error": f"Unknown path: {url.path}"})
+            return
+        if not self._is_authorized(url):
+            self._respond(401, {"error": "Invalid token"})
+            return
+
+        content_length = int(self.headers.get("Content-Length", 0))
+        if content_length > max_request_bytes:
+            self._respond(413, {"error": f"Request exceeds {max_request_bytes} bytes"})
+            return
+        try:
+            messages = parse_messages(self.rfile.read(content_length))
+        except ValueError as e:
+            log.warning(f"Invalid webhook request: {e}")
+            self._respond(400, {"error": str(e)})
+            return
+
+        # Respond once the messages have been published so that RapidPro can retry the request if publishing fails
+        request = _PendingRequest(messages)
+        with _pending_condition:
+            _pending_requests.append(request)
+            _pending_condition.notify_all()
+        if not request.published.wait(response_timeout):
+            self._respond(503, {"error": "Timed out publishing messages"})
+        elif request.exception is not None:
+            self._respond(503, {"error": f"Failed to publish messages: {request.exception}"})
+        else:
+            self._respond(200, {"received": len(messages)})
+
+    def _is_authorized(self, url):
+        if auth_token is None:
+            return True
+        header = self.headers.get("Authorization", "")
+        if header.startswith("Token "):
+            token = header[len("Token "):]
+        else:
+            token = parse_qs(url.query).get("token", [""])[0]
+        return hmac.compare_digest(token.encode("utf-8"), auth_token.encode("utf-8"))
+
+    def _respond(self, status, body):
+        data = json.dumps(body).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, format, *args):
+        log.debug(f"{self.address_string()} {format % args}")
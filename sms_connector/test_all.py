@@ -2,10 +2,20 @@ import sys
 
 from lib import test_util
 
+from test_broadcast_ledger import BroadcastLedgerTestCase
+from test_broadcast_planner import BroadcastPlannerTestCase
+from test_circuit_breaker import CircuitBreakerTestCase
 from test_firestore_uuid_table import FirestoreUuidTableTestCase
+from test_http_session_pool import HttpSessionPoolTestCase
+from test_poll_scheduler import PollSchedulerTestCase
+from test_pubsub_util import KeyedMessageSequencerTestCase, MessageSequencerTestCase
 from test_rapidpro_adapter_cli import RapidProAdapterCliTestCase
 from test_rapidpro_incoming import RapidProIncomingTestCase
 from test_rapidpro_outgoing import RapidProOutgoingTestCase
+from test_rapidpro_webhook import RapidProWebhookTestCase
+from test_rate_limiter import RateLimiterTestCase
+from test_retry_queue import RetryQueueTestCase
+from test_uuid_cache import UuidCacheTestCase
 
 if __name__ == '__main__':
     argv = []
@@ -14,4 +24,15 @@ if __name__ == '__main__':
     argv.append(RapidProIncomingTestCase.__name__)
     argv.append(RapidProOutgoingTestCase.__name__)
     argv.append(RapidProAdapterCliTestCase.__name__)
+    argv.append(RapidProWebhookTestCase.__name__)
+    argv.append(UuidCacheTestCase.__name__)
+    argv.append(PollSchedulerTestCase.__name__)
+    argv.append(HttpSessionPoolTestCase.__name__)
+    argv.append(RateLimiterTestCase.__name__)
+    argv.append(BroadcastPlannerTestCase.__name__)
+    argv.append(BroadcastLedgerTestCase.__name__)
+    argv.append(RetryQueueTestCase.__name__)
+    argv.append(CircuitBreakerTestCase.__name__)
+    argv.append(MessageSequencerTestCase.__name__)
+    argv.append(KeyedMessageSequencerTestCase.__name__)
     test_util.setup_all_unittests(argv)
@@ -0,0 +1,50 @@
+import os
+import sys
+import tempfile
+import unittest
+
+from lib import test_util
+from lib.broadcast_ledger import BroadcastLedger
+
+
+class BroadcastLedgerTestCase(unittest.TestCase):
+    def test_progress(self):
+        test_util.print_test_header()
+        with tempfile.TemporaryDirectory() as temp_dir:
+            ledger_path = os.path.join(temp_dir, "ledger.sqlite")
+            ledger = BroadcastLedger(ledger_path)
+            progress = ledger.progress("message-1")
+            self.assertEqual(progress.texts_sent(1), 0)
+            progress.record_texts_sent(1, 2)
+            progress.record_texts_sent(2, 1)
+            ledger.progress("message-2").record_texts_sent(1, 1)
+            ledger.close()
+
+            # Progress survives reopening the ledger
+            ledger = BroadcastLedger(ledger_path)
+            progress = ledger.progress("message-1")
+            self.assertEqual([progress.texts_sent(group_num) for group_num in range(1, 4)], [2, 1, 0])
+            self.assertFalse(ledger.is_complete("message-1"))
+
+            ledger.complete("message-1")
+            self.assertTrue(ledger.is_complete("message-1"))
+            self.assertFalse(ledger.is_complete("message-2"))
+            self.assertEqual(ledger.progress("message-2").texts_sent(1), 1)
+            ledger.close()
+
+    def test_expire(self):
+        test_util.print_test_header()
+        with tempfile.TemporaryDirectory() as temp_dir:
+            ledger = BroadcastLedger(os.path.join(temp_dir, "ledger.sqlite"))
+            ledger.progress("message-1").record_texts_sent(1, 1)
+            ledger.complete("message-2")
+
+            ledger.retention_seconds = -1
+            ledger.expire()
+            self.assertEqual(ledger.progress("message-1").texts_sent(1), 0)
+            self.assertFalse(ledger.is_complete("message-2"))
+            ledger.close()
+
+
+if __name__ == '__main__':
+    test_util.setup_all_unittests(sys.argv)
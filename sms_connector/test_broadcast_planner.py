@@ -0,0 +1,69 @@
+import sys
+import unittest
+
+from lib import test_util
+from lib.broadcast_planner import BroadcastPlan
+
+
+class MockUuidTable(object):
+    """Maps each id to a URN derived from the id, recording the ids resolved by each batch lookup"""
+    def __init__(self, unknown_ids=()):
+        self.batches = []
+        self.unknown_ids = set(unknown_ids)
+
+    def uuid_to_data_batch(self, ids):
+        self.batches.append(list(ids))
+        for id in ids:
+            if id in self.unknown_ids:
+                raise LookupError(f"Failed to find data for uuid {id}")
+        return {id: f"tel:+{id}" for id in ids}
+
+
+class BroadcastPlannerTestCase(unittest.TestCase):
+    def test_groups(self):
+        test_util.print_test_header()
+        uuid_table = MockUuidTable()
+        ids = [str(index) for index in range(0, 25)] + ["3", "7", "3"]
+        plan = BroadcastPlan(uuid_table, ids, group_size=10, chunk_size=4)
+
+        groups = list(plan.groups())
+        self.assertEqual([len(group) for group in groups], [10, 10, 5])
+        self.assertEqual([urn for group in groups for urn in group], [f"tel:+{index}" for index in range(0, 25)])
+        self.assertEqual(plan.recipient_count, 25)
+        self.assertEqual(plan.duplicate_count, 3)
+        self.assertEqual(plan.group_count, 3)
+
+        # Each unique id is resolved once, in chunks
+        self.assertEqual([len(batch) for batch in uuid_table.batches], [4, 4, 4, 4, 4, 4, 1])
+
+    def test_groups_empty(self):
+        test_util.print_test_header()
+        plan = BroadcastPlan(MockUuidTable(), [])
+        self.assertEqual(list(plan.groups()), [])
+
+    def test_groups_lazy(self):
+        test_util.print_test_header()
+        uuid_table = MockUuidTable()
+        plan = BroadcastPlan(uuid_table, [str(index) for index in range(0, 30)], group_size=10, chunk_size=5)
+
+        # Every id is resolved before the first group, and later groups do not resolve the ids again
+        groups = plan.groups()
+        self.assertEqual(next(groups), [f"tel:+{index}" for index in range(0, 10)])
+        self.assertEqual(plan.group_count, 1)
+        self.assertEqual(len(uuid_table.batches), 6)
+        self.assertEqual(list(groups), [[f"tel:+{index}" for index in range(start, start + 10)] for start in (10, 20)])
+        self.assertEqual(len(uuid_table.batches), 6)
+
+    def test_groups_unknown_id(self):
+        test_util.print_test_header()
+        uuid_table = MockUuidTable(unknown_ids=["25"])
+        plan = BroadcastPlan(uuid_table, [str(index) for index in range(0, 30)], group_size=10, chunk_size=5)
+
+        # An unknown id fails the broadcast before any group is yielded
+        groups = plan.groups()
+        with self.assertRaises(LookupError):
+            next(groups)
+
+
+if __name__ == '__main__':
+    test_util.setup_all_unittests(sys.argv)
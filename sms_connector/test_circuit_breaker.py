@@ -0,0 +1,124 @@
+import sys
+import threading
+import time
+import unittest
+
+from lib import test_util
+from lib.circuit_breaker import CLOSED, HALF_OPEN, OPEN, CircuitBreaker
+
+
+class FakeClock(object):
+    """A clock which only advances when told to"""
+    def __init__(self):
+        self.now = 0.0
+
+    def time(self):
+        return self.now
+
+
+class CircuitBreakerTestCase(unittest.TestCase):
+    def test_open(self):
+        test_util.print_test_header()
+        clock = FakeClock()
+        breaker = CircuitBreaker("test", max_failures=3, window_sec=60, reset_timeout_sec=10, clock=clock.time)
+
+        # Failures outside the sliding window do not count
+        self.assertEqual(breaker.record_failure(), 1)
+        clock.now = 61
+        self.assertEqual(breaker.record_failure(), 1)
+        self.assertEqual(breaker.record_failure(), 2)
+        self.assertEqual(breaker.state, CLOSED)
+        self.assertTrue(breaker.allow_request())
+
+        # The breaker opens once the window contains max_failures failures
+        self.assertEqual(breaker.record_failure(), 3)
+        self.assertEqual(breaker.state, OPEN)
+        self.assertFalse(breaker.allow_request())
+        self.assertEqual(breaker.seconds_until_probe(), 10)
+        self.assertEqual(breaker.stats(), {"state": OPEN, "failures": 3, "open_count": 1, "rejected_count": 1})
+
+    def test_probe(self):
+        test_util.print_test_header()
+        clock = FakeClock()
+        breaker = CircuitBreaker("test", max_failures=1, reset_timeout_sec=10, clock=clock.time)
+        breaker.record_failure()
+
+        # After the reset timeout a single probe is allowed
+        clock.now = 10
+        self.assertTrue(breaker.allow_request())
+        self.assertEqual(breaker.state, HALF_OPEN)
+        self.assertFalse(breaker.allow_request())
+
+        # A failed probe opens the breaker again
+        breaker.record_failure()
+        self.assertEqual(breaker.state, OPEN)
+        self.assertFalse(breaker.allow_request())
+        self.assertEqual(breaker.open_count, 2)
+
+        # A successful probe closes the breaker and clears the failures
+        clock.now = 20
+        self.assertTrue(breaker.allow_request())
+        breaker.record_success()
+        self.assertEqual(breaker.state, CLOSED)
+        self.assertEqual(breaker.failure_count(), 0)
+        self.assertTrue(breaker.allow_request())
+        self.assertTrue(breaker.allow_request())
+
+    def test_probe_not_recorded(self):
+        test_util.print_test_header()
+        clock = FakeClock()
+        breaker = CircuitBreaker("test", max_failures=1, reset_timeout_sec=10, clock=clock.time)
+        breaker.record_failure()
+        clock.now = 10
+        self.assertTrue(breaker.allow_request())
+
+        # Another probe is allowed if the result of the last one is never recorded
+        clock.now = 15
+        self.assertFalse(breaker.allow_request())
+        self.assertEqual(breaker.seconds_until_probe(), 5)
+        clock.now = 20
+        self.assertTrue(breaker.allow_request())
+
+    def test_wait_until_allowed(self):
+        test_util.print_test_header()
+        breaker = CircuitBreaker("test", max_failures=1, reset_timeout_sec=0.3)
+        breaker.record_failure()
+        probes = []
+
+        def probe():
+            breaker.wait_until_allowed()
+            probes.append(time.monotonic())
+            breaker.record_success()
+
+        # Concurrent callers wait for the probe then continue once it succeeds
+        start = time.monotonic()
+        threads = [threading.Thread(target=probe) for _ in range(0, 3)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join(5)
+        self.assertEqual(len(probes), 3)
+        self.assertGreaterEqual(min(probes) - start, 0.25)
+        self.assertEqual(breaker.state, CLOSED)
+
+    def test_wait_until_allowed_stop(self):
+        test_util.print_test_header()
+        breaker = CircuitBreaker("test", max_failures=1, reset_timeout_sec=60)
+        breaker.record_failure()
+        stop_event = threading.Event()
+        results = []
+        thread = threading.Thread(target=lambda: results.append(breaker.wait_until_allowed(stop_event)))
+        thread.start()
+        time.sleep(0.2)
+
+        # Setting the stop event and waking the waiters ends the wait without allowing a request
+        stop_event.set()
+        breaker.wake_waiters()
+        thread.join(5)
+        self.assertFalse(thread.is_alive())
+        self.assertEqual(results, [False])
+        self.assertEqual(breaker.state, OPEN)
+
+
+if __name__ == '__main__':
+    test_util.setup_all_unittests(sys.argv)
@@ -1,4 +1,6 @@
+import os
 import sys
+import tempfile
 import unittest
 
 import firebase_admin
@@ -8,6 +10,7 @@ from firebase_admin import firestore
 from lib import firestore_uuid_table
 from lib import mock_firebase
 from lib import test_util
+from lib import uuid_table_snapshot
 
 
 live_firebase_client = None
@@ -30,7 +33,8 @@ class FirestoreUuidTableTestCase(unittest.TestCase):
         changes = self.firebase_client.changes()
         self.assertEqual(len(changes), 1)
         self.assertEqual(changes[0][0], f"tables/uuid-table/mappings/{telegram_data}")
-        self.assertEqual(changes[0][1], { "uuid": uuid_1 })
+        self.assertEqual(changes[0][1]["uuid"], uuid_1)
+        self.assertIn("timestamp", changes[0][1])
         changes.clear()
         transactions = self.firebase_client.completed_transactions()
         self.assertEqual(len(transactions), 1)
@@ -131,6 +135,233 @@ class FirestoreUuidTableTestCase(unittest.TestCase):
         self.assertEqual(changes[0][1]['uuid'], uuid_new)
         self.assertEqual(len(self.firebase_client.completed_transactions()), 1)
 
+    def test_data_to_uuid_batch_new_many(self):
+        self.setup_firebase_uuid_table()
+        self.uuid_table.cache_uuid_table()
+
+        # Simulate a mapping created by another process after the table was cached
+        other_data = 'tel:+0123456789-created-elsewhere'
+        other_uuid = 'nook-phone-uuid-created-elsewhere'
+        self.firebase_client.set_doc_data('tables/uuid-table/mappings', other_data, {'uuid': other_uuid})
+
+        new_data = [f'tel:+0123456789-new-{count}' for count in range(0, 5)]
+        original_batch_size = firestore_uuid_table.BATCH_SIZE
+        firestore_uuid_table.BATCH_SIZE = 2
+        try:
+            uuid_dict = self.uuid_table.data_to_uuid_batch(new_data + [other_data, 'tel:+0123456789-2'])
+        finally:
+            firestore_uuid_table.BATCH_SIZE = original_batch_size
+
+        self.assertEqual(len(uuid_dict), 7)
+        self.assertEqual(uuid_dict[other_data], other_uuid)
+        self.assertEqual(uuid_dict['tel:+0123456789-2'], 'nook-phone-uuid-125a04d0-24d3-4dc2-b40a-56d576583991')
+        self.assertEqual(len(set(uuid_dict.values())), 7)
+        changes = self.firebase_client.changes()
+        self.assertEqual(sorted([change[0] for change in changes]),
+                         sorted([f"tables/uuid-table/mappings/{data}" for data in new_data]))
+        for change in changes:
+            self.assertEqual(change[1]['uuid'], uuid_dict[change[0].split('/')[-1]])
+        # 5 new mappings in batches of 2
+        self.assertEqual(len(self.firebase_client.completed_transactions()), 3)
+
+        # The new mappings are cached in both directions
+        self.assertEqual(self.uuid_table.uuid_to_data(uuid_dict[new_data[0]]), new_data[0])
+        self.assertEqual(self.uuid_table.uuid_to_data(other_uuid), other_data)
+
+    def test_cache_uuid_table_snapshot(self):
+        self.setup_firebase_uuid_table()
+        with tempfile.TemporaryDirectory() as temp_dir:
+            snapshot_path = os.path.join(temp_dir, "uuid-table-snapshot.sqlite")
+
+            # The first time the table is cached, all mappings are loaded from firebase and a snapshot is written
+            mappings_path = 'tables/uuid-table/mappings'
+            self.firebase_client.set_doc_data(mappings_path, 'tel:+0123456789-before', {
+                'uuid': 'nook-phone-uuid-before',
+                'timestamp': firestore.SERVER_TIMESTAMP,
+            })
+            uuid_table = firestore_uuid_table.FirestoreUuidTable(
+                self.firebase_client, 'uuid-table', 'nook-phone-uuid-', None, snapshot_path=snapshot_path)
+            new_uuid = uuid_table.data_to_uuid('tel:+0123456789-new')
+            uuid_table._snapshot.wait()
+            self.assertTrue(os.path.exists(snapshot_path))
+
+            # Simulate mappings that change after the snapshot was written.
+            # Mappings without a timestamp cannot be found using the high water mark.
+            self.firebase_client.set_doc_data(mappings_path, 'tel:+0123456789-after', {
+                'uuid': 'nook-phone-uuid-after',
+                'timestamp': firestore.SERVER_TIMESTAMP,
+            })
+            self.firebase_client.set_doc_data(mappings_path, 'tel:+0123456789-no-timestamp', {
+                'uuid': 'nook-phone-uuid-no-timestamp',
+            })
+
+            # The next time, the snapshot is loaded along with mappings changed since the snapshot was written
+            uuid_table = firestore_uuid_table.FirestoreUuidTable(
+                self.firebase_client, 'uuid-table', 'nook-phone-uuid-', None, snapshot_path=snapshot_path)
+            uuid_table.cache_uuid_table()
+            uuid_table._snapshot.wait()
+            self.assertEqual(uuid_table.uuid_to_data('nook-phone-uuid-125a04d0-24d3-4dc2-b40a-56d576583991'),
+                             'tel:+0123456789-2')
+            self.assertEqual(uuid_table.uuid_to_data(new_uuid), 'tel:+0123456789-new')
+            self.assertEqual(uuid_table.uuid_to_data('nook-phone-uuid-after'), 'tel:+0123456789-after')
+            self.assertIsNone(uuid_table._cache.get_uuid('tel:+0123456789-no-timestamp'))
+
+            # The rewritten snapshot contains the new mappings
+            data_to_uuid, high_water_mark = uuid_table._snapshot.load()
+            self.assertEqual(data_to_uuid['tel:+0123456789-after'], 'nook-phone-uuid-after')
+            self.assertIsNotNone(high_water_mark)
+            self.assertEqual(high_water_mark, uuid_table._high_water_mark.isoformat())
+
+            # Looking up a uuid that is not cached reloads the entire table
+            self.assertEqual(uuid_table.uuid_to_data('nook-phone-uuid-no-timestamp'), 'tel:+0123456789-no-timestamp')
+            with self.assertRaises(LookupError):
+                uuid_table.uuid_to_data('nook-phone-uuid-unknown')
+            uuid_table._snapshot.wait()
+            data_to_uuid, high_water_mark = uuid_table._snapshot.load()
+            self.assertEqual(data_to_uuid['tel:+0123456789-no-timestamp'], 'nook-phone-uuid-no-timestamp')
+
+    def test_cache_uuid_table_snapshot_corrupt(self):
+        self.setup_firebase_uuid_table()
+        with tempfile.TemporaryDirectory() as temp_dir:
+            snapshot_path = os.path.join(temp_dir, "uuid-table-snapshot.sqlite")
+            with open(snapshot_path, "w") as f:
+                f.write("not a sqlite database")
+
+            # Fall back to loading all mappings from firebase
+            uuid_table = firestore_uuid_table.FirestoreUuidTable(
+                self.firebase_client, 'uuid-table', 'nook-phone-uuid-', None, snapshot_path=snapshot_path)
+            uuid_table.cache_uuid_table()
+            uuid_table._snapshot.wait()
+            self.assertEqual(len(uuid_table._cache), 12)
+            data_to_uuid, high_water_mark = uuid_table._snapshot.load()
+            self.assertEqual(len(data_to_uuid), 12)
+
+    def test_listen_for_changes(self):
+        self.setup_firebase_uuid_table()
+        uuid_table = firestore_uuid_table.FirestoreUuidTable(
+            self.firebase_client, 'uuid-table', 'nook-phone-uuid-', None, listen_for_changes=True)
+        new_uuid = uuid_table.data_to_uuid('tel:+0123456789-new')
+        self.assertIsNotNone(uuid_table._watch)
+
+        # Simulate a mapping created by another process
+        uuid_table._watch.push_change('tel:+0123456789-other-process', {
+            'uuid': 'nook-phone-uuid-other-process',
+            'timestamp': firestore.SERVER_TIMESTAMP,
+        })
+        self.assertEqual(uuid_table.uuid_to_data('nook-phone-uuid-other-process'), 'tel:+0123456789-other-process')
+        self.assertEqual(uuid_table.data_to_uuid('tel:+0123456789-other-process'), 'nook-phone-uuid-other-process')
+        self.assertEqual(uuid_table.uuid_to_data(new_uuid), 'tel:+0123456789-new')
+        self.assertEqual(len(self.firebase_client.completed_transactions()), 1)
+
+        uuid_table.stop_listening()
+        self.assertIsNone(uuid_table._watch)
+
+    def test_compact_cache(self):
+        self.setup_firebase_uuid_table()
+        uuid_table = firestore_uuid_table.FirestoreUuidTable(
+            self.firebase_client, 'uuid-table', 'nook-phone-uuid-', None, compact_cache=True)
+        self.assertEqual(uuid_table.data_to_uuid('tel:+0123456789-2'), 'nook-phone-uuid-125a04d0-24d3-4dc2-b40a-56d576583991')
+        self.assertEqual(uuid_table.uuid_to_data('nook-phone-uuid-f58f1a88-68d7-402f-b0b3-2d2dbc67c91f'), 'tel:+0123456789-12')
+        new_uuid = uuid_table.data_to_uuid('tel:+0123456789-new')
+        self.assertEqual(uuid_table.uuid_to_data(new_uuid), 'tel:+0123456789-new')
+        self.assertEqual(len(uuid_table._cache), 13)
+        self.assertEqual(len(self.firebase_client.completed_transactions()), 1)
+
+    def test_cache_uuid_table_partitions(self):
+        self.setup_firebase_uuid_table()
+        self.uuid_table.cache_uuid_table()
+        expected_mappings = dict(self.uuid_table._cache.items())
+        self.assertEqual(len(expected_mappings), 12)
+
+        for load_partitions, boundaries in [(4, None), (1, ['tel:+0123456789-2', 'tel:+0123456789-5', 'tel:+9'])]:
+            uuid_table = firestore_uuid_table.FirestoreUuidTable(
+                self.firebase_client, 'uuid-table', 'nook-phone-uuid-', None,
+                load_partitions=load_partitions, load_partition_boundaries=boundaries)
+            uuid_table.cache_uuid_table()
+            self.assertEqual(dict(uuid_table._cache.items()), expected_mappings)
+        self.assertEqual(len(self.firebase_client.completed_transactions()), 0)
+
+    def test_sample_partition_boundaries(self):
+        self.setup_firebase_uuid_table()
+        uuid_table = firestore_uuid_table.FirestoreUuidTable(
+            self.firebase_client, 'uuid-table', 'nook-phone-uuid-', None, load_partitions=4)
+        # The boundaries split the digits which follow the prefix shared by the first and last document ids
+        boundaries = uuid_table._sample_partition_boundaries()
+        self.assertEqual(len(boundaries), 3)
+        self.assertTrue(all(boundary.startswith('tel:+0123456789-') for boundary in boundaries))
+
+    def test_partition_boundaries(self):
+        self.assertEqual(firestore_uuid_table.partition_boundaries('tel:+254700000001', 'tel:+254799999999', 1), [])
+        # A table of phone numbers from a single country is split on the digits after the country code
+        self.assertEqual(firestore_uuid_table.partition_boundaries('tel:+254700000001', 'tel:+254799999999', 4),
+                         ['tel:+2547250000', 'tel:+2547500000', 'tel:+2547750000'])
+        self.assertEqual(firestore_uuid_table.partition_boundaries('tel:+1', 'tel:+9', 4),
+                         ['tel:+325000', 'tel:+550000', 'tel:+775000'])
+        self.assertEqual(len(firestore_uuid_table.partition_boundaries('tel:+0', 'tel:+9', 2000000)), 999999)
+        # Ids which do not continue with digits after the shared prefix are not split
+        self.assertEqual(firestore_uuid_table.partition_boundaries('tel:+1', 'whatsapp:1', 4), [])
+
+    def test_lazy_cache(self):
+        self.setup_firebase_uuid_table()
+        uuid_table = firestore_uuid_table.FirestoreUuidTable(
+            self.firebase_client, 'uuid-table', 'nook-phone-uuid-', None, lazy_cache_size=2)
+        uuid_table.cache_uuid_table()
+        self.assertEqual(len(uuid_table._cache), 0)
+
+        # Existing mappings are read as they are needed without a transaction
+        self.assertEqual(uuid_table.data_to_uuid('tel:+0123456789-2'), 'nook-phone-uuid-125a04d0-24d3-4dc2-b40a-56d576583991')
+        self.assertEqual(len(self.firebase_client.completed_transactions()), 0)
+
+        # New mappings are stored along with a reverse index entry
+        new_uuid = uuid_table.data_to_uuid('tel:+0123456789-new')
+        changes = self.firebase_client.changes()
+        self.assertEqual(len(changes), 2)
+        self.assertEqual(changes[0][0], 'tables/uuid-table/mappings/tel:+0123456789-new')
+        self.assertEqual(changes[1], (f'tables/uuid-table/reverse-mappings/{new_uuid}', {'data': 'tel:+0123456789-new'}))
+        self.assertEqual(len(self.firebase_client.completed_transactions()), 1)
+
+        # Only the most recently used mappings are cached
+        uuid_table.data_to_uuid('tel:+0123456789-12')
+        self.assertEqual(len(uuid_table._cache), 2)
+        self.assertIsNone(uuid_table._cache.get_uuid('tel:+0123456789-2'))
+
+        # UUIDs are found using the reverse index, falling back to querying the mappings
+        other_table = firestore_uuid_table.FirestoreUuidTable(
+            self.firebase_client, 'uuid-table', 'nook-phone-uuid-', None, lazy_cache_size=10)
+        uuid_1 = 'nook-phone-uuid-125a04d0-24d3-4dc2-b40a-56d576583991'
+        self.assertEqual(other_table.uuid_to_data_batch([new_uuid, uuid_1]),
+                         {new_uuid: 'tel:+0123456789-new', uuid_1: 'tel:+0123456789-2'})
+        self.assertEqual(other_table.uuid_to_data(uuid_1), 'tel:+0123456789-2')
+        with self.assertRaises(LookupError):
+            other_table.uuid_to_data(uuid_1 + '-unknown')
+
+    def test_reverse_index_batches(self):
+        self.setup_firebase_uuid_table()
+        uuid_table = firestore_uuid_table.FirestoreUuidTable(
+            self.firebase_client, 'uuid-table', 'nook-phone-uuid-', None, lazy_cache_size=100)
+
+        # Each new mapping is written along with a reverse index entry, so half as many are created per transaction
+        new_data = [f'tel:+0123456789-new-{count}' for count in range(0, 5)]
+        original_batch_size = firestore_uuid_table.BATCH_SIZE
+        firestore_uuid_table.BATCH_SIZE = 4
+        try:
+            uuid_dict = uuid_table.data_to_uuid_batch(new_data)
+        finally:
+            firestore_uuid_table.BATCH_SIZE = original_batch_size
+        self.assertEqual(len(uuid_dict), 5)
+        self.assertEqual(len(self.firebase_client.changes()), 10)
+        self.assertEqual(len(self.firebase_client.completed_transactions()), 3)
+
+        # Mappings without a reverse index entry are queried in batches
+        other_table = firestore_uuid_table.FirestoreUuidTable(
+            self.firebase_client, 'uuid-table', 'nook-phone-uuid-', None, lazy_cache_size=100)
+        self.uuid_table.cache_uuid_table()
+        existing = dict(list(self.uuid_table._cache.items())[0:12])
+        self.assertEqual(len(existing), 12)
+        self.assertEqual(other_table.uuid_to_data_batch(list(existing.values()) + [uuid_dict[new_data[0]]]),
+                         {**{data_uuid: data for data, data_uuid in existing.items()},
+                          uuid_dict[new_data[0]]: new_data[0]})
+
     def test_uuid_to_data_existing(self):
         self.setup_firebase_uuid_table()
         uuid = 'nook-phone-uuid-125a04d0-24d3-4dc2-b40a-56d576583991'
@@ -189,6 +420,7 @@ class FirestoreUuidTableTestCase(unittest.TestCase):
     def setup_firebase_uuid_table(self):
         test_util.print_test_header()
         firestore_uuid_table.log = test_util.TestLogger(__name__)
+        uuid_table_snapshot.log = firestore_uuid_table.log
         self.firebase_client = mock_firebase.MockFirestoreClient('testdata/uuid_mappings.json')
         self.uuid_table = firestore_uuid_table.FirestoreUuidTable(self.firebase_client, 'uuid-table', 'nook-phone-uuid-', None)
 
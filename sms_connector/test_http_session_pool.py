@@ -0,0 +1,125 @@
+import datetime
+import json
+import sys
+import threading
+import unittest
+from email.utils import format_datetime
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import temba_client.base
+import temba_client.utils
+from temba_client.v2 import TembaClient
+
+from lib import http_session_pool
+from lib import test_util
+from lib.http_session_pool import EndpointConfig, SessionPool
+from lib.utils import utcnow
+
+
+class _MockRapidProHandler(BaseHTTPRequestHandler):
+    # Keep connections alive between requests
+    protocol_version = "HTTP/1.1"
+
+    def do_GET(self):
+        self.server.request_paths.append(self.path)
+        self._respond({"next": None, "previous": None, "results": []})
+
+    def do_POST(self):
+        body = json.loads(self.rfile.read(int(self.headers["Content-Length"])))
+        self.server.request_paths.append(self.path)
+        self.server.request_bodies.append(body)
+        self._respond({"id": 1, "urns": body["urns"], "contacts": [], "groups": [], "text": body["text"]})
+
+    def _respond(self, body):
+        data = json.dumps(body).encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class HttpSessionPoolTestCase(unittest.TestCase):
+    def test_connection_reuse(self):
+        test_util.print_test_header()
+        pool = SessionPool("test", pool_size=2, default_config=EndpointConfig(timeout=5))
+        for _ in range(0, 5):
+            response = pool.request("get", f"{self.server_url}/api/v2/messages.json")
+            self.assertEqual(response.status_code, 200)
+        pool.request("get", f"{self.server_url}/api/v2/contacts.json")
+
+        self.assertEqual(pool.stats(), {
+            "messages": {"requests": 5, "connections": 1, "reused": 4},
+            "contacts": {"requests": 1, "connections": 1, "reused": 0},
+        })
+        pool.close()
+
+    def test_temba_client_requests(self):
+        test_util.print_test_header()
+        default_pool = SessionPool("default")
+        other_pool = SessionPool("other")
+        http_session_pool.install(default_pool)
+        client = TembaClient(self.server_url, "token")
+
+        client.get_messages().all()
+        client.create_broadcast("hello", urns=["tel:+0123456789"])
+        with http_session_pool.use(other_pool):
+            client.create_broadcast("hello again", urns=["tel:+0123456789"])
+            client.create_broadcast("hello once more", urns=["tel:+0123456789"])
+
+        # JSON bodies are encoded as by the temba client
+        self.assertEqual([body["text"] for body in self.server.request_bodies],
+                         ["hello", "hello again", "hello once more"])
+        self.assertEqual(default_pool.stats(), {
+            "messages": {"requests": 1, "connections": 1, "reused": 0},
+            "broadcasts": {"requests": 1, "connections": 1, "reused": 0},
+        })
+        self.assertEqual(other_pool.stats(), {
+            "broadcasts": {"requests": 2, "connections": 1, "reused": 1},
+        })
+
+    def test_endpoint_name(self):
+        test_util.print_test_header()
+        self.assertEqual(http_session_pool.endpoint_name("https://textit.in/api/v2/messages.json?after=x"), "messages")
+        self.assertEqual(http_session_pool.endpoint_name("https://textit.in/api/v2/broadcasts.json"), "broadcasts")
+
+    def test_retry_after_seconds(self):
+        test_util.print_test_header()
+        self.assertEqual(http_session_pool.retry_after_seconds("30"), 30)
+        self.assertIsNone(http_session_pool.retry_after_seconds(None))
+        self.assertIsNone(http_session_pool.retry_after_seconds("not a date"))
+        self.assertEqual(http_session_pool.retry_after_seconds("Wed, 21 Oct 2015 07:28:00 GMT"), 0)
+        retry_time = utcnow() + datetime.timedelta(seconds=120)
+        self.assertAlmostEqual(http_session_pool.retry_after_seconds(format_datetime(retry_time, usegmt=True)),
+                               120, delta=2)
+
+    def test_read_timeouts_not_retried(self):
+        test_util.print_test_header()
+        retry = EndpointConfig().max_retries
+        self.assertEqual(retry.total, 2)
+        self.assertEqual(retry.read, 0)
+
+    ############ Test Helper Methods ############################################################
+
+    def setUp(self):
+        self.original_request = temba_client.base.request
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), _MockRapidProHandler)
+        self.server.daemon_threads = True
+        self.server.request_paths = []
+        self.server.request_bodies = []
+        self.server_thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self.server_thread.start()
+        self.server_url = f"http://127.0.0.1:{self.server.server_address[1]}"
+
+    def tearDown(self):
+        temba_client.base.request = self.original_request
+        http_session_pool._default_pool = None
+        self.server.shutdown()
+        self.server.server_close()
+
+
+if __name__ == '__main__':
+    test_util.setup_all_unittests(sys.argv)
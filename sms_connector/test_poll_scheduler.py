@@ -0,0 +1,26 @@
+import sys
+import unittest
+
+from lib import test_util
+from lib.poll_scheduler import AdaptivePollScheduler
+
+
+class PollSchedulerTestCase(unittest.TestCase):
+    def test_next_interval(self):
+        test_util.print_test_header()
+        scheduler = AdaptivePollScheduler(min_interval=1, max_interval=10, large_batch_size=100)
+
+        # Back off while polls are empty
+        self.assertEqual([scheduler.next_interval(0) for _ in range(0, 6)], [1, 2, 4, 8, 10, 10])
+
+        # Poll again immediately after a large batch and soon after a small batch
+        self.assertEqual(scheduler.next_interval(100), 0)
+        self.assertEqual(scheduler.next_interval(250), 0)
+        self.assertEqual(scheduler.next_interval(5), 1)
+
+        # Start backing off again from the min interval
+        self.assertEqual([scheduler.next_interval(0) for _ in range(0, 3)], [1, 2, 4])
+
+
+if __name__ == '__main__':
+    test_util.setup_all_unittests(sys.argv)
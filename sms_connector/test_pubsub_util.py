@@ -0,0 +1,369 @@
+import json
+import sys
+import threading
+import time
+import unittest
+
+from lib import message_util
+from lib import test_util
+from lib.pubsub_util import DeadLetterPolicy, KeyedMessageSequencer, MessageSequencer
+
+
+class MessageSequencerTestCase(unittest.TestCase):
+    def test_process_message(self):
+        test_util.print_test_header()
+        processed = []
+        unblocked = threading.Event()
+
+        def process_message(message):
+            unblocked.wait(5)
+            processed.append(message.data)
+            message.ack()
+
+        sequencer = MessageSequencer(process_message)
+        self.addCleanup(sequencer.stop)
+        messages = [test_util.MockPubSubMessage(f"message {count}") for count in range(0, 5)]
+
+        # Messages from many threads are queued without waiting for them to be processed
+        threads = []
+        for message in messages:
+            threads.append(threading.Thread(target=sequencer.process_message, args=[message]))
+            threads[-1].start()
+            threads[-1].join(5)
+            self.assertFalse(threads[-1].is_alive())
+        self.assertEqual(processed, [])
+        self.assertGreaterEqual(sequencer.queue_depth(), 4)
+
+        # Then they are processed one at a time in order
+        unblocked.set()
+        sequencer.join()
+        self.assertEqual(processed, [f"message {count}" for count in range(0, 5)])
+        self.assertTrue(all(message.acked for message in messages))
+        stats = sequencer.stats()
+        self.assertEqual(stats["queue_depth"], 0)
+        self.assertEqual(stats["processed"], 5)
+        self.assertEqual(stats["nacked"], 0)
+        self.assertGreater(stats["max_wait_sec"], 0)
+
+    def test_process_message_exception(self):
+        test_util.print_test_header()
+        exceptions = []
+        failure = Exception("pretend exception for testing")
+
+        def process_message(message):
+            if message.data == "fail":
+                raise failure
+            message.ack()
+
+        sequencer = MessageSequencer(process_message, exception_callback=exceptions.append)
+        self.addCleanup(sequencer.stop)
+        messages = [test_util.MockPubSubMessage(data) for data in ["before", "fail", "after"]]
+        for message in messages:
+            sequencer.process_message(message)
+        sequencer.join()
+
+        # The failing message and those after it are nacked
+        self.assertEqual(sequencer.last_exception, failure)
+        self.assertEqual(exceptions, [failure])
+        self.assertEqual([message.acked for message in messages], [True, False, False])
+        self.assertEqual([message.nacked for message in messages], [False, True, True])
+
+        # Subsequent messages are nacked and the exception is raised to terminate the subscription
+        message = test_util.MockPubSubMessage("later")
+        with self.assertRaises(Exception) as context:
+            sequencer.process_message(message)
+        self.assertEqual(context.exception, failure)
+        self.assertTrue(message.nacked)
+
+    def test_dead_letter(self):
+        test_util.print_test_header()
+        publisher = test_util.MockPublisher()
+        attempts = []
+
+        def process_message(message):
+            attempts.append(message.data)
+            if message.data.startswith("poison"):
+                raise ValueError(f"malformed {message.data}")
+            message.ack()
+
+        policy = DeadLetterPolicy(publisher, max_attempts=3, initial_retry_wait_sec=0.01)
+        sequencer = MessageSequencer(process_message, dead_letter_policy=policy)
+        self.addCleanup(sequencer.stop)
+        messages = [test_util.MockPubSubMessage(data) for data in ["before", "poison", "after"]]
+        for message in messages:
+            sequencer.process_message(message)
+        sequencer.join()
+
+        # The poison message is retried, then dead lettered with the error and acked so that processing continues
+        self.assertEqual(attempts, ["before", "poison", "poison", "poison", "after"])
+        self.assertIsNone(sequencer.last_exception)
+        self.assertTrue(all(message.acked for message in messages))
+        self.assertEqual(len(publisher.payloads), 1)
+        dead_letter = publisher.payloads[0]
+        self.assertEqual(dead_letter["message_id"], messages[1].message_id)
+        self.assertEqual(dead_letter["data"], "poison")
+        self.assertEqual(dead_letter["error"], "ValueError: malformed poison")
+        self.assertEqual(dead_letter["attempts"], 3)
+        self.assertIn("malformed poison", dead_letter["traceback"])
+        stats = sequencer.stats()
+        self.assertEqual((stats["retried"], stats["dead_lettered"], stats["nacked"]), (2, 1, 0))
+
+    def test_dead_letter_systemic(self):
+        test_util.print_test_header()
+        publisher = test_util.MockPublisher()
+
+        def process_message(message):
+            raise Exception("pretend systemic exception for testing")
+
+        # Processing halts rather than dead lettering more than max_dead_letters messages
+        policy = DeadLetterPolicy(publisher, max_attempts=1, max_dead_letters=2)
+        sequencer = MessageSequencer(process_message, dead_letter_policy=policy)
+        self.addCleanup(sequencer.stop)
+        messages = [test_util.MockPubSubMessage(f"message {count}") for count in range(0, 4)]
+        for message in messages:
+            sequencer.process_message(message)
+        sequencer.join()
+        self.assertIsNotNone(sequencer.last_exception)
+        self.assertEqual(len(publisher.payloads), 2)
+        self.assertEqual([message.acked for message in messages], [True, True, False, False])
+        self.assertEqual([message.nacked for message in messages], [False, False, True, True])
+
+    def test_dead_letter_max_dead_letters(self):
+        test_util.print_test_header()
+        publisher = test_util.MockPublisher()
+
+        def process_message(message):
+            if message.data.startswith("poison"):
+                raise ValueError(f"malformed {message.data}")
+            message.ack()
+
+        # Consecutive poison messages are dead lettered, up to max_dead_letters in the window
+        policy = DeadLetterPolicy(publisher, max_attempts=1, max_dead_letters=2)
+        sequencer = MessageSequencer(process_message, dead_letter_policy=policy)
+        self.addCleanup(sequencer.stop)
+        messages = [test_util.MockPubSubMessage(data) for data in ["poison 1", "poison 2", "ok", "poison 3", "ok"]]
+        for message in messages:
+            sequencer.process_message(message)
+        sequencer.join()
+        self.assertIsNotNone(sequencer.last_exception)
+        self.assertEqual([payload["data"] for payload in publisher.payloads], ["poison 1", "poison 2"])
+        self.assertEqual([message.acked for message in messages], [True, True, True, False, False])
+        self.assertEqual([message.nacked for message in messages], [False, False, False, True, True])
+
+    def test_dead_letter_retry_wait(self):
+        test_util.print_test_header()
+        publisher = test_util.MockPublisher()
+        attempts = []
+
+        def process_message(message):
+            attempts.append(message.data)
+            if message.data == "poison":
+                raise ValueError("malformed poison")
+            message.ack()
+
+        # The worker does not sleep while a message waits to be retried, so later messages are held in order
+        # and stopping does not wait for the retry
+        policy = DeadLetterPolicy(publisher, max_attempts=3, initial_retry_wait_sec=60)
+        sequencer = MessageSequencer(process_message, dead_letter_policy=policy)
+        messages = [test_util.MockPubSubMessage(data) for data in ["poison", "after"]]
+        for message in messages:
+            sequencer.process_message(message)
+        end_time = time.monotonic() + 5
+        while sequencer.stats()["retried"] == 0 and time.monotonic() < end_time:
+            time.sleep(0.01)
+        time.sleep(0.1)
+        self.assertEqual(attempts, ["poison"])
+        self.assertEqual(sequencer.queue_depth(), 1)
+
+        start_time = time.monotonic()
+        sequencer.stop(timeout_sec=5)
+        self.assertLess(time.monotonic() - start_time, 1)
+        self.assertFalse(sequencer._thread.is_alive())
+        self.assertEqual(attempts, ["poison"])
+        self.assertEqual([message.nacked for message in messages], [True, True])
+        self.assertEqual(publisher.payloads, [])
+
+    def test_dead_letter_publish_fail(self):
+        test_util.print_test_header()
+        publisher = test_util.MockPublisher()
+        publisher.publish_exception = Exception("pretend publish exception for testing")
+
+        def process_message(message):
+            raise Exception("pretend exception for testing")
+
+        # If the message cannot be dead lettered, then processing halts so that the message is not lost
+        sequencer = MessageSequencer(process_message, dead_letter_policy=DeadLetterPolicy(publisher, max_attempts=1))
+        self.addCleanup(sequencer.stop)
+        message = test_util.MockPubSubMessage("poison")
+        sequencer.process_message(message)
+        sequencer.join()
+        self.assertEqual(sequencer.last_exception, publisher.publish_exception)
+        self.assertFalse(message.acked)
+        self.assertTrue(message.nacked)
+
+    def test_stop(self):
+        test_util.print_test_header()
+        started = threading.Event()
+
+        def process_message(message):
+            started.set()
+            time.sleep(0.2)
+            message.ack()
+
+        sequencer = MessageSequencer(process_message, max_queue_size=2)
+        messages = [test_util.MockPubSubMessage(f"message {count}") for count in range(0, 3)]
+        for message in messages:
+            sequencer.process_message(message)
+        self.assertTrue(started.wait(5))
+
+        # The message being processed completes and the queued messages are nacked
+        sequencer.stop()
+        self.assertEqual([message.acked for message in messages], [True, False, False])
+        self.assertEqual([message.nacked for message in messages], [False, True, True])
+        message = test_util.MockPubSubMessage("too late")
+        sequencer.process_message(message)
+        self.assertTrue(message.nacked)
+
+    def test_stop_timeout(self):
+        test_util.print_test_header()
+        started = threading.Event()
+        unblocked = threading.Event()
+        self.addCleanup(unblocked.set)
+
+        def process_message(message):
+            started.set()
+            unblocked.wait(5)
+            message.ack()
+
+        sequencer = MessageSequencer(process_message)
+        messages = [test_util.MockPubSubMessage(f"message {count}") for count in range(0, 3)]
+        for message in messages:
+            sequencer.process_message(message)
+        self.assertTrue(started.wait(5))
+
+        # Stopping does not wait indefinitely for a message which is blocked, but nacks the queued messages
+        start_time = time.monotonic()
+        sequencer.stop(timeout_sec=0.2)
+        self.assertLess(time.monotonic() - start_time, 2)
+        self.assertEqual([message.nacked for message in messages], [False, True, True])
+
+        # The blocked message completes once it is unblocked
+        unblocked.set()
+        sequencer._thread.join(5)
+        self.assertFalse(sequencer._thread.is_alive())
+        self.assertTrue(messages[0].acked)
+
+
+    def test_stop_while_queue_full(self):
+        test_util.print_test_header()
+        started = threading.Event()
+        unblocked = threading.Event()
+        self.addCleanup(unblocked.set)
+
+        def process_message(message):
+            started.set()
+            unblocked.wait(5)
+            message.ack()
+
+        sequencer = MessageSequencer(process_message, max_queue_size=1)
+        messages = [test_util.MockPubSubMessage(f"message {count}") for count in range(0, 3)]
+        sequencer.process_message(messages[0])
+        self.assertTrue(started.wait(5))
+        sequencer.process_message(messages[1])
+
+        # A message waiting for room in the queue is nacked rather than queued once the sequencer stops
+        producer = threading.Thread(target=sequencer.process_message, args=[messages[2]])
+        producer.start()
+        time.sleep(0.1)
+        self.assertTrue(producer.is_alive())
+        sequencer.stop(timeout_sec=0.2)
+        producer.join(5)
+        self.assertFalse(producer.is_alive())
+        self.assertEqual([message.nacked for message in messages], [False, True, True])
+
+        unblocked.set()
+        sequencer._thread.join(5)
+        self.assertFalse(sequencer._thread.is_alive())
+        self.assertTrue(messages[0].acked)
+        self.assertEqual(sequencer.message_processing_queue.qsize(), 0)
+
+class KeyedMessageSequencerTestCase(unittest.TestCase):
+    def test_process_message(self):
+        test_util.print_test_header()
+        processed = []
+        processed_lock = threading.Lock()
+        slow_conversation_started = threading.Event()
+        slow_conversation_unblocked = threading.Event()
+
+        def process_message(message):
+            payload = json.loads(message.data)["payload"]
+            if payload.get("opinion", {}).get("text") == "slow":
+                slow_conversation_started.set()
+                slow_conversation_unblocked.wait(5)
+            with processed_lock:
+                processed.append(payload)
+            message.ack()
+
+        def message_key(message):
+            return message_util.conversation_key(json.loads(message.data)["payload"])
+
+        sequencer = KeyedMessageSequencer(process_message, message_key, num_lanes=4)
+        self.addCleanup(sequencer.stop)
+        slow_id = "nook-phone-uuid-slow"
+        other_id = next(f"nook-phone-uuid-{count}" for count in range(0, 100)
+                        if sequencer.lane(f"nook-phone-uuid-{count}") != sequencer.lane(slow_id))
+
+        def new_message(payload):
+            return test_util.MockPubSubMessage(json.dumps({"payload": payload}))
+
+        def new_opinion(id, text):
+            return new_message({"action": "add_opinion", "namespace": "nook_conversations/set_notes",
+                                "opinion": {"deidentified_phone_number": id, "notes": text, "text": text}})
+
+        # Messages for other conversations and messages without a conversation are not delayed by a slow conversation
+        slow = [new_opinion(slow_id, "slow"), new_opinion(slow_id, "after slow")]
+        other = [new_opinion(other_id, "first"), new_opinion(other_id, "second")]
+        set_tag = new_message({"action": "add_opinion", "namespace": "nook/set_tag", "opinion": {"text": "tag"}})
+        self.assertIs(sequencer.lane(message_key(set_tag)), sequencer.keyless_lane)
+        for message in slow + other + [set_tag]:
+            sequencer.process_message(message)
+        self.assertTrue(slow_conversation_started.wait(5))
+        sequencer.lane(other_id).join()
+        sequencer.keyless_lane.join()
+        self.assertTrue(all(message.acked for message in other + [set_tag]))
+        self.assertFalse(any(message.acked for message in slow))
+
+        # Messages for each conversation are processed in order
+        slow_conversation_unblocked.set()
+        sequencer.join()
+        self.assertTrue(all(message.acked for message in slow))
+        self.assertEqual([payload["opinion"]["text"] for payload in processed
+                          if payload["opinion"].get("deidentified_phone_number") == slow_id], ["slow", "after slow"])
+        self.assertEqual([payload["opinion"]["text"] for payload in processed
+                          if payload["opinion"].get("deidentified_phone_number") == other_id], ["first", "second"])
+        self.assertEqual(sum(stats["processed"] for stats in sequencer.stats().values()), 5)
+
+    def test_process_message_exception(self):
+        test_util.print_test_header()
+        failure = Exception("pretend exception for testing")
+
+        def process_message(message):
+            if message.data == "fail":
+                raise failure
+            message.ack()
+
+        # An exception in one lane halts every lane
+        sequencer = KeyedMessageSequencer(process_message, lambda message: message.data, num_lanes=2)
+        self.addCleanup(sequencer.stop)
+        sequencer.process_message(test_util.MockPubSubMessage("fail"))
+        sequencer.join()
+        self.assertEqual(sequencer.last_exception, failure)
+        for key in ["fail", "other", None]:
+            message = test_util.MockPubSubMessage(key)
+            with self.assertRaises(Exception):
+                sequencer.process_message(message)
+            self.assertTrue(message.nacked)
+
+
+if __name__ == '__main__':
+    test_util.setup_all_unittests(sys.argv)
@@ -1,5 +1,7 @@
 import datetime
+import os
 import sys
+import tempfile
 import threading
 import time
 import unittest
@@ -10,9 +12,11 @@ import rapidpro_outgoing
 
 from lib import firestore_uuid_table
 from lib import test_util
+from lib.circuit_breaker import CLOSED, CircuitBreaker
 from lib.mock_firebase import MockFirestoreClient
 from lib.mock_rapidpro import MockRapidProClient, MockRapidProMessage
-from lib.pubsub_util import Publisher, Subscriber
+from lib.poll_scheduler import AdaptivePollScheduler
+from lib.pubsub_util import MessageSequencer, Publisher, Subscriber
 
 newly_created_uuid = "nook-phone-uuid-NEWLY-CREATED"
 
@@ -54,6 +58,108 @@ class RapidProAdapterCliTestCase(unittest.TestCase):
         actual_value = rapidpro_adapter_cli.read_last_update_time(sync_token_path)
         self.assertEqual(actual_value, expected_value)
 
+    def test_new_rapidpro_client(self):
+        test_util.print_test_header()
+        incoming_client, incoming_lock, incoming_pool = rapidpro_adapter_cli.new_rapidpro_client(
+            "incoming", "https://localhost", "token", 1)
+        outgoing_client, outgoing_lock, outgoing_pool = rapidpro_adapter_cli.new_rapidpro_client(
+            "outgoing", "https://localhost", "token", 2, timeout=30)
+        self.assertIsNot(incoming_client, outgoing_client)
+        self.assertIsNot(incoming_pool, outgoing_pool)
+        self.assertEqual(outgoing_pool.pool_size, 2)
+        self.assertEqual(outgoing_pool.default_config.timeout, (10, 30))
+
+        # A request in one direction does not block requests in the other
+        with incoming_lock:
+            self.assertTrue(outgoing_lock.acquire(blocking=False))
+            self.assertTrue(outgoing_lock.acquire(blocking=False))
+            self.assertFalse(outgoing_lock.acquire(blocking=False))
+            self.assertFalse(incoming_lock.acquire(blocking=False))
+        outgoing_lock.release()
+        outgoing_lock.release()
+
+    def test_run_inbound_polling_stop(self):
+        sync_token_path = self.setup_inbound_polling()
+        self.rapidpro_client.incoming.extend(mock_incoming_messages)
+
+        polling_thread = threading.Thread(target=rapidpro_adapter_cli.run_inbound_polling, args=(sync_token_path,))
+        polling_thread.start()
+        end_time = time.time() + 5
+        while len(rapidpro_incoming.publisher.payloads) < len(mock_incoming_messages) and time.time() < end_time:
+            time.sleep(0.05)
+
+        # Stopping wakes the polling loop without waiting for the next poll
+        stop_time = time.time()
+        rapidpro_adapter_cli.stop_polling()
+        polling_thread.join(5)
+        self.assertFalse(polling_thread.is_alive())
+        self.assertLess(time.time() - stop_time, 5)
+        self.assertEqual(len(rapidpro_incoming.publisher.payloads), len(mock_incoming_messages))
+        self.assertIsNotNone(rapidpro_adapter_cli.read_last_update_time(sync_token_path))
+
+    def test_run_inbound_polling_circuit_open(self):
+        sync_token_path = self.setup_inbound_polling()
+        self.rapidpro_client.incoming.extend(mock_incoming_messages)
+        self.rapidpro_client.retry_count = 1
+        rapidpro_incoming.circuit_breaker = CircuitBreaker("rapidpro-incoming", max_failures=1, reset_timeout_sec=0.5)
+
+        polling_thread = threading.Thread(target=rapidpro_adapter_cli.run_inbound_polling, args=(sync_token_path,))
+        polling_thread.start()
+        end_time = time.time() + 5
+        while len(rapidpro_incoming.publisher.payloads) < len(mock_incoming_messages) and time.time() < end_time:
+            time.sleep(0.05)
+        rapidpro_adapter_cli.stop_polling()
+        polling_thread.join(5)
+
+        # The failed poll opens the circuit breaker rather than stopping polling, and the probe succeeds
+        self.assertFalse(polling_thread.is_alive())
+        self.assertEqual(len(rapidpro_incoming.publisher.payloads), len(mock_incoming_messages))
+        self.assertEqual(rapidpro_incoming.circuit_breaker.state, CLOSED)
+        self.assertEqual(rapidpro_incoming.circuit_breaker.open_count, 1)
+
+    def test_run_inbound_polling_circuit_open_other_exception(self):
+        sync_token_path = self.setup_inbound_polling()
+        rapidpro_incoming.circuit_breaker = CircuitBreaker("rapidpro-incoming", max_failures=1, reset_timeout_sec=60)
+        other_exception = ValueError("pretend exception for testing")
+
+        def fail_transfer(created_after_inclusive=None):
+            rapidpro_incoming.circuit_breaker.record_failure()
+            raise other_exception
+
+        original_transfer_messages = rapidpro_incoming.transfer_messages
+        rapidpro_incoming.transfer_messages = fail_transfer
+        self.addCleanup(setattr, rapidpro_incoming, "transfer_messages", original_transfer_messages)
+
+        # Only RapidPro errors are retried once the circuit breaker allows, other exceptions stop polling
+        with self.assertRaises(ValueError) as context:
+            rapidpro_adapter_cli.run_inbound_polling(sync_token_path)
+        self.assertEqual(context.exception, other_exception)
+
+    def test_run_inbound_polling_outgoing_exception(self):
+        sync_token_path = self.setup_inbound_polling()
+        outgoing_exception = Exception("pretend outgoing exception for testing")
+
+        def fail_processing(message):
+            raise outgoing_exception
+
+        def process_outgoing_message():
+            try:
+                rapidpro_outgoing.sequencer.process_message(test_util.MockPubSubMessage(b"{}"))
+            except Exception:
+                pass
+
+        rapidpro_outgoing.sequencer = MessageSequencer(
+            fail_processing, exception_callback=lambda e: rapidpro_adapter_cli.wakeup_event.set())
+        threading.Timer(0.5, process_outgoing_message).start()
+
+        # The outgoing failure wakes the polling loop rather than waiting for the next poll
+        start_time = time.time()
+        with self.assertRaises(Exception) as context:
+            rapidpro_adapter_cli.run_inbound_polling(sync_token_path)
+        self.assertEqual(context.exception, outgoing_exception)
+        self.assertLess(time.time() - start_time, 5)
+        rapidpro_outgoing.sequencer = None
+
     def test_adapter_live(self):
         if not self.setup_adapter_live(): return
         start_time = datetime.datetime.now(datetime.timezone.utc)
@@ -144,6 +250,33 @@ class RapidProAdapterCliTestCase(unittest.TestCase):
 
     ############ Test Helper Methods ############################################################
 
+    def setup_inbound_polling(self):
+        test_util.print_test_header()
+        self.log = test_util.TestLogger(__name__)
+        firestore_uuid_table.log = self.log
+        rapidpro_incoming.log = self.log
+        rapidpro_adapter_cli.log = self.log
+
+        self.rapidpro_client = MockRapidProClient()
+        self.firebase_client = MockFirestoreClient('testdata/uuid_mappings.json')
+        rapidpro_incoming.rapidpro_client = self.rapidpro_client
+        rapidpro_incoming.rapidpro_lock = threading.Lock()
+        rapidpro_incoming.phone_number_uuid_table = rapidpro_adapter_cli.new_uuid_table(None, self.firebase_client)
+        rapidpro_incoming.publisher = test_util.MockPublisher()
+        rapidpro_incoming.circuit_breaker = CircuitBreaker("rapidpro-incoming")
+        rapidpro_outgoing.sequencer = None
+
+        # Wait much longer between polls than the test should take
+        rapidpro_adapter_cli.poll_scheduler = AdaptivePollScheduler(min_interval=60, max_interval=60)
+        rapidpro_adapter_cli.wakeup_event.clear()
+
+        temp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(temp_dir.cleanup)
+        sync_token_path = os.path.join(temp_dir.name, "sync_token.json")
+        rapidpro_adapter_cli.write_last_update_time(
+            sync_token_path, datetime.datetime.fromisoformat("2019-10-02T06:00:00+00:00"))
+        return sync_token_path
+
     def setup_adapter_live(self):
         if not test_util.setup_live_test(): return False
 
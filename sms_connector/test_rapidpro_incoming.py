@@ -1,3 +1,4 @@
+import datetime
 import sys
 import threading
 import unittest
@@ -9,6 +10,7 @@ import rapidpro_incoming
 
 from lib import firestore_uuid_table
 from lib import test_util
+from lib.circuit_breaker import CircuitBreaker, CircuitOpenError, OPEN
 from lib.mock_firebase import MockFirestoreClient
 from lib.mock_rapidpro import MockRapidProClient, MockRapidProMessage
 from lib.pubsub_util import Subscriber
@@ -17,6 +19,69 @@ newly_created_uuid = "nook-phone-uuid-NEWLY-CREATED"
 
 
 class RapidProIncomingTestCase(unittest.TestCase):
+    def test_transfer_messages(self):
+        self.setup_transfer_messages()
+
+        mock_messages = [
+            MockRapidProMessage("2019-10-02T06:47:14.267126+00:00", "tel:+0123456789-10", "in", "Some client message"),
+            MockRapidProMessage("2019-10-02T06:49:14.267126+00:00", "tel:+0123456789-10-new", "in", "Hey! I'm new"),
+        ]
+        self.rapidpro_client.incoming.extend(mock_messages)
+
+        process_count = rapidpro_incoming.transfer_messages()
+
+        payloads = rapidpro_incoming.publisher.payloads
+        self.assertEqual(process_count, len(mock_messages))
+        self.assertEqual(len(payloads), len(mock_messages))
+        self.assert_payload(payloads[0],
+                            "nook-phone-uuid-91755b17-3f7e-429c-934c-9ed402d715f7",
+                            "2019-10-02T06:47:14.267126+00:00", "in", "Some client message")
+        self.assert_payload(payloads[1],
+                            newly_created_uuid,
+                            "2019-10-02T06:49:14.267126+00:00", "in", "Hey! I'm new")
+
+    def test_transfer_messages_new_urns(self):
+        self.setup_transfer_messages()
+
+        mock_messages = [
+            MockRapidProMessage("2019-10-02T06:47:14.267126+00:00", "tel:+0123456789-10-new", "in", "First"),
+            MockRapidProMessage("2019-10-02T06:48:14.267126+00:00", "tel:+0123456789-11-new", "in", "Second"),
+            MockRapidProMessage("2019-10-02T06:49:14.267126+00:00", "tel:+0123456789-10-new", "in", "Third"),
+        ]
+        self.rapidpro_client.incoming.extend(mock_messages)
+
+        process_count = rapidpro_incoming.transfer_messages()
+
+        payloads = rapidpro_incoming.publisher.payloads
+        self.assertEqual(process_count, len(mock_messages))
+        self.assertEqual(len(payloads), len(mock_messages))
+        uuid_1 = payloads[0]["sms_raw"]["deidentified_phone_number"]
+        uuid_2 = payloads[1]["sms_raw"]["deidentified_phone_number"]
+        self.assertNotEqual(uuid_1, uuid_2)
+        self.assertEqual(payloads[2]["sms_raw"]["deidentified_phone_number"], uuid_1)
+
+        changes = self.firebase_client.changes()
+        self.assertEqual(len(changes), 2)
+        self.assertEqual(sorted([change[0] for change in changes]), [
+            "tables/uuid-table/mappings/tel:+0123456789-10-new",
+            "tables/uuid-table/mappings/tel:+0123456789-11-new",
+        ])
+
+    def test_transfer_messages_publish_fail(self):
+        self.setup_transfer_messages()
+
+        mock_messages = [
+            MockRapidProMessage("2019-10-02T06:47:14.267126+00:00", "tel:+0123456789-10", "in", "Some client message"),
+        ]
+        self.rapidpro_client.incoming.extend(mock_messages)
+        rapidpro_incoming.publisher.publish_exception = Exception("pretend publish failure for testing")
+
+        try:
+            rapidpro_incoming.transfer_messages()
+            self.fail("Expected exception")
+        except Exception as e:
+            self.assertEqual(str(e), "pretend publish failure for testing")
+
     def test_transfer_messages_live(self):
         if not self.setup_transfer_messages_live(): return
 
@@ -91,10 +156,100 @@ class RapidProIncomingTestCase(unittest.TestCase):
         changes = self.firebase_client.changes()
         self.assertEqual(len(changes), 0)
 
+    def test_transfer_messages_circuit_open(self):
+        self.setup_transfer_messages()
+        self.rapidpro_client.incoming.extend([
+            MockRapidProMessage("2019-10-02T06:51:14.267126+00:00", "tel:+0123456789-10", "in", "Some client message 2"),
+        ])
+        self.rapidpro_client.retry_count = 5
+        rapidpro_incoming.circuit_breaker = CircuitBreaker("rapidpro-incoming", max_failures=2, reset_timeout_sec=60)
+
+        # Retrying stops as soon as the circuit breaker opens
+        with self.assertRaises(TembaConnectionError):
+            rapidpro_incoming.transfer_messages()
+        self.assertEqual(rapidpro_incoming.circuit_breaker.state, OPEN)
+        self.assertEqual(self.rapidpro_client.retry_count, 3)
+
+        # No further requests are made until the circuit breaker allows a probe
+        with self.assertRaises(CircuitOpenError):
+            rapidpro_incoming.transfer_messages()
+        self.assertEqual(self.rapidpro_client.retry_count, 3)
+        self.assertEqual(len(rapidpro_incoming.publisher.payloads), 0)
+
+    def test_transfer_messages_in_pages(self):
+        self.setup_transfer_messages()
+        rapidpro_incoming.page_max_duration = datetime.timedelta(hours=1)
+        rapidpro_incoming.page_target_messages = 1
+
+        mock_messages = [
+            MockRapidProMessage("2019-10-02T06:10:00+00:00", "tel:+0123456789-10", "in", "First"),
+            MockRapidProMessage("2019-10-02T07:10:00+00:00", "tel:+0123456789-10", "in", "Second"),
+            MockRapidProMessage("2019-10-02T07:15:00+00:00", "tel:+0123456789-11", "in", "Third"),
+            MockRapidProMessage("2019-10-02T08:30:00+00:00", "tel:+0123456789-10", "in", "Fourth"),
+            MockRapidProMessage("2019-10-02T09:10:00+00:00", "tel:+0123456789-10", "in", "Too late"),
+        ]
+        self.rapidpro_client.incoming.extend(mock_messages)
+
+        start = datetime.datetime.fromisoformat("2019-10-02T06:00:00+00:00")
+        checkpoints = []
+        process_count = rapidpro_incoming.transfer_messages_in_pages(
+            start, start + datetime.timedelta(hours=3), checkpoints.append)
+
+        # The page following a page with more than the target # of messages covers half the period
+        self.assertEqual(process_count, 4)
+        self.assertEqual([checkpoint - start for checkpoint in checkpoints], [
+            datetime.timedelta(hours=1),
+            datetime.timedelta(hours=2),
+            datetime.timedelta(hours=2, minutes=30),
+            datetime.timedelta(hours=3),
+        ])
+        payloads = rapidpro_incoming.publisher.payloads
+        self.assertEqual([payload["sms_raw"]["text"] for payload in payloads], ["First", "Second", "Third", "Fourth"])
+        self.assertEqual(len(self.rapidpro_client.incoming), 1)
+
+    def test_transfer_messages_in_pages_publish_fail(self):
+        self.setup_transfer_messages()
+        rapidpro_incoming.page_max_duration = datetime.timedelta(hours=1)
+
+        mock_messages = [
+            MockRapidProMessage("2019-10-02T06:10:00+00:00", "tel:+0123456789-10", "in", "First"),
+            MockRapidProMessage("2019-10-02T07:10:00+00:00", "tel:+0123456789-10", "in", "Second"),
+        ]
+        self.rapidpro_client.incoming.extend(mock_messages)
+
+        def checkpoint(page_end):
+            checkpoints.append(page_end)
+            rapidpro_incoming.publisher.publish_exception = Exception("pretend publish failure for testing")
+
+        start = datetime.datetime.fromisoformat("2019-10-02T06:00:00+00:00")
+        checkpoints = []
+        with self.assertRaises(Exception):
+            rapidpro_incoming.transfer_messages_in_pages(start, start + datetime.timedelta(hours=3), checkpoint)
+
+        # Progress is only recorded for the page that was published
+        self.assertEqual(checkpoints, [start + datetime.timedelta(hours=1)])
+
     ############ Test Helper Methods ############################################################
 
     def setUp(self):
         self.incoming_subscriber = None
+        self.original_page_max_duration = rapidpro_incoming.page_max_duration
+        self.original_page_target_messages = rapidpro_incoming.page_target_messages
+
+    def setup_transfer_messages(self):
+        test_util.print_test_header()
+
+        self.rapidpro_client = MockRapidProClient()
+        self.firebase_client = MockFirestoreClient('testdata/uuid_mappings.json')
+
+        self.log = test_util.TestLogger(__name__)
+        firestore_uuid_table.log = self.log
+        rapidpro_incoming.log = self.log
+        rapidpro_incoming.rapidpro_client = self.rapidpro_client
+        rapidpro_incoming.rapidpro_lock = threading.Lock()
+        rapidpro_incoming.phone_number_uuid_table = rapidpro_adapter_cli.new_uuid_table(None, self.firebase_client)
+        rapidpro_incoming.publisher = test_util.MockPublisher()
+        rapidpro_incoming.circuit_breaker = CircuitBreaker("rapidpro-incoming")
 
     def setup_transfer_messages_live(self):
         if not test_util.setup_live_test(): return False
@@ -137,6 +292,8 @@ class RapidProIncomingTestCase(unittest.TestCase):
         self.assertEqual(sms_raw["text"], text)
 
     def tearDown(self):
+        rapidpro_incoming.page_max_duration = self.original_page_max_duration
+        rapidpro_incoming.page_target_messages = self.original_page_target_messages
         if self.incoming_subscriber is not None:
             self.incoming_subscriber.cancel()
 
@@ -1,18 +1,26 @@
 import datetime
 import json
+import os
 import sys
+import tempfile
 import threading
 import time
 import unittest
 
+from temba_client.exceptions import TembaRateExceededError
+
 import rapidpro_adapter_cli
 import rapidpro_outgoing
 
 from lib import firestore_uuid_table
 from lib import test_util
+from lib import message_util
+from lib.broadcast_ledger import BroadcastLedger
+from lib.circuit_breaker import CLOSED, CircuitBreaker, OPEN
 from lib.mock_firebase import MockFirestoreClient
 from lib.mock_rapidpro import MockRapidProClient
 from lib.pubsub_util import Publisher, MessageSequencer
+from lib.retry_queue import RetryQueue
 
 mock_payload = {
     "action": "send_messages",
@@ -139,6 +147,420 @@ class RapidProOutgoingTestCase(unittest.TestCase):
         self.assertEqual(len(outgoing[5][0]), 50)
         self.assertEqual(outgoing[5][1], "2/2 and here's the rest of the message")
 
+    def test_process_messages_impl_concurrent(self):
+        self.setup_rapidpro_adapter()
+        rapidpro_outgoing.max_concurrent_group_sends = 4
+        ids = self.add_mappings(250)
+
+        self.process_message_impl({
+            "action": "send_messages",
+            "ids": ids,
+            "messages": [
+                "1/2 this is message one",
+                "2/2 and here's the rest of the message"
+            ]
+        })
+
+        # Each group is sent both messages in order, but the groups may be sent in any order
+        outgoing = rapidpro_outgoing.rapidpro_client.outgoing
+        self.assertEqual(len(outgoing), 6)
+        self.assertEqual(sorted(len(urns) for urns, _ in outgoing), [50, 50, 100, 100, 100, 100])
+        for group_start in range(0, 250, 100):
+            group_texts = [text for urns, text in outgoing if urns[0] == f"tel:+0123456789037-{group_start}"]
+            self.assertEqual(group_texts, ["1/2 this is message one", "2/2 and here's the rest of the message"])
+
+    def test_process_messages_impl_concurrent_fail(self):
+        self.setup_rapidpro_adapter()
+        rapidpro_outgoing.max_concurrent_group_sends = 4
+        ids = self.add_mappings(250)
+        rapidpro_outgoing.rapidpro_client.failing_urns.add("tel:+0123456789037-120")
+
+        with self.assertRaises(Exception):
+            self.process_message_impl({
+                "action": "send_messages",
+                "ids": ids,
+                "messages": ["1/1 this is the message"]
+            })
+
+        # The message is not acked and the failing group is not retried because it is large
+        outgoing = rapidpro_outgoing.rapidpro_client.outgoing
+        self.assertNotIn("tel:+0123456789037-120", [urn for urns, _ in outgoing for urn in urns])
+        self.assertEqual(rapidpro_outgoing.circuit_breaker.failure_count(), 1)
+
+    def test_process_messages_impl_unknown_id(self):
+        self.setup_rapidpro_adapter()
+        ids = self.add_mappings(250) + ["nook-phone-uuid-unknown"]
+
+        # Nothing is sent if any id is unknown, so redelivering the message never sends it twice
+        with self.assertRaises(LookupError):
+            self.process_message_impl({
+                "action": "send_messages",
+                "ids": ids,
+                "messages": ["1/1 this is the message"]
+            })
+        self.assertEqual(rapidpro_outgoing.rapidpro_client.outgoing, [])
+
+    def test_process_messages_impl_rate_exceeded(self):
+        self.setup_rapidpro_adapter()
+        ids = self.add_mappings(100)
+        rapidpro_outgoing.rapidpro_client.rate_exceeded_count = 2
+
+        self.process_message_impl({
+            "action": "send_messages",
+            "ids": ids,
+            "messages": ["1/1 this is the message"]
+        })
+
+        # The large group is retried once RapidPro stops throttling, without counting as failures
+        outgoing = rapidpro_outgoing.rapidpro_client.outgoing
+        self.assertEqual(len(outgoing), 1)
+        self.assertEqual(len(outgoing[0][0]), 100)
+        self.assertEqual(rapidpro_outgoing.circuit_breaker.failure_count(), 0)
+
+    def test_process_messages_impl_circuit_open(self):
+        self.setup_rapidpro_adapter()
+        ids = self.add_mappings(2)
+        circuit_breaker = CircuitBreaker("rapidpro-outgoing", max_failures=1, reset_timeout_sec=0.5)
+        circuit_breaker.record_failure()
+        self.assertEqual(circuit_breaker.state, OPEN)
+
+        # The send waits for the circuit breaker to allow a probe rather than failing
+        start_time = time.time()
+        message = test_util.MockPubSubMessage(json.dumps({"payload": {
+            "action": "send_messages",
+            "ids": ids,
+            "messages": ["1/1 this is the message"]
+        }}))
+        rapidpro_outgoing.circuit_breaker = circuit_breaker
+        rapidpro_outgoing.process_message_impl(message)
+        self.assertTrue(message.acked)
+        self.assertGreaterEqual(time.time() - start_time, 0.4)
+        self.assertEqual(len(rapidpro_outgoing.rapidpro_client.outgoing), 1)
+        self.assertEqual(circuit_breaker.state, CLOSED)
+
+    def test_teardown_circuit_open(self):
+        self.setup_rapidpro_adapter()
+        ids = self.add_mappings(2)
+        rapidpro_outgoing.subscriber = test_util.MockSubscriber()
+        rapidpro_outgoing.circuit_breaker = CircuitBreaker("rapidpro-outgoing", max_failures=1, reset_timeout_sec=60)
+        rapidpro_outgoing.circuit_breaker.record_failure()
+        message = test_util.MockPubSubMessage(json.dumps({"payload": {
+            "action": "send_messages",
+            "ids": ids,
+            "messages": ["1/1 this is the message"]
+        }}))
+        rapidpro_outgoing.sequencer.process_message(message)
+        time.sleep(0.2)
+
+        # Teardown interrupts the send waiting for the circuit breaker rather than waiting for the probe
+        start_time = time.time()
+        rapidpro_outgoing.teardown()
+        self.assertLess(time.time() - start_time, 5)
+        self.assertTrue(message.nacked)
+        self.assertEqual(rapidpro_outgoing.rapidpro_client.outgoing, [])
+        rapidpro_outgoing.sequencer.last_exception = None
+
+    def test_process_messages_impl_resume(self):
+        self.setup_rapidpro_adapter()
+        ids = self.add_mappings(250)
+        payload = {
+            "action": "send_messages",
+            "ids": ids,
+            "messages": ["1/2 this is message one", "2/2 and here's the rest of the message"]
+        }
+        rapidpro_outgoing.retry_wait_times = [0.1, 0.1, 0.1]
+        rapidpro_client = rapidpro_outgoing.rapidpro_client
+
+        with tempfile.TemporaryDirectory() as temp_dir:
+            rapidpro_outgoing.ledger = BroadcastLedger(os.path.join(temp_dir, "ledger.sqlite"))
+            try:
+                # Sending to the second group fails, so the message is not acked
+                rapidpro_client.failing_urns.add("tel:+0123456789037-120")
+                message = test_util.MockPubSubMessage(json.dumps({"payload": payload}), message_id="broadcast-1")
+                with self.assertRaises(Exception):
+                    rapidpro_outgoing.process_message_impl(message)
+                self.assertFalse(message.acked)
+                self.assertEqual([len(urns) for urns, _ in rapidpro_client.outgoing], [100, 100])
+
+                # When the message is redelivered, sending resumes with the second group
+                rapidpro_client.failing_urns.clear()
+                rapidpro_client.outgoing = []
+                message = test_util.MockPubSubMessage(json.dumps({"payload": payload}), message_id="broadcast-1")
+                rapidpro_outgoing.process_message_impl(message)
+                self.assertTrue(message.acked)
+                self.assertEqual([(urns[0], len(urns)) for urns, _ in rapidpro_client.outgoing], [
+                    ("tel:+0123456789037-100", 100), ("tel:+0123456789037-100", 100),
+                    ("tel:+0123456789037-200", 50), ("tel:+0123456789037-200", 50),
+                ])
+
+                # Once the message has been sent in full, redelivery sends nothing
+                rapidpro_client.outgoing = []
+                message = test_util.MockPubSubMessage(json.dumps({"payload": payload}), message_id="broadcast-1")
+                rapidpro_outgoing.process_message_impl(message)
+                self.assertTrue(message.acked)
+                self.assertEqual(rapidpro_client.outgoing, [])
+            finally:
+                rapidpro_outgoing.ledger.close()
+                rapidpro_outgoing.ledger = None
+
+    def test_process_messages_impl_split(self):
+        self.setup_rapidpro_adapter()
+        rapidpro_outgoing.min_split_group_size = 1
+        ids = self.add_mappings(250)
+        rapidpro_client = rapidpro_outgoing.rapidpro_client
+        rapidpro_client.bad_urns.add("tel:+0123456789037-120")
+        rapidpro_client.failing_urns.add("tel:+0123456789037-210")
+
+        with tempfile.TemporaryDirectory() as temp_dir:
+            rapidpro_outgoing.quarantine_report_path = os.path.join(temp_dir, "quarantine.jsonl")
+            self.process_message_impl({
+                "action": "send_messages",
+                "ids": ids,
+                "messages": ["1/2 this is message one", "2/2 and here's the rest of the message"]
+            })
+            with open(rapidpro_outgoing.quarantine_report_path) as f:
+                report = [json.loads(line) for line in f]
+
+        # Only the bad URNs are not sent the messages
+        outgoing = rapidpro_outgoing.rapidpro_client.outgoing
+        for text in ["1/2 this is message one", "2/2 and here's the rest of the message"]:
+            sent_urns = sorted(urn for urns, sent_text in outgoing if sent_text == text for urn in urns)
+            expected_urns = sorted(f"tel:+0123456789037-{index}" for index in range(0, 250) if index not in (120, 210))
+            self.assertEqual(sent_urns, expected_urns)
+        self.assertEqual(sorted(urn for entry in report for urn in entry["urns"]),
+                         ["tel:+0123456789037-120", "tel:+0123456789037-210"])
+        self.assertEqual(report[0]["texts"], ["1/2 this is message one", "2/2 and here's the rest of the message"])
+
+    def test_process_messages_impl_split_rate_exceeded(self):
+        self.setup_rapidpro_adapter()
+        rapidpro_outgoing.min_split_group_size = 1
+        rapidpro_outgoing.max_rate_exceeded_retries = 1
+        ids = self.add_mappings(100)
+        rapidpro_client = rapidpro_outgoing.rapidpro_client
+        rapidpro_client.rate_exceeded_count = 5
+
+        # The group is not split when RapidPro keeps throttling, because the URNs are not the cause
+        try:
+            with tempfile.TemporaryDirectory() as temp_dir:
+                rapidpro_outgoing.quarantine_report_path = os.path.join(temp_dir, "quarantine.jsonl")
+                with self.assertRaises(TembaRateExceededError):
+                    self.process_message_impl({
+                        "action": "send_messages",
+                        "ids": ids,
+                        "messages": ["1/1 this is the message"]
+                    })
+                self.assertFalse(os.path.exists(rapidpro_outgoing.quarantine_report_path))
+        finally:
+            rapidpro_outgoing.max_rate_exceeded_retries = 10
+        self.assertEqual(rapidpro_client.outgoing, [])
+        self.assertEqual(rapidpro_client.rate_exceeded_count, 3)
+
+    def test_process_messages_impl_split_fail(self):
+        self.setup_rapidpro_adapter()
+        rapidpro_outgoing.min_split_group_size = 1
+        rapidpro_outgoing.max_quarantined_urns = 1
+        ids = self.add_mappings(250)
+        rapidpro_client = rapidpro_outgoing.rapidpro_client
+        rapidpro_client.bad_urns.update(["tel:+0123456789037-20", "tel:+0123456789037-120"])
+
+        # The broadcast fails if too many URNs are quarantined
+        try:
+            with self.assertRaises(Exception):
+                self.process_message_impl({
+                    "action": "send_messages",
+                    "ids": ids,
+                    "messages": ["1/1 this is the message"]
+                })
+        finally:
+            rapidpro_outgoing.max_quarantined_urns = 100
+
+    def test_process_messages_coalesce(self):
+        self.setup_rapidpro_adapter()
+        rapidpro_outgoing.coalesce_window = 0.2
+        rapidpro_outgoing.retry_wait_times = [0.1, 0.1, 0.1]
+        ids = self.add_mappings(3)
+
+        messages = []
+        for id in ids:
+            message = test_util.MockPubSubMessage(json.dumps({"payload": {
+                "action": "send_messages",
+                "ids": [id],
+                "messages": ["1/1 the same reply"]
+            }}))
+            rapidpro_outgoing.sequencer.process_message(message)
+            messages.append(message)
+        rapidpro_outgoing.sequencer.join()
+
+        # The messages are not sent until the window has elapsed, then they are sent together
+        self.assertEqual(rapidpro_outgoing.rapidpro_client.outgoing, [])
+        self.assertFalse(any(message.acked for message in messages))
+        time.sleep(0.5)
+        rapidpro_outgoing.sequencer.join()
+        self.assertEqual(rapidpro_outgoing.rapidpro_client.outgoing, [
+            ([f"tel:+0123456789037-{index}" for index in range(0, 3)], "1/1 the same reply")
+        ])
+        self.assertTrue(all(message.acked for message in messages))
+
+    def test_process_messages_coalesce_retried(self):
+        self.setup_rapidpro_adapter()
+        rapidpro_outgoing.coalesce_window = 0.2
+        rapidpro_outgoing.retry_wait_times = [0.1, 0.1, 0.1]
+        ids = self.add_mappings(20)
+        rapidpro_outgoing.rapidpro_client.retry_count = 1
+
+        messages = []
+        for id in ids:
+            message = test_util.MockPubSubMessage(json.dumps({"payload": {
+                "action": "send_messages",
+                "ids": [id],
+                "messages": ["1/1 the same reply"]
+            }}))
+            rapidpro_outgoing.sequencer.process_message(message)
+            messages.append(message)
+        time.sleep(0.5)
+        rapidpro_outgoing.sequencer.join()
+
+        # Coalesced sends are limited to max_retried_group_size recipients, so a failed send is retried
+        self.assertEqual(rapidpro_outgoing.rapidpro_client.outgoing, [
+            ([f"tel:+0123456789037-{index}" for index in range(0, 15)], "1/1 the same reply"),
+            ([f"tel:+0123456789037-{index}" for index in range(15, 20)], "1/1 the same reply"),
+        ])
+        self.assertTrue(all(message.acked for message in messages))
+
+    def test_process_messages_coalesce_order(self):
+        self.setup_rapidpro_adapter()
+        rapidpro_outgoing.coalesce_window = 0.2
+        rapidpro_outgoing.retry_wait_times = [0.1, 0.1, 0.1]
+        ids = self.add_mappings(2)
+
+        messages = []
+        for id, text in [(ids[0], "first"), (ids[1], "first"), (ids[0], "second")]:
+            message = test_util.MockPubSubMessage(json.dumps({"payload": {
+                "action": "send_messages",
+                "ids": [id],
+                "messages": [text]
+            }}))
+            rapidpro_outgoing.sequencer.process_message(message)
+            messages.append(message)
+        rapidpro_outgoing.sequencer.join()
+
+        # A message with different texts is not coalesced, and the pending sends are sent before it
+        self.assertEqual(rapidpro_outgoing.rapidpro_client.outgoing, [
+            (["tel:+0123456789037-0", "tel:+0123456789037-1"], "first")
+        ])
+        self.assertEqual([message.acked for message in messages], [True, True, False])
+        time.sleep(0.5)
+        rapidpro_outgoing.sequencer.join()
+        self.assertEqual(rapidpro_outgoing.rapidpro_client.outgoing[1:], [(["tel:+0123456789037-0"], "second")])
+        self.assertTrue(messages[2].acked)
+
+    def test_process_messages_coalesce_after_failure(self):
+        self.setup_rapidpro_adapter()
+        rapidpro_outgoing.coalesce_window = 0.2
+        ids = self.add_mappings(1)
+        uncaught = []
+        original_excepthook = threading.excepthook
+        threading.excepthook = uncaught.append
+        self.addCleanup(setattr, threading, "excepthook", original_excepthook)
+
+        message = test_util.MockPubSubMessage(json.dumps({"payload": {
+            "action": "send_messages",
+            "ids": ids,
+            "messages": ["1/1 the same reply"]
+        }}))
+        rapidpro_outgoing.sequencer.process_message(message)
+        rapidpro_outgoing.sequencer.process_message(test_util.MockPubSubMessage("not json"))
+        rapidpro_outgoing.sequencer.join()
+        self.assertIsNotNone(rapidpro_outgoing.sequencer.last_exception)
+
+        # Once the window has elapsed the failed sequencer does not send the pending sends
+        # and the timer thread does not raise the sequencer's exception
+        time.sleep(0.5)
+        self.assertEqual(uncaught, [])
+        self.assertEqual(rapidpro_outgoing.rapidpro_client.outgoing, [])
+        self.assertFalse(message.acked)
+        rapidpro_outgoing.sequencer.last_exception = None
+
+    def test_process_messages_interactive_lane(self):
+        self.setup_rapidpro_adapter()
+        rapidpro_outgoing.interactive_sequencer = MessageSequencer(rapidpro_outgoing.process_interactive_message_impl)
+        ids = self.add_mappings(101)
+        rapidpro_client = rapidpro_outgoing.rapidpro_client
+
+        # Block sending the broadcast until the interactive message has been sent
+        broadcast_started = threading.Event()
+        broadcast_unblocked = threading.Event()
+        original_send = rapidpro_client.send_message_to_urns
+        def send_message_to_urns(message, urns, interrupt=False):
+            if len(urns) > 1:
+                broadcast_started.set()
+                broadcast_unblocked.wait(10)
+            original_send(message, urns, interrupt)
+        rapidpro_client.send_message_to_urns = send_message_to_urns
+
+        broadcast = {"action": "send_messages", "ids": ids[1:], "messages": ["1/1 the broadcast"]}
+        reply = {"action": "send_messages", "ids": ids[:1], "messages": ["1/1 the reply"]}
+        self.assertEqual(message_util.outgoing_lane(broadcast), message_util.BULK_LANE)
+        self.assertEqual(message_util.outgoing_lane(reply), message_util.INTERACTIVE_LANE)
+        self.assertEqual(message_util.outgoing_lane(dict(broadcast, lane="interactive")), message_util.INTERACTIVE_LANE)
+
+        broadcast_message = test_util.MockPubSubMessage(json.dumps({"payload": broadcast}))
+        rapidpro_outgoing.sequencer.process_message(broadcast_message)
+        self.assertTrue(broadcast_started.wait(10))
+
+        reply_message = test_util.MockPubSubMessage(json.dumps({"payload": reply}))
+        rapidpro_outgoing.interactive_sequencer.process_message(reply_message)
+        rapidpro_outgoing.interactive_sequencer.join()
+        self.assertTrue(reply_message.acked)
+        self.assertEqual(rapidpro_client.outgoing, [(["tel:+0123456789037-0"], "1/1 the reply")])
+
+        broadcast_unblocked.set()
+        rapidpro_outgoing.sequencer.join()
+        rapidpro_outgoing.interactive_sequencer.stop()
+        self.assertTrue(broadcast_message.acked)
+        self.assertEqual(len(rapidpro_client.outgoing), 2)
+
+    def test_process_messages_scheduled_retry(self):
+        self.setup_rapidpro_adapter()
+        rapidpro_outgoing.retry_wait_times = [0.3, 0.3, 0.3]
+        rapidpro_outgoing.circuit_breaker = CircuitBreaker("rapidpro-outgoing")
+        rapidpro_outgoing.retry_queue = RetryQueue()
+        ids = self.add_mappings(2)
+        rapidpro_client = rapidpro_outgoing.rapidpro_client
+
+        def new_message(id, text):
+            return test_util.MockPubSubMessage(json.dumps({"payload": {
+                "action": "send_messages",
+                "ids": [id],
+                "messages": [text]
+            }}))
+
+        try:
+            # The first send fails, so a retry is scheduled and the message is not acked until it succeeds
+            rapidpro_client.retry_count = 1
+            first = new_message(ids[0], "first")
+            rapidpro_outgoing.sequencer.process_message(first)
+            rapidpro_outgoing.sequencer.join()
+            self.assertFalse(first.acked)
+
+            # Sending to another recipient is not delayed by the retry
+            other = new_message(ids[1], "other")
+            rapidpro_outgoing.sequencer.process_message(other)
+            rapidpro_outgoing.sequencer.join()
+            self.assertTrue(other.acked)
+
+            # Sending to the same recipient waits for the retry so that the messages are sent in order
+            second = new_message(ids[0], "second")
+            rapidpro_outgoing.sequencer.process_message(second)
+            rapidpro_outgoing.sequencer.join()
+            self.assertTrue(first.acked)
+            self.assertTrue(second.acked)
+            self.assertEqual([text for _, text in rapidpro_client.outgoing], ["other", "first", "second"])
+            self.assertEqual(rapidpro_outgoing.circuit_breaker.failure_count(), 1)
+        finally:
+            rapidpro_outgoing.retry_queue.stop()
+            rapidpro_outgoing.retry_queue = None
+
     def test_process_message_order_live(self):
         if not self.setup_rapidpro_adapter_live(): return
 
@@ -300,6 +722,17 @@ class RapidProOutgoingTestCase(unittest.TestCase):
         subscriber.process_message_funct = original
         return payloads
 
+    def add_mappings(self, count):
+        """Add mappings for the specified # of phone numbers and return their ids"""
+        ids = []
+        for index in range(0, count):
+            id = f"nook-phone-uuid-837601-473126-{index}"
+            tel = f"tel:+0123456789037-{index}"
+            doc = self.firebase_client.document(f"tables/uuid-table/mappings/{tel}")
+            doc.set({ "uuid": id, "__id": tel })
+            ids.append(id)
+        return ids
+
     def setup_rapidpro_adapter_impl(self):
         self.log = test_util.TestLogger(test_util.name_of_test_method())
         self.firebase_client = MockFirestoreClient('testdata/uuid_mappings.json')
@@ -307,6 +740,7 @@ class RapidProOutgoingTestCase(unittest.TestCase):
         # Simulate normal message flow
         # publisher[message] --> sequencer --> process_message_impl
         rapidpro_outgoing.sequencer = MessageSequencer(rapidpro_outgoing.process_message_impl)
+        self.addCleanup(rapidpro_outgoing.sequencer.stop)
 
         firestore_uuid_table.log = self.log
         rapidpro_outgoing.log = self.log
@@ -314,30 +748,38 @@ class RapidProOutgoingTestCase(unittest.TestCase):
         lookup_table = rapidpro_adapter_cli.new_uuid_table(test_util.crypto_token_path, self.firebase_client)
         rapidpro_outgoing.phone_number_uuid_table = lookup_table
         rapidpro_outgoing.rapidpro_client = MockRapidProClient()
-        rapidpro_outgoing.rapidpro_lock = threading.Lock()
+        rapidpro_outgoing.rapidpro_lock = threading.BoundedSemaphore(4)
+        rapidpro_outgoing.max_concurrent_group_sends = 1
+        rapidpro_outgoing.min_split_group_size = None
+        rapidpro_outgoing.quarantine_report_path = None
+        rapidpro_outgoing.coalesce_window = None
+        rapidpro_outgoing.pending_sends = dict()
+        rapidpro_outgoing.interactive_sequencer = None
+        rapidpro_outgoing.retry_queue = None
+        rapidpro_outgoing.stopping.clear()
 
     def process_message(self, payload, retry_wait_times=None, retry_count=0):
         if retry_wait_times is None:
             rapidpro_outgoing.retry_wait_times = [0.1, 0.1, 0.1]
         else:
             rapidpro_outgoing.retry_wait_times = retry_wait_times
-        rapidpro_outgoing.last_failure_tokens = [] # Reset the failure tokens
+        rapidpro_outgoing.circuit_breaker = CircuitBreaker("rapidpro-outgoing")
         rapidpro_outgoing.rapidpro_client.retry_count = retry_count
         message = test_util.MockPubSubMessage(json.dumps({"payload": payload}))
         self.assertEqual(message.acked, False)
-        try:
-            rapidpro_outgoing.sequencer.process_message(message)
-            self.assertEqual(message.acked, True)
-        except Exception as e:
+        rapidpro_outgoing.sequencer.process_message(message)
+        rapidpro_outgoing.sequencer.join()
+        if rapidpro_outgoing.sequencer.last_exception is not None:
             self.assertEqual(message.acked, False)
-            raise
+            raise rapidpro_outgoing.sequencer.last_exception
+        self.assertEqual(message.acked, True)
 
     def process_message_impl(self, payload, retry_wait_times=None, retry_count=0):
         if retry_wait_times is None:
             rapidpro_outgoing.retry_wait_times = [0.1, 0.1, 0.1]
         else:
             rapidpro_outgoing.retry_wait_times = retry_wait_times
-        rapidpro_outgoing.last_failure_tokens = [] # Reset the failure tokens
+        rapidpro_outgoing.circuit_breaker = CircuitBreaker("rapidpro-outgoing")
         rapidpro_outgoing.rapidpro_client.retry_count = retry_count
         message = test_util.MockPubSubMessage(json.dumps({"payload": payload}))
         self.assertEqual(message.acked, False)
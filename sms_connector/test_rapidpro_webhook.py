@@ -0,0 +1,194 @@
+import json
+import sys
+import threading
+import unittest
+import urllib.error
+import urllib.request
+
+import rapidpro_adapter_cli
+import rapidpro_incoming
+import rapidpro_webhook
+
+from lib import firestore_uuid_table
+from lib import test_util
+from lib.mock_firebase import MockFirestoreClient
+from lib.mock_rapidpro import MockRapidProClient, MockRapidProMessage
+
+# The input of RapidPro's default flow webhook body, which does not include created_on
+default_flow_webhook_event = {
+    "contact": {"uuid": "contact-uuid", "name": "", "urn": "tel:+0123456789-10"},
+    "flow": {"uuid": "flow-uuid", "name": "Forward to nook"},
+    "input": {
+        "uuid": "message-uuid-1",
+        "channel": {"uuid": "channel-uuid", "name": "Nook"},
+        "urn": "tel:+0123456789-10",
+        "text": "Some client message",
+        "attachments": [],
+    },
+}
+
+# A flow webhook body which adds input.created_on to the input
+flow_webhook_event = dict(default_flow_webhook_event, input=dict(
+    default_flow_webhook_event["input"], created_on="2019-10-02T06:47:14.267126Z"))
+
+
+class RapidProWebhookTestCase(unittest.TestCase):
+    def test_flow_webhook_event(self):
+        self.setup_webhook()
+
+        status, body = self.post(flow_webhook_event)
+
+        self.assertEqual(status, 200)
+        self.assertEqual(body, {"received": 1})
+        payloads = rapidpro_incoming.publisher.payloads
+        self.assertEqual(len(payloads), 1)
+        self.assertEqual(payloads[0]["action"], "sms_from_rapidpro")
+        self.assertEqual(payloads[0]["sms_raw"], {
+            "deidentified_phone_number": "nook-phone-uuid-91755b17-3f7e-429c-934c-9ed402d715f7",
+            "created_on": "2019-10-02T06:47:14.267126+00:00",
+            "text": "Some client message",
+            "direction": "in",
+        })
+
+    def test_concurrent_requests_batched(self):
+        self.setup_webhook(max_latency=0.5)
+        events = [{"urn": f"tel:+0123456789-{index}", "text": f"message {index}",
+                   "created_on": f"2019-10-02T06:47:0{index}+00:00"} for index in range(1, 6)]
+
+        uuid_table = rapidpro_incoming.phone_number_uuid_table
+        data_to_uuid_batch = uuid_table.data_to_uuid_batch
+        batch_sizes = []
+
+        def record_batch(list_of_data):
+            batch_sizes.append(len(list_of_data))
+            return data_to_uuid_batch(list_of_data)
+
+        uuid_table.data_to_uuid_batch = record_batch
+
+        results = []
+        threads = [threading.Thread(target=lambda event=event: results.append(self.post(event))) for event in events]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual([status for status, _ in results], [200] * 5)
+        self.assertEqual(sorted(payload["sms_raw"]["text"] for payload in rapidpro_incoming.publisher.payloads),
+                         [f"message {index}" for index in range(1, 6)])
+        # All of the requests arrived within the batch latency, so they were published in a single batch
+        self.assertEqual(batch_sizes, [5])
+
+    def test_invalid_requests(self):
+        self.setup_webhook(token="secret")
+
+        self.assertEqual(self.post(flow_webhook_event, token=None)[0], 401)
+        self.assertEqual(self.post(flow_webhook_event, token="wrong")[0], 401)
+        self.assertEqual(self.post({"text": "missing urn"}, token="secret")[0], 400)
+        self.assertEqual(self.post({"urn": "tel:+0123456789-10", "text": "no tz", "created_on": "2019-10-02T06:47:14"},
+                                   token="secret")[0], 400)
+        self.assertEqual(self.post(default_flow_webhook_event, token="secret")[0], 400)
+        self.assertEqual(self.post(flow_webhook_event, token="secret", path="/other")[0], 404)
+        self.assertEqual(self.post(b"not json", token="secret")[0], 400)
+        self.assertEqual(len(rapidpro_incoming.publisher.payloads), 0)
+
+        self.assertEqual(self.post(flow_webhook_event, token="secret")[0], 200)
+        self.assertEqual(self.post(flow_webhook_event, token="secret", token_in_query=True)[0], 200)
+
+    def test_publish_fail(self):
+        self.setup_webhook()
+        rapidpro_incoming.publisher.publish_exception = Exception("pretend publish failure for testing")
+
+        status, _ = self.post(flow_webhook_event)
+
+        # RapidPro can retry the request
+        self.assertEqual(status, 503)
+
+    def test_reconciliation_poll_skips_published_messages(self):
+        self.setup_webhook()
+        self.assertEqual(self.post(flow_webhook_event)[0], 200)
+
+        # Messages are matched by uuid, so the same text sent again by the same contact is not skipped
+        self.rapidpro_client.incoming.extend([
+            MockRapidProMessage("2019-10-02T06:47:14.312345+00:00", "tel:+0123456789-10", "in", "Some client message",
+                                uuid="message-uuid-1"),
+            MockRapidProMessage("2019-10-02T06:48:14.267126+00:00", "tel:+0123456789-10", "in", "Some client message",
+                                uuid="message-uuid-2"),
+            MockRapidProMessage("2019-10-02T06:49:14.267126+00:00", "tel:+0123456789-11", "in", "Missed by webhook",
+                                uuid="message-uuid-3"),
+        ])
+        self.assertEqual(rapidpro_incoming.transfer_messages(), 2)
+
+        payloads = rapidpro_incoming.publisher.payloads
+        self.assertEqual([payload["sms_raw"]["text"] for payload in payloads],
+                         ["Some client message", "Some client message", "Missed by webhook"])
+
+    def test_messages_without_uuid_never_skipped(self):
+        self.setup_webhook()
+        body = json.loads(json.dumps(flow_webhook_event))
+        del body["input"]["uuid"]
+        self.assertEqual(self.post(body)[0], 200)
+
+        # Without a uuid the same text from the same contact may be a separate message, so it is not skipped
+        self.rapidpro_client.incoming.extend([
+            MockRapidProMessage("2019-10-02T06:47:14.312345+00:00", "tel:+0123456789-10", "in", "Some client message"),
+            MockRapidProMessage("2019-10-02T06:48:14.267126+00:00", "tel:+0123456789-10", "in", "Some client message"),
+        ])
+        self.assertEqual(rapidpro_incoming.transfer_messages(), 2)
+        self.assertEqual(len(rapidpro_incoming.publisher.payloads), 3)
+
+    def test_token_required_on_public_interface(self):
+        test_util.print_test_header()
+        self.assertTrue(rapidpro_webhook.is_loopback("127.0.0.1"))
+        self.assertTrue(rapidpro_webhook.is_loopback("localhost"))
+        self.assertTrue(rapidpro_webhook.is_loopback("::1"))
+        self.assertFalse(rapidpro_webhook.is_loopback("0.0.0.0"))
+        self.assertFalse(rapidpro_webhook.is_loopback("example.com"))
+        with self.assertRaises(ValueError):
+            rapidpro_webhook.init("0.0.0.0", 0)
+        self.assertIsNone(rapidpro_webhook.server)
+
+    ############ Test Helper Methods ############################################################
+
+    def setup_webhook(self, token=None, max_latency=0.01):
+        test_util.print_test_header()
+
+        self.rapidpro_client = MockRapidProClient()
+        self.firebase_client = MockFirestoreClient('testdata/uuid_mappings.json')
+
+        self.log = test_util.TestLogger(__name__)
+        firestore_uuid_table.log = self.log
+        rapidpro_incoming.log = self.log
+        rapidpro_webhook.log = self.log
+        rapidpro_incoming.rapidpro_client = self.rapidpro_client
+        rapidpro_incoming.rapidpro_lock = threading.Lock()
+        rapidpro_incoming.phone_number_uuid_table = rapidpro_adapter_cli.new_uuid_table(None, self.firebase_client)
+        rapidpro_incoming.publisher = test_util.MockPublisher()
+        rapidpro_incoming.recently_published = rapidpro_incoming.RecentMessages(100)
+
+        rapidpro_webhook.init("127.0.0.1", 0, token=token, max_latency=max_latency)
+        self.port = rapidpro_webhook.server.server_address[1]
+
+    def post(self, body, token=None, token_in_query=False, path=rapidpro_webhook.WEBHOOK_PATH):
+        """Post the specified body to the webhook and return a tuple (status, response body)"""
+        url = f"http://127.0.0.1:{self.port}{path}"
+        headers = {"Content-Type": "application/json"}
+        if token is not None:
+            if token_in_query:
+                url = f"{url}?token={token}"
+            else:
+                headers["Authorization"] = f"Token {token}"
+        data = body if isinstance(body, bytes) else json.dumps(body).encode("utf-8")
+        request = urllib.request.Request(url, data=data, headers=headers, method="POST")
+        try:
+            with urllib.request.urlopen(request, timeout=10) as response:
+                return response.status, json.loads(response.read())
+        except urllib.error.HTTPError as e:
+            return e.code, json.loads(e.read())
+
+    def tearDown(self):
+        rapidpro_webhook.teardown()
+        rapidpro_incoming.recently_published = None
+
+
+if __name__ == '__main__':
+    test_util.setup_all_unittests(sys.argv)
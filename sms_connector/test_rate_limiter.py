@@ -0,0 +1,70 @@
+import sys
+import unittest
+
+from lib import test_util
+from lib.rate_limiter import RateLimiter
+
+
+class FakeClock(object):
+    """A clock which only advances when sleep is called"""
+    def __init__(self):
+        self.now = 0.0
+        self.sleeps = []
+
+    def time(self):
+        return self.now
+
+    def sleep(self, sec):
+        self.sleeps.append(sec)
+        self.now += sec
+
+
+class RateLimiterTestCase(unittest.TestCase):
+    def test_acquire(self):
+        test_util.print_test_header()
+        clock = FakeClock()
+        limiter = RateLimiter(max_rate=10, burst=5, clock=clock.time, sleep=clock.sleep)
+
+        # The burst is available immediately, then requests are spaced at the max rate
+        for _ in range(0, 5):
+            limiter.acquire()
+        self.assertEqual(clock.now, 0)
+        for _ in range(0, 10):
+            limiter.acquire()
+        self.assertAlmostEqual(clock.now, 1.0)
+
+    def test_acquire_unlimited(self):
+        test_util.print_test_header()
+        clock = FakeClock()
+        limiter = RateLimiter(clock=clock.time, sleep=clock.sleep)
+
+        for _ in range(0, 1000):
+            limiter.acquire()
+        self.assertEqual(clock.now, 0)
+
+        # Requests still pause when throttled
+        limiter.throttle(5)
+        limiter.acquire()
+        self.assertEqual(clock.now, 5)
+        self.assertEqual(limiter.stats(), {"rate": None, "throttle_count": 1, "wait_time": 5})
+
+    def test_throttle(self):
+        test_util.print_test_header()
+        clock = FakeClock()
+        limiter = RateLimiter(max_rate=10, burst=1, recovery_period=10, clock=clock.time, sleep=clock.sleep)
+
+        # Throttling while paused extends the pause without reducing the rate again
+        limiter.throttle(2)
+        limiter.throttle(3)
+        self.assertEqual(limiter.stats()["rate"], 5)
+        self.assertEqual(limiter.stats()["throttle_count"], 1)
+        limiter.acquire()
+        self.assertAlmostEqual(clock.now, 3 + 1 / 5, delta=0.1)
+
+        # The rate recovers to the max rate
+        clock.now += 20
+        self.assertEqual(limiter.stats()["rate"], 10)
+
+
+if __name__ == '__main__':
+    test_util.setup_all_unittests(sys.argv)
@@ -0,0 +1,41 @@
+import sys
+import threading
+import time
+import unittest
+
+from lib import test_util
+from lib.retry_queue import RetryQueue
+
+
+class RetryQueueTestCase(unittest.TestCase):
+    def test_schedule(self):
+        test_util.print_test_header()
+        retry_queue = RetryQueue()
+        calls = []
+        done = threading.Event()
+
+        # Calls are made in order of due time, not the order in which they were scheduled
+        retry_queue.schedule(0.2, lambda: (calls.append("late"), done.set()))
+        retry_queue.schedule(0.1, calls.append, "early")
+        retry_queue.schedule(0.1, calls.append, "early too")
+        self.assertEqual(len(retry_queue), 3)
+        self.assertTrue(done.wait(5))
+        self.assertEqual(calls, ["early", "early too", "late"])
+        self.assertEqual(retry_queue.stop(), [])
+
+    def test_stop(self):
+        test_util.print_test_header()
+        retry_queue = RetryQueue()
+        retry_queue.schedule(60, print, "never")
+        retry_queue.schedule(30, print, "never either")
+
+        # Calls that have not been made are returned
+        start = time.monotonic()
+        self.assertEqual(retry_queue.stop(), [("never either",), ("never",)])
+        self.assertLess(time.monotonic() - start, 5)
+        with self.assertRaises(AssertionError):
+            retry_queue.schedule(1, print, "too late")
+
+
+if __name__ == '__main__':
+    test_util.setup_all_unittests(sys.argv)
@@ -0,0 +1,76 @@
+import sys
+import unittest
+import uuid
+
+from lib import test_util
+from lib.uuid_cache import CompactUuidCache, DictUuidCache
+
+uuid_prefix = "nook-phone-uuid-"
+
+
+class UuidCacheTestCase(unittest.TestCase):
+    def test_dict_cache(self):
+        test_util.print_test_header()
+        self.assert_cache_behavior(DictUuidCache())
+
+    def test_compact_cache(self):
+        test_util.print_test_header()
+        self.assert_cache_behavior(CompactUuidCache(uuid_prefix))
+
+    def test_compact_cache_irregular_uuids(self):
+        test_util.print_test_header()
+        cache = CompactUuidCache(uuid_prefix)
+        irregular = {
+            "tel:+0123456789-1": "nook-phone-uuid-NEWLY-CREATED",
+            "tel:+0123456789-2": "my-uuid-" + str(uuid.uuid4()),
+            "tel:+0123456789-3": uuid_prefix + str(uuid.uuid4()).upper(),
+        }
+        regular = {f"tel:+0123456789-{count}-regular": uuid_prefix + str(uuid.uuid4()) for count in range(0, 5)}
+        for data, data_uuid in list(irregular.items()) + list(regular.items()):
+            cache.add(data, data_uuid)
+
+        self.assertEqual(len(cache), 8)
+        for data, data_uuid in list(irregular.items()) + list(regular.items()):
+            self.assertEqual(cache.get_uuid(data), data_uuid)
+            self.assertEqual(cache.get_data(data_uuid), data)
+        self.assertEqual(dict(cache.items()), dict(list(irregular.items()) + list(regular.items())))
+
+    def test_compact_cache_existing_mapping(self):
+        test_util.print_test_header()
+        cache = CompactUuidCache(uuid_prefix)
+        original_uuid = uuid_prefix + str(uuid.uuid4())
+        cache.add("tel:+0123456789-1", original_uuid)
+        cache.add("tel:+0123456789-1", uuid_prefix + str(uuid.uuid4()))
+        self.assertEqual(len(cache), 1)
+        self.assertEqual(cache.get_uuid("tel:+0123456789-1"), original_uuid)
+
+    ############ Test Helper Methods ############################################################
+
+    def assert_cache_behavior(self, cache):
+        self.assertEqual(len(cache), 0)
+        self.assertIsNone(cache.get_uuid("tel:+0123456789-1"))
+        self.assertIsNone(cache.get_data(uuid_prefix + str(uuid.uuid4())))
+
+        expected = dict()
+        for count in range(0, 100):
+            data = f"tel:+{count * 7919 % 1000:04}-{count}"
+            data_uuid = uuid_prefix + str(uuid.uuid4())
+            cache.add(data, data_uuid)
+            expected[data] = data_uuid
+
+            # mappings can be found immediately after they are added
+            self.assertEqual(cache.get_uuid(data), data_uuid)
+            self.assertEqual(cache.get_data(data_uuid), data)
+
+        self.assertEqual(len(cache), len(expected))
+        for data, data_uuid in expected.items():
+            self.assertEqual(cache.get_uuid(data), data_uuid)
+            self.assertEqual(cache.get_data(data_uuid), data)
+        self.assertEqual(dict(cache.items()), expected)
+        self.assertIsNone(cache.get_uuid("tel:+0123456789-unknown"))
+        self.assertIsNone(cache.get_uuid("tel:+0000-0-unknown"))
+        self.assertIsNone(cache.get_data(uuid_prefix + str(uuid.uuid4())))
+
+
+if __name__ == '__main__':
+    test_util.setup_all_unittests(sys.argv)